@@ -0,0 +1,93 @@
+"""
+Benchmark the latency of requests to a Guppy-like service with a new `httpx.AsyncClient`
+per request (previous behavior) and with the shared client of `make_http_client`.
+
+A local uvicorn server stands in for Guppy and answers each GraphQL POST with a small
+JSON body. Requests are sent in batches of `--concurrency`. Reports p50/p99 latencies.
+Over plain HTTP on localhost the gain is the connection setup and client creation;
+with TLS (dev deployments) it is larger.
+
+Usage:
+    python benchmarks/bench_http_client.py [--requests 2000] [--concurrency 10]
+"""
+
+import argparse
+import asyncio
+import socket
+import threading
+import time
+
+import httpx
+import numpy as np
+import uvicorn
+
+from gen3analysis.utils.http_client import make_http_client, use_http_client
+
+RESPONSE = b'{"data": {"_aggregation": {"case": {"_totalCount": 42}}}}'
+
+
+async def stand_in_guppy(scope, receive, send):
+    if scope["type"] != "http":
+        return
+    while (await receive()).get("more_body"):
+        pass
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send({"type": "http.response.body", "body": RESPONSE})
+
+
+def start_server() -> str:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(stand_in_guppy, port=port, log_level="error", lifespan="off")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}/graphql"
+
+
+async def run(url: str, n_requests: int, concurrency: int, http_client) -> np.ndarray:
+    async def request():
+        start = time.perf_counter()
+        async with use_http_client(http_client) as client:
+            response = await client.post(url, json={"query": "{ _totalCount }"})
+            response.json()
+        return time.perf_counter() - start
+
+    latencies = []
+    for _ in range(0, n_requests, concurrency):
+        latencies += await asyncio.gather(*(request() for _ in range(concurrency)))
+    return np.array(latencies) * 1000
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    url = start_server()
+    shared_client = make_http_client()
+    # warm up
+    await run(url, args.concurrency, args.concurrency, shared_client)
+
+    print(f"{'client':>14} {'p50 (ms)':>9} {'p99 (ms)':>9} {'total (s)':>10}")
+    for name, http_client in [("per-request", None), ("shared", shared_client)]:
+        start = time.perf_counter()
+        latencies = await run(url, args.requests, args.concurrency, http_client)
+        total = time.perf_counter() - start
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print(f"{name:>14} {p50:>9.2f} {p99:>9.2f} {total:>10.2f}")
+    await shared_client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
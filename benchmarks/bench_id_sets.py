@@ -0,0 +1,104 @@
+"""
+Benchmark the comparison of the ids of two cohorts, as done by `/survival/compare`.
+
+Compares Python `set`s of string ids (intersection and differences, turned back into
+lists) with `IdDictionary` + `IdSet` (integer codes in sorted NumPy arrays). Reports
+the time to build the sets (hashing every id once in both cases), the time of the
+comparison itself, the peak memory allocated (the ids themselves are not counted) and
+the size of the sets.
+
+Usage:
+    python benchmarks/bench_id_sets.py [--sizes 100000 1000000] [--overlap 0.5]
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from gen3analysis.utils.id_sets import IdDictionary, IdSet
+
+
+def synthetic_ids(n_ids: int, overlap: float):
+    ids = np.empty(2 * n_ids, dtype=object)
+    ids[:] = [f"{i:08x}-0000-4000-8000-{i:012x}" for i in range(2 * n_ids)]
+    shift = int(n_ids * (1 - overlap))
+    return ids[:n_ids], ids[shift : shift + n_ids]
+
+
+def build_sets(ids_0, ids_1):
+    return set(ids_0), set(ids_1)
+
+
+def compare_sets(set0, set1):
+    intersection = set0 & set1
+    return list(set0 - intersection), list(set1 - intersection)
+
+
+def build_id_sets(ids_0, ids_1):
+    codes_0, codes_1 = IdDictionary().encode(ids_0, ids_1)
+    return codes_0, codes_1, IdSet.from_codes(codes_0), IdSet.from_codes(codes_1)
+
+
+def compare_id_sets(codes_0, codes_1, set0, set1):
+    return (
+        np.flatnonzero(~set1.contains(codes_0)),
+        np.flatnonzero(~set0.contains(codes_1)),
+    )
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--overlap", type=float, default=0.5)
+    args = parser.parse_args()
+
+    print(
+        f"{'ids/cohort':>10} {'method':>8} {'build (s)':>10} {'compare (s)':>12}"
+        f" {'peak (MiB)':>11} {'sets (MiB)':>11}"
+    )
+    for size in args.sizes:
+        ids_0, ids_1 = synthetic_ids(size, args.overlap)
+
+        sets, build_time, build_peak = measure(build_sets, ids_0, ids_1)
+        (legacy_0, legacy_1), compare_time, compare_peak = measure(compare_sets, *sets)
+        sets_size = sum(sys.getsizeof(ids) for ids in sets)
+        rows = [
+            ("set", build_time, compare_time, max(build_peak, compare_peak), sets_size)
+        ]
+
+        id_sets, build_time, build_peak = measure(build_id_sets, ids_0, ids_1)
+        (new_0, new_1), compare_time, compare_peak = measure(compare_id_sets, *id_sets)
+        sets_size = sum(codes.nbytes for codes in id_sets)
+        rows.append(
+            (
+                "id_sets",
+                build_time,
+                compare_time,
+                max(build_peak, compare_peak),
+                sets_size,
+            )
+        )
+        assert set(legacy_0) == set(ids_0[new_0]) and set(legacy_1) == set(ids_1[new_1])
+
+        for method, build_time, compare_time, peak, sets_size in rows:
+            print(
+                f"{size:>10} {method:>8} {build_time:>10.3f} {compare_time:>12.3f}"
+                f" {peak / 2**20:>11.1f} {sets_size / 2**20:>11.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Benchmark the donor-to-survival-estimate mapping of `get_curve`.
+
+Compares the previous `groupby().apply()` + `iterrows()` + `.loc` implementation with
+the columnar `searchsorted` join, on synthetic cohorts, and checks that both produce
+the exact same `donors` list.
+
+Usage:
+    python benchmarks/bench_survival_donors.py [--sizes 10000 100000 1000000] [--legacy-max 100000]
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+from lifelines import KaplanMeierFitter
+
+from gen3analysis.utils.survival import build_donors, donor_survival_estimates
+
+
+def synthetic_cohort(n_cases: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "duration": rng.integers(1, 5000, n_cases),
+            "event": rng.integers(0, 2, n_cases),
+            "case_id": [f"case-{i}" for i in range(n_cases)],
+            "submitter_id": [f"ID_{i}" for i in range(n_cases)],
+            "project_id": rng.choice(["P-1", "P-2", "P-3"], n_cases),
+        }
+    )
+
+
+def legacy_donors(df: pd.DataFrame, kmf: KaplanMeierFitter) -> list:
+    donors_by_time = (
+        df.groupby("duration")[["event", "case_id", "submitter_id", "project_id"]]
+        .apply(
+            lambda group: [
+                {
+                    "id": row["case_id"],
+                    "submitter_id": row["submitter_id"],
+                    "project_id": row["project_id"],
+                    "event_type": "death" if row["event"] == 1 else "censored",
+                }
+                for _, row in group.iterrows()
+            ]
+        )
+        .to_dict()
+    )
+    results = []
+    survival_df = kmf.survival_function_
+    timeline_sorted = sorted(kmf.timeline)
+    for i, time_point in enumerate(timeline_sorted):
+        survival_prob = survival_df.loc[time_point].iloc[0]
+        if time_point in donors_by_time:
+            for donor in donors_by_time[time_point]:
+                if donor["event_type"] == "death":
+                    if i > 0:
+                        donor_survival_prob = survival_df.loc[
+                            timeline_sorted[i - 1]
+                        ].iloc[0]
+                    else:
+                        donor_survival_prob = 1.0
+                else:
+                    donor_survival_prob = survival_prob
+                results.append(
+                    {
+                        "time": int(time_point),
+                        "id": donor["id"],
+                        "submitter_id": donor["submitter_id"],
+                        "project_id": donor["project_id"],
+                        "survivalEstimate": float(donor_survival_prob),
+                        "censored": donor["event_type"] == "censored",
+                    }
+                )
+    return results
+
+
+def columnar_donors(df: pd.DataFrame, kmf: KaplanMeierFitter) -> list:
+    survival_df = kmf.survival_function_
+    order, estimates = donor_survival_estimates(
+        timeline=survival_df.index.to_numpy(dtype=float),
+        survival=survival_df.iloc[:, 0].to_numpy(),
+        durations=df["duration"].to_numpy(dtype=float),
+        events=df["event"].to_numpy(),
+    )
+    return build_donors(
+        order,
+        estimates,
+        durations=df["duration"].to_numpy(),
+        events=df["event"].to_numpy(),
+        case_ids=df["case_id"].to_numpy(),
+        submitter_ids=df["submitter_id"].to_numpy(),
+        project_ids=df["project_id"].to_numpy(),
+    )
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument(
+        "--legacy-max",
+        type=int,
+        default=100_000,
+        help="skip the (slow) legacy implementation above this number of cases",
+    )
+    args = parser.parse_args()
+
+    print(f"{'cases':>10} {'fit (s)':>10} {'legacy (s)':>12} {'columnar (s)':>14}")
+    for n_cases in args.sizes:
+        df = synthetic_cohort(n_cases)
+        kmf = KaplanMeierFitter()
+        _, fit_time = timed(kmf.fit, df["duration"], df["event"])
+
+        new, new_time = timed(columnar_donors, df, kmf)
+        legacy_time = float("nan")
+        if n_cases <= args.legacy_max:
+            old, legacy_time = timed(legacy_donors, df, kmf)
+            assert json.dumps(old) == json.dumps(new), "donors lists differ"
+
+        print(f"{n_cases:>10} {fit_time:>10.3f} {legacy_time:>12.3f} {new_time:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark the parsing of Guppy `case` documents for the survival endpoints.
+
+Compares the previous `transform()` (one dict per case -> DataFrame -> `pd.to_numeric`)
+with `SurvivalAccumulator`, which parses the cases straight into typed arrays. Reports
+the time and the peak memory allocated by the parsing (the Guppy JSON itself is not
+counted).
+
+Usage:
+    python benchmarks/bench_survival_parse.py [--sizes 10000 100000] [--page-size 10000]
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from gen3analysis.utils.survival import SurvivalAccumulator
+
+
+def synthetic_cases(n_cases: int, seed: int = 0) -> list:
+    rng = np.random.default_rng(seed)
+    durations = rng.integers(1, 5000, n_cases).tolist()
+    dead = (rng.random(n_cases) < 0.3).tolist()
+    projects = rng.choice(["P-1", "P-2", "P-3"], n_cases).tolist()
+    return [
+        {
+            "_case_id": f"{i:08x}-0000-4000-8000-{i:012x}",
+            "submitter_id": f"ID_{i}",
+            "project_id": projects[i],
+            "demographic": [
+                {
+                    "days_to_death": durations[i] if dead[i] else None,
+                    "vital_status": "Dead" if dead[i] else "Alive",
+                }
+            ],
+            "diagnoses": [{"days_to_last_follow_up": durations[i]}],
+        }
+        for i in range(n_cases)
+    ]
+
+
+def legacy_parse(cases: list, page_size: int) -> pd.DataFrame:
+    records = []
+    for case in cases:
+        demographic = case.get("demographic", [])
+        if not demographic:
+            continue
+        demo = demographic[0]
+        days_to_death = demo.get("days_to_death")
+        diagnoses = case.get("diagnoses", [{}])[0]
+        days_to_follow_up = diagnoses.get("days_to_last_follow_up")
+        duration = days_to_death if days_to_death is not None else days_to_follow_up
+        if duration is not None:
+            records.append(
+                {
+                    "duration": duration,
+                    "event": int(demo.get("vital_status", "").lower() != "alive"),
+                    "case_id": case.get("_case_id"),
+                    "submitter_id": case.get("submitter_id"),
+                    "project_id": case.get("project_id"),
+                }
+            )
+    df = pd.DataFrame(records)
+    df["duration"] = pd.to_numeric(df["duration"], errors="coerce")
+    df["event"] = pd.to_numeric(df["event"], errors="coerce").astype(int)
+    return df.dropna(subset=["duration", "event"])
+
+
+def columnar_parse(cases: list, page_size: int):
+    accumulator = SurvivalAccumulator()
+    for start in range(0, len(cases), page_size):
+        accumulator.add_page(cases[start : start + page_size])
+    return accumulator.finalize()
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10_000, 100_000])
+    parser.add_argument("--page-size", type=int, default=10_000)
+    args = parser.parse_args()
+
+    print(
+        f"{'cases':>10} {'legacy (s)':>11} {'legacy (MiB)':>13} "
+        f"{'columnar (s)':>13} {'columnar (MiB)':>15}"
+    )
+    for n_cases in args.sizes:
+        cases = synthetic_cases(n_cases)
+        df, old_time, old_peak = measure(legacy_parse, cases, args.page_size)
+        cohort, new_time, new_peak = measure(columnar_parse, cases, args.page_size)
+        assert np.array_equal(df["duration"].to_numpy(dtype=float), cohort.durations)
+        assert np.array_equal(df["event"].to_numpy(), cohort.events)
+        print(
+            f"{n_cases:>10} {old_time:>11.3f} {old_peak:>13.1f} "
+            f"{new_time:>13.3f} {new_peak:>15.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -67,14 +67,200 @@ if DEPLOYMENT_TYPE not in ["prod", "dev"]:
 # )
 #
 URL_PREFIX = config("URL_PREFIX", default=None)
+
+# HTTP client shared by the requests to other Gen3 services (Guppy, revproxy): maximum
+# number of connections, of idle connections kept alive and for how long (seconds),
+# timeouts (seconds; `HTTP_CLIENT_TIMEOUT` applies to reads and writes) and whether to
+# use HTTP/2 (requires `pip install httpx[http2]`)
+HTTP_CLIENT_MAX_CONNECTIONS = config(
+    "HTTP_CLIENT_MAX_CONNECTIONS", cast=int, default=100
+)
+HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS = config(
+    "HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS", cast=int, default=20
+)
+HTTP_CLIENT_KEEPALIVE_EXPIRY = config(
+    "HTTP_CLIENT_KEEPALIVE_EXPIRY", cast=float, default=30
+)
+HTTP_CLIENT_TIMEOUT = config("HTTP_CLIENT_TIMEOUT", cast=float, default=60)
+HTTP_CLIENT_CONNECT_TIMEOUT = config(
+    "HTTP_CLIENT_CONNECT_TIMEOUT", cast=float, default=5
+)
+HTTP_CLIENT_POOL_TIMEOUT = config("HTTP_CLIENT_POOL_TIMEOUT", cast=float, default=10)
+HTTP_CLIENT_HTTP2 = config("HTTP_CLIENT_HTTP2", cast=bool, default=False)
+
+# the CSRF token sent to Guppy is refreshed in the background this many seconds before
+# it expires. If `CSRF_TOKEN_SHARED_FILE` is set, the token is stored in that file so
+# that all the workers of a server share it (e.g. "/tmp/gen3analysis-csrf.json")
+CSRF_TOKEN_REFRESH_AHEAD_SECONDS = config(
+    "CSRF_TOKEN_REFRESH_AHEAD_SECONDS", cast=float, default=60
+)
+CSRF_TOKEN_SHARED_FILE = config("CSRF_TOKEN_SHARED_FILE", default="")
+
+# if True, concurrent identical Guppy queries (same query, variables and access token)
+# share a single upstream request
+GUPPY_COALESCE_REQUESTS = config("GUPPY_COALESCE_REQUESTS", cast=bool, default=True)
+
+# cache of the results of the Guppy aggregations marked as cacheable (facets and
+# counts of the cohort comparisons), keyed by query, variables and the caller's access
+# token. Results are fresh for `GUPPY_CACHE_TTL_SECONDS`, then served for
+# `GUPPY_CACHE_STALE_SECONDS` more while being refreshed in the background. If
+# `GUPPY_CACHE_DIR` is set, results are also stored in that directory (at most about
+# `GUPPY_CACHE_DISK_MAX_ENTRIES` files; 0 means no limit), shared by the workers. Set
+# `GUPPY_CACHE_MAX_ENTRIES` to 0 to disable it
+GUPPY_CACHE_MAX_ENTRIES = config("GUPPY_CACHE_MAX_ENTRIES", cast=int, default=1024)
+GUPPY_CACHE_TTL_SECONDS = config("GUPPY_CACHE_TTL_SECONDS", cast=float, default=60)
+GUPPY_CACHE_STALE_SECONDS = config("GUPPY_CACHE_STALE_SECONDS", cast=float, default=300)
+GUPPY_CACHE_DIR = config("GUPPY_CACHE_DIR", default="")
+GUPPY_CACHE_DISK_MAX_ENTRIES = config(
+    "GUPPY_CACHE_DISK_MAX_ENTRIES", cast=int, default=10000
+)
+
+# concurrent requests to Guppy are limited per worker. The limit adapts between
+# `GUPPY_MIN_CONCURRENCY` and `GUPPY_MAX_CONCURRENCY`: it grows while Guppy answers
+# within `GUPPY_LATENCY_TARGET_SECONDS`, and is halved when it answers slower or fails
+GUPPY_INITIAL_CONCURRENCY = config("GUPPY_INITIAL_CONCURRENCY", cast=int, default=16)
+GUPPY_MIN_CONCURRENCY = config("GUPPY_MIN_CONCURRENCY", cast=int, default=2)
+GUPPY_MAX_CONCURRENCY = config("GUPPY_MAX_CONCURRENCY", cast=int, default=64)
+GUPPY_LATENCY_TARGET_SECONDS = config(
+    "GUPPY_LATENCY_TARGET_SECONDS", cast=float, default=5
+)
+
+# after `GUPPY_CIRCUIT_FAILURE_THRESHOLD` consecutive failures (timeouts, 5xx errors,
+# GraphQL errors other than invalid queries), requests to Guppy fail with a 503 error
+# for `GUPPY_CIRCUIT_RESET_SECONDS` seconds.
+# `0` disables the circuit breaker
+GUPPY_CIRCUIT_FAILURE_THRESHOLD = config(
+    "GUPPY_CIRCUIT_FAILURE_THRESHOLD", cast=int, default=5
+)
+GUPPY_CIRCUIT_RESET_SECONDS = config(
+    "GUPPY_CIRCUIT_RESET_SECONDS", cast=float, default=30
+)
+
+# failed requests to Guppy are retried after a random (jittered) exponential backoff of
+# at most `GUPPY_RETRY_MAX_WAIT_SECONDS`, as long as retries stay under
+# `GUPPY_RETRY_BUDGET_RATIO` times the number of requests
+GUPPY_RETRY_BUDGET_RATIO = config("GUPPY_RETRY_BUDGET_RATIO", cast=float, default=0.2)
+GUPPY_RETRY_MAX_WAIT_SECONDS = config(
+    "GUPPY_RETRY_MAX_WAIT_SECONDS", cast=float, default=2
+)
+
+# deadline of each request, in seconds: the requests it sends to Guppy are aborted (and
+# not retried) once it has passed, and the request fails with a 504 error. Clients can
+# shorten it with the `X-Request-Timeout` header. `0` means no deadline
+REQUEST_TIMEOUT_SECONDS = config("REQUEST_TIMEOUT_SECONDS", cast=float, default=60)
+
+# `/compare/facets` queries the facets in groups of at most this many facets, sent to
+# Guppy concurrently, so that a slow facet does not delay the others. `0` means a
+# single query for all the facets
+COMPARE_FACET_GROUP_SIZE = config("COMPARE_FACET_GROUP_SIZE", cast=int, default=0)
+
+# maximum number of cohorts of a `/compare/facets` request using `cohorts`, and number
+# of cohorts aggregated per Guppy query (the queries are sent concurrently). `0` means
+# all the cohorts in a single query
+COMPARE_MAX_COHORTS = config("COMPARE_MAX_COHORTS", cast=int, default=20)
+COMPARE_COHORTS_PER_QUERY = config("COMPARE_COHORTS_PER_QUERY", cast=int, default=0)
+
+# maximum number of the Guppy queries of a `/compare/facets` request (facet groups and
+# cohort chunks) that are sent at the same time. `0` means no limit
+COMPARE_MAX_CONCURRENT_QUERIES = config(
+    "COMPARE_MAX_CONCURRENT_QUERIES", cast=int, default=0
+)
+
+# in-process cache of the range of values of numeric facets in each cohort, used by
+# `/compare/facets` to compute bins shared by the cohorts (`bins`). Set
+# `FACET_RANGES_CACHE_MAX_ENTRIES` to 0 to disable it
+FACET_RANGES_CACHE_MAX_ENTRIES = config(
+    "FACET_RANGES_CACHE_MAX_ENTRIES", cast=int, default=4096
+)
+FACET_RANGES_CACHE_TTL_SECONDS = config(
+    "FACET_RANGES_CACHE_TTL_SECONDS", cast=float, default=600
+)
+
+# maximum number of cohorts of a single survival request that are fetched from Guppy
+# at the same time. `0` means no limit
+SURVIVAL_MAX_CONCURRENT_COHORTS = config(
+    "SURVIVAL_MAX_CONCURRENT_COHORTS", cast=int, default=4
+)
+
+# number of cases requested from Guppy per page when fetching a survival cohort
+SURVIVAL_PAGE_SIZE = config("SURVIVAL_PAGE_SIZE", cast=int, default=10000)
+
+# `SURVIVAL_PAGINATION_MODE` must be "offset" or "download". Either way, cohorts that
+# fit in the first page are fetched with a single GraphQL query.
+# - offset: the following pages are selected with `offset`/`first`. ES rejects pages
+#   beyond its `max_result_window` index setting (10000 by default), so larger cohorts
+#   fail.
+# - download: larger cohorts are fetched whole from Guppy's `/download` endpoint, which
+#   walks them with an ES scroll and has no depth limit. The cohort is returned in a
+#   single response.
+SURVIVAL_PAGINATION_MODE = config(
+    "SURVIVAL_PAGINATION_MODE", cast=str, default="download"
+)
+if SURVIVAL_PAGINATION_MODE not in ["offset", "download"]:
+    raise Exception(
+        f'"SURVIVAL_PAGINATION_MODE" must be "offset" or "download", got: {SURVIVAL_PAGINATION_MODE}'
+    )
+
+# `SURVIVAL_ESTIMATOR` must be "native" or "lifelines".
+# - native: Kaplan-Meier curves are fitted with the built-in NumPy implementation.
+# - lifelines: Kaplan-Meier curves are fitted with lifelines' `KaplanMeierFitter`,
+#   the reference implementation.
+SURVIVAL_ESTIMATOR = config("SURVIVAL_ESTIMATOR", cast=str, default="native")
+if SURVIVAL_ESTIMATOR not in ["native", "lifelines"]:
+    raise Exception(
+        f'"SURVIVAL_ESTIMATOR" must be "native" or "lifelines", got: {SURVIVAL_ESTIMATOR}'
+    )
+
+# in-process cache of survival curves, keyed by filter and by the caller's access token.
+# Set `SURVIVAL_CACHE_MAX_ENTRIES` to 0 to disable it. `SURVIVAL_CACHE_MAX_CASES` bounds
+# the total number of cases held by the cached curves (0 means no limit)
+SURVIVAL_CACHE_MAX_ENTRIES = config("SURVIVAL_CACHE_MAX_ENTRIES", cast=int, default=256)
+SURVIVAL_CACHE_MAX_CASES = config(
+    "SURVIVAL_CACHE_MAX_CASES", cast=int, default=2_000_000
+)
+SURVIVAL_CACHE_TTL_SECONDS = config(
+    "SURVIVAL_CACHE_TTL_SECONDS", cast=float, default=300
+)
+
+# number of donors per line when survival results are streamed as newline-delimited JSON
+SURVIVAL_STREAM_CHUNK_SIZE = config(
+    "SURVIVAL_STREAM_CHUNK_SIZE", cast=int, default=1000
+)
+
+# maximum number of curves a `stratify_by` request can split a cohort into
+SURVIVAL_MAX_STRATA = config("SURVIVAL_MAX_STRATA", cast=int, default=50)
+
+# width, in days, of the histogram buckets used by `source="aggregation"` survival
+# curves. With 1, the curves are exact; larger values return fewer, binned, time points
+SURVIVAL_HISTOGRAM_RANGE_STEP = config(
+    "SURVIVAL_HISTOGRAM_RANGE_STEP", cast=int, default=1
+)
+
+# `CPU_POOL_KIND` must be "process", "thread" or "inline". CPU-bound analysis steps
+# (curve fitting, statistics, encoding of large responses) run in a pool of
+# `CPU_POOL_MAX_WORKERS` processes or threads, or directly on the event loop ("inline").
+# Threads keep the event loop responsive, but the steps that run Python code rather
+# than NumPy (building the donors, encoding JSON) still hold the GIL and compete with
+# the requests served by the process. "process" moves the curve fitting and the
+# statistics to other processes; the Python-heavy steps run in threads in all cases.
+# Up to `CPU_POOL_MAX_QUEUE` tasks wait for a worker; more are rejected with a 503 error
+CPU_POOL_KIND = config("CPU_POOL_KIND", cast=str, default="thread")
+if CPU_POOL_KIND not in ["process", "thread", "inline"]:
+    raise Exception(
+        f'"CPU_POOL_KIND" must be "process", "thread" or "inline", got: {CPU_POOL_KIND}'
+    )
+CPU_POOL_MAX_WORKERS = config("CPU_POOL_MAX_WORKERS", cast=int, default=2)
+CPU_POOL_MAX_QUEUE = config("CPU_POOL_MAX_QUEUE", cast=int, default=64)
+
+# enable Prometheus Metrics for observability purposes
+#
+# WARNING: Any counters, gauges, histograms, etc. should be carefully
+# reviewed to make sure its labels do not contain any PII / PHI. T
 #
-# # enable Prometheus Metrics for observability purposes
-# #
-# # WARNING: Any counters, gauges, histograms, etc. should be carefully
-# # reviewed to make sure its labels do not contain any PII / PHI. T
-# #
-# # IMPORTANT: This enables a /metrics endpoint which is OPEN TO ALL TRAFFIC, unless controlled upstream
-# ENABLE_PROMETHEUS_METRICS = config("ENABLE_PROMETHEUS_METRICS", default=False)
+# IMPORTANT: This enables a /metrics endpoint which is OPEN TO ALL TRAFFIC, unless controlled upstream
+ENABLE_PROMETHEUS_METRICS = config(
+    "ENABLE_PROMETHEUS_METRICS", cast=bool, default=False
+)
 #
 # PROMETHEUS_MULTIPROC_DIR = config(
 #     "PROMETHEUS_MULTIPROC_DIR", default="/var/tmp/prometheus_metrics"
@@ -0,0 +1,15 @@
+from typing import Optional
+
+from fastapi import Request
+
+from gen3analysis.utils.cpu_pool import CPUPool
+
+
+def get_cpu_pool(request: Request) -> Optional[CPUPool]:
+    """
+    Dependency function to get the global pool for CPU-bound work.
+
+    Returns:
+        CPUPool: The global CPU pool, or None if it is not set up
+    """
+    return getattr(request.app.state, "cpu_pool", None)
@@ -0,0 +1,16 @@
+from typing import Optional
+
+from fastapi import Request
+
+from gen3analysis.utils.cache import TTLCache
+
+
+def get_facet_ranges_cache(request: Request) -> Optional[TTLCache]:
+    """
+    Dependency function to get the global cache of the ranges of values of numeric
+    facets, used to compute shared histogram bins.
+
+    Returns:
+        TTLCache: The global facet ranges cache, or None if caching is not set up
+    """
+    return getattr(request.app.state, "facet_ranges_cache", None)
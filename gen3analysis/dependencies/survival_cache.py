@@ -0,0 +1,15 @@
+from typing import Optional
+
+from fastapi import Request
+
+from gen3analysis.utils.cache import TTLCache
+
+
+def get_survival_cache(request: Request) -> Optional[TTLCache]:
+    """
+    Dependency function to get the global survival curve cache.
+
+    Returns:
+        TTLCache: The global survival curve cache, or None if caching is not set up
+    """
+    return getattr(request.app.state, "survival_cache", None)
@@ -2,10 +2,14 @@ from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Optional
 import asyncio
+import json
+import os
 import httpx
 from fastapi import HTTPException
 
+from gen3analysis import config
 from gen3analysis.config import logger
+from gen3analysis.utils.http_client import use_http_client
 
 
 @dataclass
@@ -16,24 +20,132 @@ class CachedToken:
     def is_expired(self) -> bool:
         return datetime.utcnow() >= self.expires_at
 
+    def needs_refresh(self, refresh_ahead: timedelta) -> bool:
+        return datetime.utcnow() >= self.expires_at - refresh_ahead
+
 
 class CSRFTokenCache:
-    def __init__(self, rest_api_url: str, token_ttl_seconds: int = 3600):
+    """
+    Cache of the CSRF token sent along with Guppy queries.
+
+    Reading a valid token takes no lock. Shortly before the token expires
+    (`refresh_ahead_seconds`), it is refreshed in the background while the current
+    token is still served. Concurrent refreshes share a single request. If the token
+    has expired and the refresh fails, the expired token is served rather than failing
+    the query.
+
+    With `shared_file`, the token is also stored in that file, so that the workers of
+    a server share it instead of each fetching their own.
+    """
+
+    def __init__(
+        self,
+        rest_api_url: str,
+        token_ttl_seconds: int = 3600,
+        http_client: Optional[httpx.AsyncClient] = None,
+        refresh_ahead_seconds: Optional[float] = None,
+        shared_file: Optional[str] = None,
+    ):
         self.rest_api_url = rest_api_url
+        self.http_client = http_client
         self.token_ttl = timedelta(seconds=token_ttl_seconds)
+        self.refresh_ahead = timedelta(
+            seconds=(
+                config.CSRF_TOKEN_REFRESH_AHEAD_SECONDS
+                if refresh_ahead_seconds is None
+                else refresh_ahead_seconds
+            )
+        )
+        self.shared_file = (
+            config.CSRF_TOKEN_SHARED_FILE if shared_file is None else shared_file
+        )
         self._cached_token: Optional[CachedToken] = None
-        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
         logger.info("CSRFTokenCache initialized")
 
     async def get_token(self) -> str:
-        async with self._lock:
-            if self._cached_token is None or self._cached_token.is_expired():
-                await self._refresh_token()
-            return self._cached_token.token
+        cached_token = self._cached_token
+        if cached_token is not None and not cached_token.is_expired():
+            if cached_token.needs_refresh(self.refresh_ahead):
+                self._start_refresh()
+            return cached_token.token
+
+        try:
+            await self.refresh()
+        except Exception as e:
+            if cached_token is None:
+                raise
+            logger.warning(f"Unable to refresh CSRF token, using expired token: {e}")
+            return cached_token.token
+        return self._cached_token.token
+
+    async def refresh(self, force: bool = False) -> None:
+        """
+        Refresh the token, sharing the request with any refresh in progress. With
+        `force` (e.g. the token was rejected), the current token is replaced even if
+        it is still valid, and is not adopted again from `shared_file`.
+        """
+        rejected = self._cached_token.token if force and self._cached_token else None
+        # a cancelled caller does not cancel the refresh for the other callers
+        await asyncio.shield(self._start_refresh(rejected))
+        if rejected is not None and self._cached_token.token == rejected:
+            # the refresh that was in progress kept the rejected token
+            await asyncio.shield(self._start_refresh(rejected))
+
+    def _start_refresh(self, rejected: Optional[str] = None) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh_token(rejected))
+            self._refresh_task.add_done_callback(self._log_refresh_error)
+        return self._refresh_task
+
+    @staticmethod
+    def _log_refresh_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error refreshing CSRF token: {task.exception()}")
+
+    def _read_shared_token(self) -> Optional[CachedToken]:
+        try:
+            with open(self.shared_file) as f:
+                data = json.load(f)
+            return CachedToken(
+                token=data["token"],
+                expires_at=datetime.fromisoformat(data["expires_at"]),
+            )
+        except (OSError, ValueError, KeyError) as e:
+            logger.debug(f"No shared CSRF token in '{self.shared_file}': {e}")
+            return None
+
+    def _write_shared_token(self, cached_token: CachedToken) -> None:
+        # write then rename, so that other workers never read a partial file
+        tmp_file = f"{self.shared_file}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(
+                    {
+                        "token": cached_token.token,
+                        "expires_at": cached_token.expires_at.isoformat(),
+                    },
+                    f,
+                )
+            os.replace(tmp_file, self.shared_file)
+        except OSError as e:
+            logger.warning(f"Unable to share CSRF token in '{self.shared_file}': {e}")
+
+    async def _refresh_token(self, rejected: Optional[str] = None):
+        if self.shared_file:
+            # another worker may have refreshed the token already
+            shared_token = self._read_shared_token()
+            if (
+                shared_token is not None
+                and shared_token.token != rejected
+                and not shared_token.needs_refresh(self.refresh_ahead)
+            ):
+                self._cached_token = shared_token
+                return
 
-    async def _refresh_token(self):
         try:
-            async with httpx.AsyncClient() as session:
+            async with use_http_client(self.http_client) as session:
                 response = await session.get(self.rest_api_url)
                 if response.status_code != 200:
                     raise HTTPException(
@@ -51,6 +163,8 @@ class CSRFTokenCache:
                 self._cached_token = CachedToken(
                     token=token, expires_at=datetime.utcnow() + self.token_ttl
                 )
+                if self.shared_file:
+                    self._write_shared_token(self._cached_token)
         except httpx.ConnectError as e:
             raise HTTPException(
                 status_code=503,
@@ -1,21 +1,266 @@
 import asyncio
-from typing import Dict, Any, Optional
+from collections import Counter
+from contextvars import Context
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
 
 from fastapi import Cookie, HTTPException
 import httpx
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
+from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
+from gen3analysis import config
 from gen3analysis.config import logger
 from gen3analysis.gen3.csrfTokenCache import CSRFTokenCache
+from gen3analysis.utils.backpressure import AdaptiveLimiter, CircuitBreaker, RetryBudget
+from gen3analysis.utils.cache import MISSING, TTLCache, access_scope, canonical_hash
+from gen3analysis.utils.deadline import (
+    capped_timeout,
+    check_deadline,
+    remaining,
+    within_deadline,
+)
+from gen3analysis.utils.http_client import use_http_client
+from gen3analysis.utils.metrics import (
+    CACHE_EVICTIONS,
+    CACHE_REQUESTS,
+    CACHE_REVALIDATIONS,
+    GUPPY_COALESCED_REQUESTS,
+)
+
+# responses that suggest Guppy (or Elasticsearch) is overloaded or unavailable
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+# codes (`extensions.code`) of the GraphQL errors caused by the query itself
+GRAPHQL_CLIENT_ERRORS = {
+    "GRAPHQL_PARSE_FAILED",
+    "GRAPHQL_VALIDATION_FAILED",
+    "BAD_USER_INPUT",
+}
+
+
+class _RetryableError(HTTPException):
+    """Transient error of a Guppy request, which may succeed if retried"""
+
+
+class GuppyQueryError(HTTPException):
+    """Guppy rejected the query itself, e.g. because it selects an unknown field"""
+
+
+def _stop_before_deadline(retry_state: RetryCallState) -> bool:
+    # don't retry if the deadline would pass before the next attempt
+    left = remaining()
+    return left is not None and left <= retry_state.upcoming_sleep
+
+
+class _CachedResponse(NamedTuple):
+    # wall-clock times, so that entries stored on disk outlive the process
+    fresh_until: float
+    stale_until: float
+    result: Dict[str, Any]
+
+
+class GuppyResponseCache:
+    """
+    Cache of the parsed results of Guppy queries that callers mark as cacheable
+    (aggregations: facets, counts...), keyed by query, canonical variables and access
+    scope (see `canonical_hash`).
+
+    Results are fresh for `ttl_seconds`. For `stale_seconds` more, they are still
+    returned immediately, while a background request refreshes them
+    ("stale-while-revalidate"), so popular queries never wait for Guppy.
+
+    Entries are kept in memory (LRU, at most `max_entries`) and, if `directory` is set,
+    on disk (at most about `max_disk_entries` files), where they are shared by the
+    workers of a server and survive restarts. Files are only readable by their owner
+    since results depend on the caller's access.
+    """
+
+    # the oldest files are removed every time this many files were written
+    DISK_PRUNE_INTERVAL = 64
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        stale_seconds: float = 0,
+        directory: str = "",
+        max_disk_entries: int = 0,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.memory = TTLCache(
+            name="guppy_responses",
+            max_entries=max_entries,
+            ttl_seconds=ttl_seconds + stale_seconds,
+        )
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._disk_writes = 0
+        # key => task refreshing a stale entry
+        self._revalidating: Dict[str, asyncio.Task] = {}
+
+    async def get_or_fetch(
+        self, key: str, fetch: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """Return the cached result for `key`, or fetch it and cache it"""
+        entry = self.memory.get(key)
+        if entry is MISSING and self.directory:
+            entry = await asyncio.to_thread(self._read, key)
+            if entry is not MISSING:
+                self.memory.set(key, entry)
+
+        now = time.time()
+        if entry is not MISSING and now < entry.stale_until:
+            if now >= entry.fresh_until:
+                self._revalidate(key, fetch)
+            return entry.result
+
+        result = await fetch()
+        await self._store(key, result)
+        return result
+
+    def _revalidate(
+        self, key: str, fetch: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> None:
+        if key in self._revalidating:
+            CACHE_REVALIDATIONS.labels(cache=self.memory.name, result="pending").inc()
+            return
+        CACHE_REVALIDATIONS.labels(cache=self.memory.name, result="started").inc()
+        # in a new context: the refresh is not bound to the deadline of the request
+        # that triggered it, and is not cancelled if that request is
+        task = asyncio.create_task(self._refresh(key, fetch), context=Context())
+        self._revalidating[key] = task
+        task.add_done_callback(lambda _: self._revalidating.pop(key, None))
+
+    async def _refresh(
+        self, key: str, fetch: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> None:
+        try:
+            await self._store(key, await fetch())
+        except Exception as e:
+            # the stale result keeps being served until it expires
+            logger.warning(f"Unable to refresh cached Guppy response: {e}")
+            CACHE_REVALIDATIONS.labels(cache=self.memory.name, result="failed").inc()
+        else:
+            CACHE_REVALIDATIONS.labels(cache=self.memory.name, result="succeeded").inc()
+
+    async def _store(self, key: str, result: Dict[str, Any]) -> None:
+        now = time.time()
+        entry = _CachedResponse(
+            fresh_until=now + self.ttl_seconds,
+            stale_until=now + self.ttl_seconds + self.stale_seconds,
+            result=result,
+        )
+        self.memory.set(key, entry)
+        if self.directory:
+            await asyncio.to_thread(self._write, key, entry)
+
+    def _path(self, key: str) -> str:
+        # keys are hex digests, safe to use as file names
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read(self, key: str) -> Any:
+        disk_cache = f"{self.memory.name}_disk"
+        try:
+            with open(self._path(key)) as f:
+                entry = _CachedResponse(**json.load(f))
+        except FileNotFoundError:
+            entry = MISSING
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable cached Guppy response: {e}")
+            entry = MISSING
+        if entry is not MISSING and entry.stale_until <= time.time():
+            entry = MISSING
+        result = "miss" if entry is MISSING else "hit"
+        CACHE_REQUESTS.labels(cache=disk_cache, result=result).inc()
+        return entry
+
+    def _write(self, key: str, entry: _CachedResponse) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry._asdict(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Unable to write cached Guppy response: {e}")
+            return
+        self._disk_writes += 1
+        if self._disk_writes % self.DISK_PRUNE_INTERVAL == 0:
+            self._prune()
+
+    def _prune(self) -> None:
+        if not self.max_disk_entries:
+            return
+        paths = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json"):
+                    try:
+                        paths.append((entry.stat().st_mtime, entry.path))
+                    except FileNotFoundError:  # removed by another worker
+                        pass
+        paths.sort()
+        for _, path in paths[: max(0, len(paths) - self.max_disk_entries)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            CACHE_EVICTIONS.labels(cache=f"{self.memory.name}_disk").inc()
 
 
 class GuppyGQLClient:
-    def __init__(self, graphql_url: str, csrf_token_url: str):
+    def __init__(
+        self,
+        graphql_url: str,
+        csrf_token_url: str,
+        http_client: Optional[httpx.AsyncClient] = None,
+        response_cache: Optional["GuppyResponseCache"] = None,
+        download_url: Optional[str] = None,
+    ):
         self.graphql_url = graphql_url
+        # Guppy's `/download` endpoint, next to `/graphql` by default
+        self.download_url = download_url or f"{graphql_url.rsplit('/', 1)[0]}/download"
+        self.response_cache = response_cache
+        # shared, long-lived client (see `make_http_client`)
+        self.http_client = http_client
         self.csrf_cache = CSRFTokenCache(
             rest_api_url=f"{csrf_token_url}/_status",
             token_ttl_seconds=3600,  # 1 hour
+            http_client=http_client,
+        )
+        # protection of Guppy against overload, shared by the requests of the worker
+        self.limiter = AdaptiveLimiter(
+            name="guppy",
+            initial_limit=config.GUPPY_INITIAL_CONCURRENCY,
+            min_limit=config.GUPPY_MIN_CONCURRENCY,
+            max_limit=config.GUPPY_MAX_CONCURRENCY,
+            latency_target=config.GUPPY_LATENCY_TARGET_SECONDS,
         )
+        self.circuit_breaker = CircuitBreaker(
+            name="guppy",
+            failure_threshold=config.GUPPY_CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout=config.GUPPY_CIRCUIT_RESET_SECONDS,
+        )
+        self.retry_budget = RetryBudget(
+            name="guppy", ratio=config.GUPPY_RETRY_BUDGET_RATIO
+        )
+        # key => task of the in-flight request
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        # task of an in-flight request => number of callers waiting for it
+        self._waiters: Counter[asyncio.Task] = Counter()
 
     async def execute(
         self,
@@ -23,57 +268,260 @@ class GuppyGQLClient:
         query: str,
         variables: Dict[str, Any] = None,
         retry_count: int = 1,
+        cacheable: bool = False,
     ) -> Dict[str, Any]:
-        for attempt in range(retry_count + 1):
-            try:
-                csrf_token = await self.csrf_cache.get_token()
-                headers = {
-                    "Content-Type": "application/json",
-                    "X-CSRF-Token": csrf_token,
-                }
-                if access_token:
-                    headers["Authorization"] = f"Bearer {access_token}"
-
-                payload = {"query": query, "variables": variables or {}}
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        self.graphql_url, json=payload, headers=headers
-                    )
-
-                    if response.status_code != 200:
-                        if attempt < retry_count:
-                            continue
-                        raise HTTPException(
-                            status_code=response.status_code,
-                            detail=f"GraphQL request failed: {response.text}",
-                        )
+        """
+        Send a GraphQL query to Guppy.
 
-                    result = response.json()
+        Concurrent calls with the same query, variables and access token share a single
+        request to Guppy ("single flight"): the first call sends it, the others wait
+        for its result. The result is shared between the callers, so it must not be
+        modified.
 
-                    logger.info(f"GuppyGQLClient result: {result}")
+        The request is aborted, and a 504 error raised, once the deadline of the
+        current request (see `gen3analysis.utils.deadline`) has passed. A shared request
+        runs with the deadline of the caller that sent it.
 
-                    # Check for CSRF-related errors
-                    if self._is_csrf_error(result):
-                        if attempt < retry_count:
-                            await self.csrf_cache._refresh_token()  # Force refresh
-                            continue
+        If the client has a `response_cache`, the results of `cacheable` queries are
+        cached (see `GuppyResponseCache`). Only aggregations that can be served a few
+        minutes old should be cacheable: not documents, nor the pages of a listing,
+        whose pages must come from the same snapshot.
+        """
+        check_deadline()
+        key = canonical_hash(query, variables or {}, access_scope(access_token))
+        if self.response_cache is not None and cacheable:
+            return await self.response_cache.get_or_fetch(
+                key,
+                lambda: self._execute_coalesced(
+                    key, access_token, query, variables, retry_count
+                ),
+            )
+        return await self._execute_coalesced(
+            key, access_token, query, variables, retry_count
+        )
+
+    async def _execute_coalesced(
+        self,
+        key: str,
+        access_token: str,
+        query: str,
+        variables: Dict[str, Any],
+        retry_count: int,
+    ) -> Dict[str, Any]:
+        if not config.GUPPY_COALESCE_REQUESTS:
+            return await self._execute(access_token, query, variables, retry_count)
+
+        task = self._in_flight.get(key)
+        if task is None:
+            GUPPY_COALESCED_REQUESTS.labels(result="sent").inc()
+            task = asyncio.ensure_future(
+                self._execute(access_token, query, variables, retry_count)
+            )
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            # the error is raised to the callers; if they were all cancelled, don't
+            # log it as never retrieved
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        else:
+            GUPPY_COALESCED_REQUESTS.labels(result="shared").inc()
+
+        # a caller that is cancelled (e.g. client disconnected) or reaches its deadline
+        # does not cancel the request for the other callers. Once no caller is waiting
+        # for it anymore, the request is cancelled, so that Guppy is not kept busy
+        self._waiters[task] += 1
+        try:
+            async with within_deadline():
+                return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    self._forget(key, task)
+                    task.cancel()
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        # a cancelled request may finish after a new one was sent with the same key
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    async def _execute(
+        self,
+        access_token: str,
+        query: str,
+        variables: Dict[str, Any] = None,
+        retry_count: int = 1,
+    ) -> Dict[str, Any]:
+        payload = {"query": query, "variables": variables or {}}
+        return await self._with_retries(
+            lambda: self._send(access_token, payload), retry_count
+        )
+
+    async def download(
+        self,
+        access_token: str,
+        doc_type: str,
+        fields: List[str],
+        filter: Dict[str, Any],
+        retry_count: int = 1,
+    ) -> List[Dict[str, Any]]:
+        """
+        Return all the `doc_type` documents matching `filter`, with their `fields`
+        (dotted paths for nested fields), from Guppy's `/download` endpoint.
+
+        Guppy walks the results with an Elasticsearch scroll, so unlike `offset`
+        pagination of the GraphQL API, the number of documents is not capped by the
+        index's `max_result_window`. The documents are returned in a single response,
+        which is neither coalesced nor cached.
+        """
+        check_deadline()
+        payload = {
+            "type": doc_type,
+            "fields": fields,
+            "filter": filter,
+            "accessibility": "accessible",
+        }
+        return await self._with_retries(
+            lambda: self._post(self.download_url, access_token, payload), retry_count
+        )
+
+    async def _with_retries(
+        self, send: Callable[[], Awaitable[Any]], retry_count: int
+    ) -> Any:
+        self.retry_budget.deposit()
+        retrying = AsyncRetrying(
+            # full jitter: concurrent retries don't hit Guppy at the same time
+            wait=wait_random_exponential(
+                multiplier=0.1, max=config.GUPPY_RETRY_MAX_WAIT_SECONDS
+            ),
+            # the budget is checked last, so that it is only spent on actual retries
+            stop=stop_after_attempt(retry_count + 1)
+            | _stop_before_deadline
+            | (lambda _: not self.retry_budget.withdraw()),
+            retry=retry_if_exception_type((httpx.TransportError, _RetryableError)),
+            before_sleep=lambda state: logger.error(
+                f"GuppyGQLClient error, retrying: {state.outcome.exception()}"
+            ),
+            reraise=True,
+        )
+        async for attempt in retrying:
+            with attempt:
+                result = await send()
+        return result
+
+    async def _send(self, access_token: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        result = await self._post(self.graphql_url, access_token, payload)
+
+        logger.info(f"GuppyGQLClient result: {result}")
 
-                    if result.get("errors"):
-                        err_msg = f"GuppyGQLClient error: {result['errors']}"
-                        logger.error(err_msg)
-                        raise HTTPException(
-                            status_code=HTTP_500_INTERNAL_SERVER_ERROR,
-                            detail=err_msg,
+        # Check for CSRF-related errors
+        if self._is_csrf_error(result):
+            await self.csrf_cache.refresh(force=True)
+            raise _RetryableError(
+                status_code=HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"GuppyGQLClient error: {result['errors']}",
+            )
+
+        if result.get("errors"):
+            err_msg = f"GuppyGQLClient error: {result['errors']}"
+            logger.error(err_msg)
+            error = GuppyQueryError if self._is_query_error(result) else HTTPException
+            raise error(
+                status_code=HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=err_msg,
+            )
+
+        return result
+
+    async def _post(self, url: str, access_token: str, payload: Dict[str, Any]) -> Any:
+        """
+        Send a request to Guppy, through the circuit breaker and the concurrency
+        limiter, and return its JSON output
+        """
+        csrf_token = await self.csrf_cache.get_token()
+        headers = {
+            "Content-Type": "application/json",
+            "X-CSRF-Token": csrf_token,
+        }
+        if access_token:
+            headers["Authorization"] = f"Bearer {access_token}"
+
+        trial = self.circuit_breaker.check()
+        # None: the request was abandoned (deadline, client disconnected), possibly
+        # before it was sent. It must still be recorded, since it may be the circuit
+        # breaker's trial request
+        failed = None
+        try:
+            async with use_http_client(self.http_client) as client, within_deadline():
+                start = await self.limiter.acquire()
+                overloaded = False
+                try:
+                    try:
+                        response = await client.post(
+                            url,
+                            json=payload,
+                            headers=headers,
+                            timeout=capped_timeout(client.timeout),
                         )
+                    except httpx.TransportError:
+                        overloaded = failed = True
+                        raise
+                    overloaded = response.status_code in RETRYABLE_STATUS_CODES
+                finally:
+                    self.limiter.release(start, overloaded=overloaded)
+            result = response.json() if response.status_code == 200 else None
+            # Elasticsearch failures are usually returned as 500 errors, or as
+            # GraphQL errors in a 200 response
+            failed = response.status_code >= 500 or self._is_server_error(result)
+        finally:
+            self.circuit_breaker.record(failed, trial)
+
+        if response.status_code != 200:
+            error = (
+                _RetryableError
+                if response.status_code in RETRYABLE_STATUS_CODES
+                else HTTPException
+            )
+            # invalid GraphQL queries may be rejected with a 400 error
+            if response.status_code == 400 and self._is_query_error(
+                self._json_or_none(response)
+            ):
+                error = GuppyQueryError
+            raise error(
+                status_code=response.status_code,
+                detail=f"Guppy request failed: {response.text}",
+            )
 
-                    return result
+        return result
 
-            except Exception as e:
-                # log exception
-                logger.error(f"GuppyGQLClient error: {str(e)}")
-                if attempt == retry_count:
-                    raise
-                await asyncio.sleep(0.1 * (2**attempt))  # Exponential backoff
+    def _is_query_error(self, result: Any) -> bool:
+        """Return True if all the errors of a GraphQL response are caused by the query"""
+        errors = result.get("errors") if isinstance(result, dict) else None
+        return bool(errors) and all(
+            isinstance(error, dict)
+            and (error.get("extensions") or {}).get("code") in GRAPHQL_CLIENT_ERRORS
+            for error in errors
+        )
+
+    @staticmethod
+    def _json_or_none(response: httpx.Response) -> Any:
+        try:
+            return response.json()
+        except ValueError:
+            return None
+
+    def _is_server_error(self, result: Any) -> bool:
+        """
+        Return True if a GraphQL response has errors that are not caused by the query
+        itself (invalid query, CSRF token...)
+        """
+        if not isinstance(result, dict) or self._is_csrf_error(result):
+            return False
+        return any(
+            (error.get("extensions") or {}).get("code") not in GRAPHQL_CLIENT_ERRORS
+            for error in result.get("errors") or []
+            if isinstance(error, dict)
+        )
 
     def _is_csrf_error(self, result: Dict[str, Any]) -> bool:
         errors = result.get("errors", [])
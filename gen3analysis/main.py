@@ -7,9 +7,10 @@ from cdislogging import get_logger
 from gen3authz.client.arborist.async_client import ArboristClient
 import fastapi
 from fastapi import FastAPI, APIRouter
+from starlette.datastructures import Headers
 
 from gen3analysis.auth import Gen3SdkAuth
-from gen3analysis.gen3.guppyQuery import GuppyGQLClient
+from gen3analysis.gen3.guppyQuery import GuppyGQLClient, GuppyResponseCache
 from gen3analysis.gdc.graphqlQuery import GDCGQLClient
 from gen3analysis.routes.compare import compare
 
@@ -17,6 +18,15 @@ from gen3analysis.routes.survival import survival
 from gen3analysis import config
 
 from gen3analysis.routes.basic import basic_router
+from gen3analysis.utils.cache import TTLCache
+from gen3analysis.utils.cpu_pool import CPUPool
+from gen3analysis.utils.deadline import (
+    DEADLINE_HEADER,
+    request_deadline,
+    request_timeout,
+)
+from gen3analysis.utils.http_client import make_http_client
+from gen3analysis.utils.metrics import make_metrics_app
 
 route_aggregator = APIRouter()
 
@@ -52,8 +62,22 @@ async def lifespan(app: FastAPI):
         guppy_url = f"{config.HOSTNAME}/guppy"
         revproxy_url = f"{config.HOSTNAME}"
 
+    app.state.http_client = make_http_client()
+    guppy_response_cache = None
+    if config.GUPPY_CACHE_MAX_ENTRIES > 0:
+        guppy_response_cache = GuppyResponseCache(
+            max_entries=config.GUPPY_CACHE_MAX_ENTRIES,
+            ttl_seconds=config.GUPPY_CACHE_TTL_SECONDS,
+            stale_seconds=config.GUPPY_CACHE_STALE_SECONDS,
+            directory=config.GUPPY_CACHE_DIR,
+            max_disk_entries=config.GUPPY_CACHE_DISK_MAX_ENTRIES,
+        )
     guppy_client = GuppyGQLClient(
-        graphql_url=f"{guppy_url}/graphql", csrf_token_url=revproxy_url
+        graphql_url=f"{guppy_url}/graphql",
+        download_url=f"{guppy_url}/download",
+        csrf_token_url=revproxy_url,
+        http_client=app.state.http_client,
+        response_cache=guppy_response_cache,
     )
 
     gdc_graphql_client = GDCGQLClient(
@@ -62,6 +86,23 @@ async def lifespan(app: FastAPI):
 
     app.state.guppy_client = guppy_client
     app.state.gdc_graphql_client = gdc_graphql_client
+    app.state.survival_cache = TTLCache(
+        name="survival_curves",
+        max_entries=config.SURVIVAL_CACHE_MAX_ENTRIES,
+        ttl_seconds=config.SURVIVAL_CACHE_TTL_SECONDS,
+        max_weight=config.SURVIVAL_CACHE_MAX_CASES,
+        weigher=lambda curves: sum(curve.cohort.size for curve in curves) or 1,
+    )
+    app.state.facet_ranges_cache = TTLCache(
+        name="facet_ranges",
+        max_entries=config.FACET_RANGES_CACHE_MAX_ENTRIES,
+        ttl_seconds=config.FACET_RANGES_CACHE_TTL_SECONDS,
+    )
+    app.state.cpu_pool = CPUPool(
+        kind=config.CPU_POOL_KIND,
+        max_workers=config.CPU_POOL_MAX_WORKERS,
+        max_queue=config.CPU_POOL_MAX_QUEUE,
+    )
     app.state.gen3_sdk_auth = None
     if config.DEPLOYMENT_TYPE == "dev":
         app.state.gen3_sdk_auth = Gen3SdkAuth(endpoint=config.HOSTNAME)
@@ -76,8 +117,14 @@ async def lifespan(app: FastAPI):
     yield
 
     # teardown
+    await app.state.http_client.aclose()
+    app.state.http_client = None
     app.state.guppy_client = None
     app.state.gdc_graphql_client = None
+    app.state.survival_cache = None
+    app.state.facet_ranges_cache = None
+    app.state.cpu_pool.shutdown()
+    app.state.cpu_pool = None
     app.state.gen3_sdk_auth = None
     app.state.arborist_client = None
 
@@ -102,44 +149,94 @@ def get_app() -> fastapi.FastAPI:
     )
     fastapi_app.include_router(route_aggregator)
     fastapi_app.add_middleware(ClientDisconnectMiddleware)
+    # outermost, so that the deadline is set before the request is handled in a task
+    fastapi_app.add_middleware(RequestDeadlineMiddleware)
+
+    if config.ENABLE_PROMETHEUS_METRICS:
+        fastapi_app.mount("/metrics", make_metrics_app())
 
     return fastapi_app
 
 
 class ClientDisconnectMiddleware:
+    """
+    Cancel the handling of a request when the client disconnects, so that the requests
+    it sends to other services (e.g. Guppy) are aborted instead of running for nothing.
+
+    The request messages are read by a watcher task and handed over to the app, so that
+    a disconnection is noticed even while the app is not reading.
+    """
+
     def __init__(self, app):
         self._app = app
 
     async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self._app(scope, receive, send)
+            return
+
         loop = asyncio.get_running_loop()
-        rv = loop.create_task(self._app(scope, receive, send))
-        waiter = None
+        messages = asyncio.Queue()
+        response_complete = False
         cancelled = False
-        if scope["type"] == "http":
-
-            def add_close_watcher():
-                nonlocal waiter
-
-                async def wait_closed():
-                    nonlocal cancelled
-                    while True:
-                        message = await receive()
-                        if message["type"] == "http.disconnect":
-                            if not rv.done():
-                                cancelled = True
-                                rv.cancel()
-                            break
 
-                waiter = loop.create_task(wait_closed())
-
-            scope["add_close_watcher"] = add_close_watcher
+        async def receive_message():
+            message = await messages.get()
+            if message["type"] == "http.disconnect":
+                # every later call also returns the disconnection
+                messages.put_nowait(message)
+            return message
+
+        async def send_message(message):
+            nonlocal response_complete
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                response_complete = True
+
+        rv = loop.create_task(self._app(scope, receive_message, send_message))
+
+        async def wait_closed():
+            nonlocal cancelled
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    # servers also report a disconnection once the response is sent
+                    if not rv.done() and not response_complete:
+                        cancelled = True
+                        rv.cancel()
+                    break
+
+        waiter = loop.create_task(wait_closed())
         try:
             await rv
         except asyncio.CancelledError:
             if not cancelled:
                 raise
-        if waiter and not waiter.done():
-            waiter.cancel()
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+
+
+class RequestDeadlineMiddleware:
+    """
+    Set the deadline of each request (see `gen3analysis.utils.deadline`), from the
+    `REQUEST_TIMEOUT_SECONDS` setting and the `X-Request-Timeout` header
+    """
+
+    def __init__(self, app):
+        self._app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self._app(scope, receive, send)
+            return
+
+        header = Headers(scope=scope).get(DEADLINE_HEADER)
+        with request_deadline(request_timeout(header)):
+            await self._app(scope, receive, send)
 
 
 app_instance = get_app()
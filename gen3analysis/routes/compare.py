@@ -1,24 +1,58 @@
 import json
+import math
+import time
 from pydantic import BaseModel
-from typing import Dict, Optional
+from typing import Any, Awaitable, Dict, List, Literal, NamedTuple, Optional, Tuple
 
-from fastapi import APIRouter, Depends, HTTPException, Cookie
+from fastapi import APIRouter, Depends, HTTPException, Cookie, Response
 from starlette.status import HTTP_200_OK, HTTP_500_INTERNAL_SERVER_ERROR
 
+from gen3analysis import config
 from gen3analysis.config import logger
+from gen3analysis.dependencies.cpu_pool import get_cpu_pool
+from gen3analysis.dependencies.facet_ranges_cache import get_facet_ranges_cache
 from gen3analysis.dependencies.guppy_client import get_guppy_client
 from gen3analysis.gen3.guppyQuery import GuppyGQLClient
-
+from gen3analysis.utils.cache import MISSING, TTLCache, access_scope, canonical_hash
+from gen3analysis.utils.core import gather_with_concurrency
+from gen3analysis.utils.cpu_pool import CPUPool, run_in_thread
+from gen3analysis.utils.facet_buckets import (
+    decode_cursor,
+    encode_cursor,
+    paginate_facets,
+)
+from gen3analysis.utils.facet_stats import facet_statistics
 
 compare = APIRouter()
 
 
 class FacetComparisonRequest(BaseModel):
     doc_type: str
-    cohort1: dict
-    cohort2: dict
+    cohort1: Optional[dict] = None
+    cohort2: Optional[dict] = None
+    # alternative to `cohort1` and `cohort2`, to compare any number of cohorts
+    cohorts: Optional[List[dict]] = None
     facets: list
     interval: Dict[str, int] = {}
+    # number of bins of numeric facets binned automatically, with the same bin edges
+    # for all the cohorts (alternative to `interval`)
+    bins: Dict[str, int] = {}
+    # significance tests of the differences between `cohort1` and `cohort2`
+    statistics: bool = False
+    correction: Literal["fdr_bh", "holm", "bonferroni", "none"] = "fdr_bh"
+    # at most `top_k` buckets per facet, the others rolled up into an "other" count
+    top_k: Optional[int] = None
+    # pages of `page_size` buckets per facet, from the `next_cursor` of the last page
+    page_size: Optional[int] = None
+    cursor: Optional[str] = None
+
+
+class HistogramRange(NamedTuple):
+    """Bins `[start, start + step)`, ..., `[end - step, end)`"""
+
+    start: int
+    end: int
+    step: int
 
 
 def facet_name_to_props(facet_name) -> list:
@@ -40,18 +74,46 @@ def facet_name_to_props(facet_name) -> list:
 @compare.post("/facets", status_code=HTTP_200_OK)
 async def compare_facets(
     body: FacetComparisonRequest,
+    response: Response,
     access_token: Optional[str] = Cookie(None),
     gen3_graphql_client: GuppyGQLClient = Depends(get_guppy_client),
+    cpu_pool: Optional[CPUPool] = Depends(get_cpu_pool),
+    bins_cache: Optional[TTLCache] = Depends(get_facet_ranges_cache),
 ) -> dict:
     """
-    Compare facets between two cohorts.
+    Compare facets between two cohorts, or any number of cohorts.
 
     Body:
     - **doc_type**: the cohorts' ES document type
     - **cohort1**: filter corresponding to the first cohort to compare
     - **cohort2**: filter corresponding to the second cohort to compare
+    - **cohorts**: instead of `cohort1` and `cohort2`, list of filters corresponding to
+    the cohorts to compare (at most `COMPARE_MAX_COHORTS`). Each distinct cohort is
+    aggregated once, in queries of `COMPARE_COHORTS_PER_QUERY` cohorts
     - **facets**: fields to compare
     - **interval**: dictionary of intervals for numerical facets. Example: `facets=["numeric_field"]` and `interval={"numeric_field": 10}`
+    - **bins**: dictionary of numbers of bins for numerical facets without `interval`.
+    The range of values of each facet in each cohort is queried first, and all the
+    cohorts get the same bins, covering all their values. Example:
+    `facets=["numeric_field"]` and `bins={"numeric_field": 10}`
+    - **statistics** (default: false): with `cohort1` and `cohort2`, also test the
+    differences between the cohorts: a chi-square test per facet, and a two-proportion
+    z-test per bucket (see `gen3analysis.utils.facet_stats`)
+    - **correction** (default: "fdr_bh"): multiple-testing correction of the p-values:
+    "fdr_bh" (Benjamini-Hochberg), "holm", "bonferroni" or "none"
+    - **top_k**: only return the `top_k` buckets of each facet with the largest total
+    count across the cohorts, in that order, and the total count and number of the
+    other buckets in `other`
+    - **page_size**: only return `page_size` buckets of each facet, in the same order,
+    and the `next_cursor` of the next page (null after the last page)
+    - **cursor**: with `page_size`, the `next_cursor` of the previous page
+
+    `top_k` and `page_size` apply to the facets without `interval` or `bins`; the
+    other facets are returned whole. The cohorts get the same buckets: a bucket is
+    omitted from a cohort's histogram only if the cohort has no such bucket.
+
+    Facets are queried in groups of `COMPARE_FACET_GROUP_SIZE`, concurrently. The
+    duration of each group's query is returned in the `Server-Timing` header.
 
     Returns:
         dict - example:
@@ -64,6 +126,8 @@ async def compare_facets(
                                 {"key": "value1", "count": 99},
                                 {"key": "value2", "count": 45},
                             ],
+                            # with `top_k`
+                            "other": {"count": 12, "buckets": 7},
                         },
                         "numeric_field": {
                             "buckets": [
@@ -76,62 +140,488 @@ async def compare_facets(
                 "cohort2": {
                     "facets": { [...] }
                 },
+                # with `page_size`
+                "next_cursor": "eyJvZmZzZXQiOiAyMH0=",
+                # with `bins`: the bins of each facet, shared by the cohorts
+                "bins": {
+                    "numeric_field": {"start": 20, "end": 50, "step": 10},
+                },
+                # with `statistics`
+                "statistics": {
+                    "correction": "fdr_bh",
+                    "facets": {
+                        "text_field": {
+                            "chi2": 12.1,
+                            "dof": 1,
+                            "p_value": 0.0005,
+                            "adjusted_p_value": 0.001,
+                            "buckets": {
+                                "keys": ["value1", "value2"],
+                                "proportion1": [0.69, 0.31],
+                                "proportion2": [0.45, 0.55],
+                                "z": [3.5, -3.5],
+                                "p_value": [0.0005, 0.0005],
+                                "adjusted_p_value": [0.0005, 0.0005],
+                            },
+                        },
+                        [...]
+                    },
+                },
+            }
+
+        or, with `cohorts`, the facets of each cohort in the same order:
+
+            {
+                "cohorts": [
+                    {"facets": { [...] }},
+                    {"facets": { [...] }},
+                    [...]
+                ]
             }
     """
-    # build the GraphQL query: query a histogram of values for each requested facet
+    invalid_bins = [
+        facet
+        for facet, n_bins in body.bins.items()
+        if facet not in body.facets or facet in body.interval or n_bins < 1
+    ]
+    if invalid_bins:
+        raise HTTPException(
+            status_code=400,
+            detail=f"'bins' must be positive, for facets without 'interval': {invalid_bins}",
+        )
+    if (body.top_k is not None and body.top_k < 1) or (
+        body.page_size is not None and body.page_size < 1
+    ):
+        raise HTTPException(
+            status_code=400, detail="'top_k' and 'page_size' must be positive"
+        )
+    offset = 0
+    if body.cursor is not None:
+        if body.page_size is None:
+            raise HTTPException(status_code=400, detail="'cursor' requires 'page_size'")
+        try:
+            offset = decode_cursor(body.cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    if body.cohorts is None:
+        if body.cohort1 is None or body.cohort2 is None:
+            raise HTTPException(
+                status_code=400,
+                detail="Either 'cohort1' and 'cohort2', or 'cohorts' are required",
+            )
+        cohorts = {"cohort1": body.cohort1, "cohort2": body.cohort2}
+        ranges = await get_shared_ranges(
+            gen3_graphql_client, access_token, body, cohorts, bins_cache
+        )
+        res = await query_cohort_facets(
+            gen3_graphql_client, access_token, body, cohorts, response, ranges
+        )
+        res, statistics, next_cursor = await select_cohort_buckets(
+            cpu_pool, body, res, offset, body.statistics
+        )
+        res = {cohort: {"facets": facets} for cohort, facets in res.items()}
+        if body.statistics:
+            res["statistics"] = {"correction": body.correction, "facets": statistics}
+        if body.page_size is not None:
+            res["next_cursor"] = next_cursor
+        if ranges:
+            res["bins"] = ranges_to_json(ranges)
+        return res
+
+    if body.statistics:
+        raise HTTPException(
+            status_code=400,
+            detail="'statistics' are only available with 'cohort1' and 'cohort2'",
+        )
+
+    if body.cohort1 is not None or body.cohort2 is not None:
+        raise HTTPException(
+            status_code=400,
+            detail="'cohorts' cannot be combined with 'cohort1' and 'cohort2'",
+        )
+    if not body.cohorts or len(body.cohorts) > config.COMPARE_MAX_COHORTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"'cohorts' must contain 1 to {config.COMPARE_MAX_COHORTS} cohorts",
+        )
+
+    # each distinct cohort is aggregated once, however many times it is requested
+    aliases = {}
+    cohorts = {}
+    for cohort in body.cohorts:
+        key = canonical_hash(cohort)
+        if key not in aliases:
+            aliases[key] = f"cohort{len(aliases) + 1}"
+            cohorts[aliases[key]] = cohort
+    ranges = await get_shared_ranges(
+        gen3_graphql_client, access_token, body, cohorts, bins_cache
+    )
+    res = await query_cohort_facets(
+        gen3_graphql_client, access_token, body, cohorts, response, ranges
+    )
+    res, _, next_cursor = await select_cohort_buckets(cpu_pool, body, res, offset)
+    res = {
+        "cohorts": [
+            {"facets": res[aliases[canonical_hash(cohort)]]} for cohort in body.cohorts
+        ]
+    }
+    if body.page_size is not None:
+        res["next_cursor"] = next_cursor
+    if ranges:
+        res["bins"] = ranges_to_json(ranges)
+    return res
+
+
+async def query_cohort_facets(
+    gen3_graphql_client: GuppyGQLClient,
+    access_token: Optional[str],
+    body: FacetComparisonRequest,
+    cohorts: Dict[str, dict],
+    response: Response,
+    ranges: Optional[Dict[str, HistogramRange]] = None,
+) -> Dict[str, dict]:
+    """
+    Query the histograms of `body.facets` for each of the `cohorts` (alias => filter),
+    and return them by cohort alias.
+
+    The facets are split into groups of `COMPARE_FACET_GROUP_SIZE` and the cohorts into
+    chunks of `COMPARE_COHORTS_PER_QUERY`; each (chunk, group) pair is a separate
+    GraphQL request, and the requests are sent concurrently (at most
+    `COMPARE_MAX_CONCURRENT_QUERIES` at a time). If one fails, the others are
+    cancelled. The duration of each request is returned in the `Server-Timing` header.
+    """
+    groups = plan_facet_groups(body.facets, config.COMPARE_FACET_GROUP_SIZE)
+    chunks = plan_cohort_chunks(cohorts, config.COMPARE_COHORTS_PER_QUERY)
+    queries = [
+        (query_name(i, j, len(chunks)), chunk, facets)
+        for j, chunk in enumerate(chunks)
+        for i, facets in enumerate(groups)
+    ]
+
+    async def query_group(chunk: Dict[str, dict], facets: List[str]) -> dict:
+        return await gen3_graphql_client.execute(
+            access_token=access_token,
+            query=build_facets_query(
+                body.doc_type, facets, body.interval, chunk, ranges
+            ),
+            variables=chunk,
+            retry_count=1,
+            cacheable=True,
+        )
+
+    # the requests are independent ES requests: a slow facet only delays its own group.
+    # If one fails, the others are cancelled rather than left running in Guppy
+    results = await gather_with_concurrency(
+        config.COMPARE_MAX_CONCURRENT_QUERIES,
+        *(timed(query_group(chunk, facets)) for _, chunk, facets in queries),
+    )
+    response.headers["Server-Timing"] = server_timing(
+        [(name, facets) for name, _, facets in queries],
+        [duration for _, duration in results],
+    )
+
+    # parse and transform the output, and merge the groups
+    res = {cohort: {} for cohort in cohorts}
+    for (_, chunk, facets), (data, _) in zip(queries, results):
+        for cohort in chunk:
+            res[cohort].update(parse_facets(data, cohort, body.doc_type, facets))
+    # in the requested order
+    return {
+        cohort: {facet: res[cohort][facet] for facet in body.facets}
+        for cohort in cohorts
+    }
+
+
+async def select_cohort_buckets(
+    cpu_pool: Optional[CPUPool],
+    body: FacetComparisonRequest,
+    res: Dict[str, dict],
+    offset: int,
+    statistics: bool = False,
+) -> Tuple[Dict[str, dict], Optional[dict], Optional[str]]:
+    """
+    Select the `body.top_k` buckets and the page of buckets at `offset` of each facet
+    of each cohort (`res`: alias => facet => histogram), and test the differences
+    between the 2 cohorts if `statistics`.
+
+    Returns:
+        the histograms of each cohort, the statistics (or None) and the cursor of the
+        next page (or None)
+    """
+    buckets = [
+        {facet: histograms[facet]["buckets"] for facet in body.facets}
+        for histograms in res.values()
+    ]
+    if body.top_k is None and body.page_size is None:
+        if not statistics:
+            return res, None, None
+        return (
+            res,
+            await run_in_thread(
+                cpu_pool, facet_statistics, body.facets, buckets, body.correction
+            ),
+            None,
+        )
+
+    # the buckets of all the facets and cohorts are ranked and merged at once
+    selected = await run_in_thread(
+        cpu_pool,
+        paginate_facets,
+        body.facets,
+        buckets,
+        [
+            facet not in body.interval and facet not in body.bins
+            for facet in body.facets
+        ],
+        body.top_k,
+        offset,
+        body.page_size,
+        body.correction if statistics else None,
+    )
+    next_cursor = (
+        encode_cursor(offset + body.page_size) if selected["has_more"] else None
+    )
+    return (
+        dict(zip(res, selected["cohorts"])),
+        selected.get("statistics"),
+        next_cursor,
+    )
+
+
+async def timed(coroutine: Awaitable) -> Tuple[Any, float]:
+    """Await `coroutine` and return its result and duration in seconds"""
+    start = time.perf_counter()
+    result = await coroutine
+    return result, time.perf_counter() - start
+
+
+def query_name(group: int, chunk: int, n_chunks: int) -> str:
+    if n_chunks == 1:
+        return f"facets-{group}"
+    return f"facets-{group}-cohorts-{chunk}"
+
+
+def nice_step(width: float) -> int:
+    """Return the smallest 1, 2 or 5 times a power of 10 that is >= `width`, at least 1"""
+    if width <= 1:
+        return 1
+    magnitude = 10 ** math.floor(math.log10(width))
+    for multiple in [1, 2, 5, 10]:
+        if multiple * magnitude >= width:
+            return int(multiple * magnitude)
+
+
+def shared_range(
+    value_ranges: List[Optional[Tuple[float, float]]], n_bins: int
+) -> Optional[HistogramRange]:
+    """
+    Return bins covering all the `(min, max)` value ranges (None for a cohort without
+    values), about `n_bins` of them, with edges at multiples of a round step
+    """
+    value_ranges = [value_range for value_range in value_ranges if value_range]
+    if not value_ranges:
+        return None
+    low = min(low for low, _ in value_ranges)
+    high = max(high for _, high in value_ranges)
+    step = nice_step((high - low) / n_bins)
+    start = math.floor(low / step) * step
+    # the last bin must include `high`
+    end = (math.floor(high / step) + 1) * step
+    return HistogramRange(start, end, step)
+
+
+async def get_shared_ranges(
+    gen3_graphql_client: GuppyGQLClient,
+    access_token: Optional[str],
+    body: FacetComparisonRequest,
+    cohorts: Dict[str, dict],
+    bins_cache: Optional[TTLCache],
+) -> Dict[str, HistogramRange]:
+    """
+    Return the bins of each facet in `body.bins`, shared by all the `cohorts`.
+
+    The range of values of each facet in each cohort (a histogram without `rangeStep`
+    returns a single `[min, max]` bucket) is queried in one request, for the (facet,
+    cohort) pairs that are not in `bins_cache`.
+    """
+    if not body.bins:
+        return {}
+
+    def cache_key(facet: str, cohort: str) -> tuple:
+        return (
+            "facet_range",
+            body.doc_type,
+            facet,
+            canonical_hash(cohorts[cohort]),
+            access_scope(access_token),
+        )
+
+    value_ranges = {}
+    for facet in body.bins:
+        for cohort in cohorts:
+            cached = (
+                MISSING
+                if bins_cache is None
+                else bins_cache.get(cache_key(facet, cohort))
+            )
+            if cached is not MISSING:
+                value_ranges[facet, cohort] = cached
+
+    missing_facets = [
+        facet
+        for facet in body.bins
+        if any((facet, cohort) not in value_ranges for cohort in cohorts)
+    ]
+    if missing_facets:
+        data = await gen3_graphql_client.execute(
+            access_token=access_token,
+            query=build_facets_query(body.doc_type, missing_facets, {}, cohorts),
+            variables=cohorts,
+            retry_count=1,
+            cacheable=True,
+        )
+        for cohort in cohorts:
+            histograms = parse_facets(data, cohort, body.doc_type, missing_facets)
+            for facet, histogram in histograms.items():
+                buckets = [
+                    bucket["key"] for bucket in histogram["buckets"] if bucket["count"]
+                ]
+                if not all(is_value_range(key) for key in buckets):
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"'bins' are only available for numeric facets, not '{facet}'",
+                    )
+                value_range = (
+                    (min(key[0] for key in buckets), max(key[1] for key in buckets))
+                    if buckets
+                    else None
+                )
+                value_ranges[facet, cohort] = value_range
+                if bins_cache is not None:
+                    bins_cache.set(cache_key(facet, cohort), value_range)
+
+    ranges = {}
+    for facet, n_bins in body.bins.items():
+        facet_range = shared_range(
+            [value_ranges[facet, cohort] for cohort in cohorts], n_bins
+        )
+        # without values, the facet is queried without bins
+        if facet_range is not None:
+            ranges[facet] = facet_range
+    return ranges
+
+
+def is_value_range(key: Any) -> bool:
+    """Return True if a histogram bucket `key` is a `[min, max]` pair of numbers"""
+    return (
+        isinstance(key, list)
+        and len(key) == 2
+        and all(
+            isinstance(value, (int, float)) and not isinstance(value, bool)
+            for value in key
+        )
+    )
+
+
+def ranges_to_json(ranges: Dict[str, HistogramRange]) -> Dict[str, dict]:
+    return {facet: facet_range._asdict() for facet, facet_range in ranges.items()}
+
+
+def plan_cohort_chunks(
+    cohorts: Dict[str, dict], chunk_size: int
+) -> List[Dict[str, dict]]:
+    """
+    Split `cohorts` into chunks of at most `chunk_size` cohorts, each queried with a
+    separate GraphQL request. A `chunk_size` of 0 puts all the cohorts in one chunk.
+    """
+    items = list(cohorts.items())
+    if chunk_size <= 0 or len(items) <= chunk_size:
+        return [cohorts]
+    return [dict(items[i : i + chunk_size]) for i in range(0, len(items), chunk_size)]
+
+
+def plan_facet_groups(facets: List[str], group_size: int) -> List[List[str]]:
+    """
+    Split `facets` into groups of at most `group_size` facets, each queried with a
+    separate GraphQL request. A `group_size` of 0 puts all the facets in one group.
+    """
+    if group_size <= 0 or len(facets) <= group_size:
+        return [facets]
+    return [facets[i : i + group_size] for i in range(0, len(facets), group_size)]
+
+
+def build_facets_query(
+    doc_type: str,
+    facets: List[str],
+    interval: Dict[str, int],
+    cohorts: Dict,
+    ranges: Optional[Dict[str, HistogramRange]] = None,
+) -> str:
+    """
+    Build the GraphQL query of a histogram of values for each facet, for each cohort.
+    Each cohort is an aliased `_aggregation` filtered by the variable of the same name.
+    Numeric facets are binned with the `interval` step, or with the `ranges` bins.
+    """
+    ranges = ranges or {}
     facets_query = ""
-    for facet in body.facets:
+    for facet in facets:
         props = facet_name_to_props(facet)
 
         # query the fields
         facets_query += " ".join(f"{prop} {{" for prop in props) + " "
 
         # for numeric fields, add `rangeStep` parameter as specified in `interval` input
-        params = (
-            f"(rangeStep: {body.interval[facet]})" if facet in body.interval else ""
-        )
+        params = f"(rangeStep: {interval[facet]})" if facet in interval else ""
+        if facet in ranges:
+            start, end, step = ranges[facet]
+            params = f"(rangeStart: {start}, rangeEnd: {end}, rangeStep: {step})"
 
         # query the histogram for this field
         facets_query += f"histogram{params} {{ key count }} "
 
         facets_query += " ".join("}" for _ in props) + " "
 
-    # apply this query to each of the 2 cohorts
-    query = f"""query ($cohort1: JSON, $cohort2: JSON){{
-        cohort1: _aggregation {{
-            {body.doc_type} (filter: $cohort1, accessibility: accessible) {{ {facets_query} }}
-        }}
-        cohort2: _aggregation {{
-            {body.doc_type} (filter: $cohort2, accessibility: accessible) {{ {facets_query} }}
-        }}
-    }}"""
-
-    data = await gen3_graphql_client.execute(
-        access_token=access_token,
-        query=query,
-        variables={"cohort1": body.cohort1, "cohort2": body.cohort2},
-        retry_count=1,
+    # apply this query to each of the cohorts
+    variables = ", ".join(f"${cohort}: JSON" for cohort in cohorts)
+    aggregations = "".join(
+        f"""
+        {cohort}: _aggregation {{
+            {doc_type} (filter: ${cohort}, accessibility: accessible) {{ {facets_query} }}
+        }}"""
+        for cohort in cohorts
     )
+    return f"query ({variables}){{{aggregations}\n    }}"
 
-    # parse and transform the output
+
+def parse_facets(data: dict, cohort: str, doc_type: str, facets: List[str]) -> dict:
+    """Return the histogram buckets of each facet of `cohort` in the GraphQL output"""
     try:
         res = {}
-        for cohort in ["cohort1", "cohort2"]:
-            res[cohort] = {"facets": {}}
-            for facet in body.facets:
-                _data = data["data"][cohort][body.doc_type]
-                props = facet_name_to_props(facet)
-                for prop in props:
-                    _data = _data[prop]
-                res[cohort]["facets"][facet] = {"buckets": _data["histogram"]}
+        for facet in facets:
+            _data = data["data"][cohort][doc_type]
+            props = facet_name_to_props(facet)
+            for prop in props:
+                _data = _data[prop]
+            res[facet] = {"buckets": _data["histogram"]}
     except KeyError as e:
         err_msg = f"Unable to parse GraphQL output: KeyError {e}"
         logger.error(f"{err_msg}. Output: {json.dumps(data)}")
         raise HTTPException(HTTP_500_INTERNAL_SERVER_ERROR, err_msg)
-
     return res
 
 
+def server_timing(queries: List[Tuple[str, List[str]]], durations: List[float]) -> str:
+    """
+    Return a `Server-Timing` header value with the duration of each (name, facets)
+    query, e.g. `facets-0;dur=120.5;desc="project_id demographic.ethnicity"`
+    """
+    return ", ".join(
+        f'{name};dur={duration * 1000:.1f};desc="{' '.join(facets)}"'
+        for (name, facets), duration in zip(queries, durations)
+    )
+
+
 class IntersectionRequest(BaseModel):
     doc_type: str
     cohort1: dict
@@ -195,6 +685,7 @@ async def get_cohort_intersection(
             "intersection": {"AND": [body.cohort1, body.cohort2]},
         },
         retry_count=1,
+        cacheable=True,
     )
 
     # parse and transform the output
@@ -1,240 +1,685 @@
-from typing import Annotated, List, Dict, Optional
-import pandas as pd
+import json
+from typing import (
+    Annotated,
+    Awaitable,
+    Callable,
+    Iterator,
+    List,
+    Literal,
+    Dict,
+    Optional,
+    Tuple,
+)
 from fastapi import Cookie, FastAPI
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
 from glom import glom
-from lifelines import KaplanMeierFitter
-from lifelines.statistics import multivariate_logrank_test
-from pydantic import BaseModel
+import numpy as np
+from pydantic import BaseModel, Field
 from starlette import status
-from starlette.responses import JSONResponse
+from starlette.responses import Response, StreamingResponse
 
 from gen3analysis.auth import Auth
+from gen3analysis.dependencies.cpu_pool import get_cpu_pool
 from gen3analysis.dependencies.guppy_client import get_guppy_client
-from gen3analysis.gen3.guppyQuery import GuppyGQLClient
-from gen3analysis.routes import cases
+from gen3analysis.dependencies.survival_cache import get_survival_cache
+from gen3analysis.gen3.guppyQuery import GuppyGQLClient, GuppyQueryError
+from gen3analysis.routes.compare import facet_name_to_props
+from gen3analysis import config
 from gen3analysis.config import logger
+from gen3analysis.utils.cache import MISSING, TTLCache, access_scope, canonical_hash
+from gen3analysis.utils.core import gather_with_concurrency
+from gen3analysis.utils.cpu_pool import CPUPool, run_cpu_bound, run_in_thread
+from gen3analysis.utils.id_sets import IdDictionary, IdSet
+from gen3analysis.utils.survival import (
+    KaplanMeierEstimate,
+    SurvivalAccumulator,
+    SurvivalCohort,
+    SurvivalCurve,
+    compare_survival,
+    fit_kaplan_meier,
+    survival_table_from_histograms,
+)
 
 MAX_CASES = 10000
 
 survival = APIRouter()
 
-Gen3GraphQLQuery = f"""query ($filter: JSON) {{
-    case(accessibility: accessible, offset: 0, first: {MAX_CASES}, filter: $filter) {{
+SURVIVAL_CASE_FIELDS = """
         submitter_id
         _case_id
         project_id
-        demographic {{
+        demographic {
             days_to_death
             vital_status
-        }}
-        diagnoses {{
+        }
+        diagnoses {
             days_to_last_follow_up
-        }}
+        }"""
+
+
+def build_survival_queries(extra_fields: Optional[List[str]] = None) -> Tuple[str, str]:
+    """
+    Build the GraphQL queries of the first page of a cohort, which also returns the
+    size of the cohort, and of the following pages.
+
+    Args:
+        extra_fields (list): optional (nested) fields to also return for each case, e.g.
+            "demographic.gender"
+    """
+    case_fields = SURVIVAL_CASE_FIELDS
+    for extra_field in extra_fields or []:
+        props = facet_name_to_props(extra_field)
+        # e.g. "demographic { gender }"; GraphQL merges it with the fields above
+        selection = [f"{prop} {{" for prop in props[:-1]] + [props[-1]]
+        selection += ["}" for _ in props[:-1]]
+        case_fields += "\n        " + " ".join(selection)
+
+    page_query = f"""query ($filter: JSON, $first: Int, $offset: Int, $sort: JSON) {{
+    case(accessibility: accessible, offset: $offset, first: $first, filter: $filter, sort: $sort) {{{case_fields}
     }}
-    _aggregation {{
-        case(filter: $filter, accessibility: accessible) {{
+"""
+    first_page_query = (
+        page_query
+        + """    _aggregation {
+        case(filter: $filter, accessibility: accessible) {
             _totalCount
-        }}
-    }}
-}}
+        }
+    }
 """
+    )
+    return first_page_query + "}\n", page_query + "}\n"
+
+
+Gen3GraphQLQuery, Gen3GraphQLPageQuery = build_survival_queries()
+
+HAS_DAYS_TO_DEATH = {"nested": {">": {"days_to_death": 0}, "path": "demographic"}}
+HAS_DAYS_TO_LAST_FOLLOW_UP = {
+    "nested": {">": {"days_to_last_follow_up": 0}, "path": "diagnoses"}
+}
+IS_ALIVE = {
+    "nested": {"in": {"vital_status": ["Alive", "alive"]}, "path": "demographic"}
+}
+
+# cases are paginated in a stable order, so that no case is skipped or repeated
+PAGINATION_SORT_FIELD = "_case_id"
+
+# `SURVIVAL_CASE_FIELDS`, as the field paths of Guppy's `/download` endpoint
+SURVIVAL_CASE_FIELD_PATHS = [
+    "submitter_id",
+    "_case_id",
+    "project_id",
+    "demographic.days_to_death",
+    "demographic.vital_status",
+    "diagnoses.days_to_last_follow_up",
+]
+
+
+async def fetch_cohort_pages(
+    query_filter: Dict,
+    gen3_graphql_client: GuppyGQLClient,
+    accumulator: SurvivalAccumulator,
+    access_token: Optional[str] = None,
+    extra_fields: Optional[List[str]] = None,
+) -> int:
+    """
+    Walk all the cases matching `query_filter` and feed them to `accumulator`, one page
+    at a time.
 
+    The first page, of `SURVIVAL_PAGE_SIZE` cases in `_case_id` order, is queried along
+    with the size of the cohort. If the cohort is larger:
+    - in "offset" mode, the following pages are selected with `offset`, which ES caps
+    at its `max_result_window` setting: pages beyond it fail.
+    - in "download" mode, the whole cohort is fetched from Guppy's `/download`
+    endpoint, which walks it with an ES scroll and has no depth limit. The cohort
+    arrives in a single response, which is fed to `accumulator` in pages.
 
-def transform(data) -> pd.DataFrame:
-    """Transform the Gen3 data into a pandas DataFrame suitable for lifelines."""
-    records = []
-
-    for case in data:
-        demographic = case.get("demographic", [])
-        if not demographic:
-            continue
-
-        demo = demographic[0]
-        days_to_death = demo.get("days_to_death")
-        diagnoses = case.get("diagnoses", [{}])[0]
-        days_to_follow_up = diagnoses.get("days_to_last_follow_up")
-
-        # Use days_to_death if available, otherwise use days_to_follow_up
-        duration = days_to_death if days_to_death is not None else days_to_follow_up
-
-        if duration is not None:
-            records.append(
-                {
-                    "duration": duration,
-                    "event": int(
-                        demo.get("vital_status", "").lower() != "alive"
-                    ),  # 1 if dead, 0 if alive
-                    "case_id": case.get("_case_id"),
-                    "submitter_id": case.get("submitter_id"),
-                    "project_id": case.get("project_id"),
-                }
-            )
-
-    return pd.DataFrame(records)
+    Args:
+        query_filter (dict): Guppy filter for the cohort
+        gen3_graphql_client (GuppyGQLClient): client used to query Guppy
+        accumulator (SurvivalAccumulator): receives the cases of each page
+        access_token (str): optional access token forwarded to Guppy
+        extra_fields (list): optional fields to also fetch for each case
 
+    Returns:
+        int: the total number of cases in the cohort, as reported by Guppy
+    """
+    first_page_query, page_query = (
+        build_survival_queries(extra_fields)
+        if extra_fields
+        else (Gen3GraphQLQuery, Gen3GraphQLPageQuery)
+    )
+    page_size = config.SURVIVAL_PAGE_SIZE
+    total_count, fetched = None, 0
+
+    while True:
+        data = await gen3_graphql_client.execute(
+            access_token=access_token,
+            query=first_page_query if total_count is None else page_query,
+            variables={
+                "filter": query_filter,
+                "first": page_size,
+                "offset": fetched,
+                "sort": [{PAGINATION_SORT_FIELD: "asc"}],
+            },
+            retry_count=1,
+        )
+        page = glom(data, "data.case", default=None) or []
+        if total_count is None:
+            total_count = glom(data, "data._aggregation.case._totalCount", default=0)
+            if total_count == 0:
+                return 0
+            if (
+                config.SURVIVAL_PAGINATION_MODE == "download"
+                and len(page) == page_size
+                and total_count > page_size
+            ):
+                del data, page
+                cases = await gen3_graphql_client.download(
+                    access_token=access_token,
+                    doc_type="case",
+                    fields=SURVIVAL_CASE_FIELD_PATHS + (extra_fields or []),
+                    filter=query_filter,
+                    retry_count=1,
+                )
+                for start in range(0, len(cases), page_size):
+                    accumulator.add_page(cases[start : start + page_size])
+                return total_count
+
+        accumulator.add_page(page)
+        fetched += len(page)
+        if len(page) < page_size or fetched >= total_count:
+            return total_count
+
+
+def fit_cohorts(
+    durations: List[np.ndarray], events: List[np.ndarray]
+) -> List[KaplanMeierEstimate]:
+    """Fit a Kaplan-Meier curve per cohort, in a single `CPUPool` task"""
+    return [
+        fit_kaplan_meier(cohort_durations, cohort_events)
+        for cohort_durations, cohort_events in zip(durations, events)
+    ]
+
+
+async def fetch_cohort(
+    filters,
+    gen3_graphql_client,
+    access_token=None,
+    stratify_by: Optional[str] = None,
+    key_field: Optional[str] = None,
+) -> Optional[SurvivalCohort]:
+    """
+    Fetch the survival data of the cases matching `filters`, along with the values of
+    the optional `stratify_by` and `key_field` fields.
 
-async def get_curve(filters, gen3_graphql_client, access_token=None):
+    Returns:
+        the cohort, or None if no case has survival data
+    """
     query_filter = {
-        "and": [
-            filters,
-            {
-                "or": [
-                    {
-                        "nested": {
-                            ">": {"days_to_death": 0},
-                            "path": "demographic",
-                        }
-                    },
-                    {
-                        "nested": {
-                            ">": {"days_to_last_follow_up": 0},
-                            "path": "diagnoses",
-                        }
-                    },
-                ]
-            },
-        ]
+        "and": [filters, {"or": [HAS_DAYS_TO_DEATH, HAS_DAYS_TO_LAST_FOLLOW_UP]}]
     }
-    data = await gen3_graphql_client.execute(
-        access_token=access_token,
-        query=Gen3GraphQLQuery,
-        variables={"filter": query_filter},
-        retry_count=1,
+    accumulator = SurvivalAccumulator(
+        strata_props=facet_name_to_props(stratify_by) if stratify_by else None,
+        key_props=facet_name_to_props(key_field) if key_field else None,
     )
-
-    if glom(data, "data._aggregation.case._totalCount", default=0) == 0:
+    try:
+        total_count = await fetch_cohort_pages(
+            query_filter,
+            gen3_graphql_client,
+            accumulator,
+            access_token=access_token,
+            extra_fields=[field for field in (stratify_by, key_field) if field],
+        )
+    except GuppyQueryError as e:
+        if not (stratify_by or key_field):
+            raise
+        # GraphQL queries fail if `stratify_by` is an object field, or doesn't exist
+        raise HTTPException(status_code=400, detail=e.detail)
+    except ValueError as e:
+        # e.g. `stratify_by` is an object field
+        raise HTTPException(status_code=400, detail=str(e))
+    if total_count == 0:
         return None
-    data_root = glom(data, "data.case", default={})
-    df = transform(data_root)
-    if df.empty:
+    cohort = accumulator.finalize()
+    if cohort.size == 0:
         return None
+    return cohort
+
+
+async def fit_curves(
+    cohorts: List[SurvivalCohort],
+    cpu_pool: Optional[CPUPool] = None,
+    metas: Optional[List[Dict]] = None,
+) -> List[SurvivalCurve]:
+    """Fit the curve of each cohort, in a single `CPUPool` task"""
+    estimates = await run_cpu_bound(
+        cpu_pool,
+        fit_cohorts,
+        [cohort.durations for cohort in cohorts],
+        [cohort.events for cohort in cohorts],
+    )
+    return [
+        SurvivalCurve(cohort=cohort, estimate=estimate, meta=meta)
+        for cohort, estimate, meta in zip(
+            cohorts, estimates, metas or [{} for _ in cohorts]
+        )
+    ]
 
-    # Ensure duration and event columns are numeric
-    df["duration"] = pd.to_numeric(df["duration"], errors="coerce")
-    df["event"] = pd.to_numeric(df["event"], errors="coerce").astype(int)
 
-    # Remove rows with NaN values
-    df = df.dropna(subset=["duration", "event"])
+async def get_curves(
+    filters,
+    gen3_graphql_client,
+    access_token=None,
+    cpu_pool: Optional[CPUPool] = None,
+    stratify_by: Optional[str] = None,
+) -> List[SurvivalCurve]:
+    """
+    Fetch the cohort matching `filters` and fit its survival curve. With `stratify_by`,
+    the cohort is still fetched once, then split by the value of that field and a curve
+    is fitted per stratum.
 
-    if df.empty:
-        return None
+    Returns:
+        list of curves, empty if the cohort has no cases with survival data
+    """
+    cohort = await fetch_cohort(
+        filters, gen3_graphql_client, access_token=access_token, stratify_by=stratify_by
+    )
+    if cohort is None:
+        return []
+
+    if stratify_by:
+        strata = cohort.stratify()
+        if len(strata) > config.SURVIVAL_MAX_STRATA:
+            raise HTTPException(
+                status_code=400,
+                detail=f"'{stratify_by}' has {len(strata)} distinct values, the maximum number of strata is {config.SURVIVAL_MAX_STRATA}",
+            )
+        return await fit_curves(
+            [stratum_cohort for _, stratum_cohort in strata],
+            cpu_pool=cpu_pool,
+            metas=[{"stratum": stratum} for stratum, _ in strata],
+        )
+    return await fit_curves([cohort], cpu_pool=cpu_pool)
+
+
+# alias => (filters on top of the cohort's filter, histogram field)
+SURVIVAL_HISTOGRAMS = {
+    "death": ([HAS_DAYS_TO_DEATH], "demographic.days_to_death"),
+    "death_alive": ([HAS_DAYS_TO_DEATH, IS_ALIVE], "demographic.days_to_death"),
+    "follow_up": ([HAS_DAYS_TO_LAST_FOLLOW_UP], "diagnoses.days_to_last_follow_up"),
+    "follow_up_alive": (
+        [HAS_DAYS_TO_LAST_FOLLOW_UP, IS_ALIVE],
+        "diagnoses.days_to_last_follow_up",
+    ),
+    "follow_up_death": (
+        [HAS_DAYS_TO_LAST_FOLLOW_UP, HAS_DAYS_TO_DEATH],
+        "diagnoses.days_to_last_follow_up",
+    ),
+    "follow_up_death_alive": (
+        [HAS_DAYS_TO_LAST_FOLLOW_UP, HAS_DAYS_TO_DEATH, IS_ALIVE],
+        "diagnoses.days_to_last_follow_up",
+    ),
+}
+
+
+def build_survival_histogram_query(range_step: int) -> str:
+    """Build the GraphQL query of the `SURVIVAL_HISTOGRAMS`, one alias each"""
+    variables = ", ".join(f"${alias}: JSON" for alias in SURVIVAL_HISTOGRAMS)
+    aggregations = ""
+    for alias, (_, field) in SURVIVAL_HISTOGRAMS.items():
+        props = facet_name_to_props(field)
+        histogram = (
+            " ".join(f"{prop} {{" for prop in props)
+            + f" histogram(rangeStep: {range_step}) {{ key count }} "
+            + " ".join("}" for _ in props)
+        )
+        aggregations += f"""
+    {alias}: _aggregation {{
+        case(filter: ${alias}, accessibility: accessible) {{ _totalCount {histogram} }}
+    }}"""
+    return f"query ({variables}) {{{aggregations}\n}}\n"
+
+
+async def get_aggregated_curves(
+    filters,
+    gen3_graphql_client,
+    access_token=None,
+    cpu_pool: Optional[CPUPool] = None,
+) -> List[SurvivalCurve]:
+    """
+    Fit the survival curve of the cohort matching `filters` from histograms of its
+    durations, without fetching the cases: the cost doesn't depend on the size of the
+    cohort. See `survival_table_from_histograms`.
 
-    # Create KaplanMeierFitter object
-    kmf = KaplanMeierFitter()
-
-    # return these for use in the statistics calculation
-    durations = df["duration"]
-    events = df["event"]
-    kmf.fit(durations=durations, event_observed=events, label="Survival Curve")
-
-    # Group donors by their exact duration time
-    donors_by_time = (
-        df.groupby("duration")
-        .apply(
-            lambda group: [
-                {
-                    "id": row["case_id"],
-                    "submitter_id": row["submitter_id"],
-                    "project_id": row["project_id"],
-                    "event_type": "death" if row["event"] == 1 else "censored",
-                }
-                for _, row in group.iterrows()
-            ]
+    The histograms of nested fields count every demographic and diagnosis, while the
+    cases' survival data use the first ones only. The curve is only exact if each case
+    has a single `days_to_death` and `days_to_last_follow_up` value: the histograms'
+    counts are checked against the number of cases, and a 422 error is raised if some
+    cases of the cohort have several values.
+
+    Returns:
+        list of curves, empty if the cohort has no cases with survival data
+    """
+    data = await gen3_graphql_client.execute(
+        access_token=access_token,
+        query=build_survival_histogram_query(config.SURVIVAL_HISTOGRAM_RANGE_STEP),
+        variables={
+            alias: {"and": [filters, *alias_filters]}
+            for alias, (alias_filters, _) in SURVIVAL_HISTOGRAMS.items()
+        },
+        retry_count=1,
+    )
+    histograms = {
+        alias: glom(data, f"data.{alias}.case.{field}.histogram", default=[])
+        for alias, (_, field) in SURVIVAL_HISTOGRAMS.items()
+    }
+    try:
+        if any(
+            sum(bucket["count"] for bucket in histogram)
+            != glom(data, f"data.{alias}.case._totalCount", default=0)
+            for alias, histogram in histograms.items()
+        ):
+            raise ValueError("Some cases have several survival values")
+        durations, events, counts = survival_table_from_histograms(**histograms)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=422,
+            detail=f'source "aggregation" requires a single survival value per case ({e}), use source "cases"',
         )
-        .to_dict()
+    if not len(durations):
+        return []
+
+    cohort = SurvivalCohort.from_counts(durations, events, counts)
+    estimate = await run_cpu_bound(
+        cpu_pool, fit_kaplan_meier, cohort.durations, cohort.events, cohort.counts
+    )
+    return [SurvivalCurve(cohort=cohort, estimate=estimate)]
+
+
+async def get_cached_curves(
+    filters,
+    gen3_graphql_client,
+    survival_cache: Optional[TTLCache],
+    access_token=None,
+    cache_control: Optional[str] = None,
+    cpu_pool: Optional[CPUPool] = None,
+    stratify_by: Optional[str] = None,
+    source: str = "cases",
+) -> List[SurvivalCurve]:
+    """
+    `get_curves`, or `get_aggregated_curves` if `source` is "aggregation", behind the
+    survival curve cache.
+
+    Curves are cached per filter, stratification field and access token, so that a
+    caller never gets a curve computed with someone else's permissions.
+    """
+
+    async def fetch_curves():
+        if source == "aggregation":
+            return await get_aggregated_curves(
+                filters,
+                gen3_graphql_client,
+                access_token=access_token,
+                cpu_pool=cpu_pool,
+            )
+        return await get_curves(
+            filters,
+            gen3_graphql_client,
+            access_token=access_token,
+            cpu_pool=cpu_pool,
+            stratify_by=stratify_by,
+        )
+
+    return await with_survival_cache(
+        survival_cache,
+        cache_control,
+        ("survival_curves", filters, stratify_by, source, access_scope(access_token)),
+        fetch_curves,
     )
 
-    # Format results
-    results = []
-    survival_df = kmf.survival_function_
-
-    # Create a sorted list of time points
-    timeline_sorted = sorted(kmf.timeline)
-
-    for i, time_point in enumerate(timeline_sorted):
-        survival_prob = survival_df.loc[time_point].iloc[0]
-
-        # Only include donors who have events at this exact time point
-        if time_point in donors_by_time:
-            for donor in donors_by_time[time_point]:
-                # For donors with events at this time point, use the survival probability
-                # from BEFORE the event (i.e., the previous time point or current if censored)
-
-                if donor["event_type"] == "death":
-                    # For death events, use survival probability from the previous time point
-                    if i > 0:
-                        prev_time_point = timeline_sorted[i - 1]
-                        donor_survival_prob = survival_df.loc[prev_time_point].iloc[0]
-                    else:
-                        # If this is the first time point, use 1.0
-                        donor_survival_prob = 1.0
-                else:
-                    # For censored events, use the current survival probability
-                    donor_survival_prob = survival_prob
-
-                results.append(
-                    {
-                        "time": int(time_point),
-                        "id": donor["id"],
-                        "submitter_id": donor["submitter_id"],
-                        "project_id": donor["project_id"],
-                        "survivalEstimate": float(donor_survival_prob),
-                        "censored": (
-                            True if donor["event_type"] == "censored" else False
-                        ),
-                    }
-                )
 
-    return {
-        "meta": {"id": id(results)},
-        "donors": results,
-        "durations": durations,
-        "events": events,
+async def with_survival_cache(
+    survival_cache: Optional[TTLCache],
+    cache_control: Optional[str],
+    key_parts: Tuple,
+    fetch: Callable[[], Awaitable[List[SurvivalCurve]]],
+) -> List[SurvivalCurve]:
+    """
+    Return the curves cached for `key_parts`, or fetch and cache them. A
+    `Cache-Control: no-cache` request header skips the cache lookup (the fresh curves
+    are still cached), and `Cache-Control: no-store` skips the cache entirely.
+    """
+    directives = {
+        directive.strip().lower() for directive in (cache_control or "").split(",")
     }
+    if survival_cache is None or "no-store" in directives:
+        return await fetch()
+
+    key = canonical_hash(*key_parts)
+    if "no-cache" not in directives:
+        curves = survival_cache.get(key)
+        if curves is not MISSING:
+            return curves
+
+    curves = await fetch()
+    survival_cache.set(key, curves)
+    return curves
+
 
+class LogRankWeights(BaseModel):
+    """Fleming-Harrington weights S(t-)^p * (1 - S(t-))^q of the log-rank test"""
 
-def calculate_survival_statistics(non_empty_curves: List[Dict]) -> Dict:
+    p: float = Field(default=0, ge=0)
+    q: float = Field(default=0, ge=0)
+
+
+def calculate_survival_statistics(
+    durations: List[np.ndarray],
+    events: List[np.ndarray],
+    weights: Optional[LogRankWeights] = None,
+    counts: Optional[List[Optional[np.ndarray]]] = None,
+) -> Dict:
     """
     Calculate survival statistics for multiple curves using a log-rank test.
 
     Args:
-        non_empty_curves: List of curve dictionaries containing durations, events, and donors
+        durations: durations of the cases of each curve
+        events: events of the cases of each curve, aligned with `durations`
+        weights: optional Fleming-Harrington weights of the log-rank test
+        counts: optional number of cases each observation of each curve stands for
+            (None for curves where each observation is a case)
 
     Returns:
-        Dictionary containing pValue and degreesFreedom, or empty dict if < 2 curves
+        Dictionary containing pValue and degreesFreedom, or empty dict if < 2 curves.
+        With more than 2 curves, also contains the pValue of each pair of curves.
     """
     statistics = {}
-    if len(non_empty_curves) > 1:
-        all_durations = []
-        all_events = []
-        for curve in non_empty_curves:
-            all_durations.extend(curve["durations"])
-            all_events.extend(curve["events"])
-
-        groups = []
-        for curve_index in range(len(non_empty_curves)):
-            groups.extend([curve_index] * len(non_empty_curves[curve_index]["donors"]))
-
-        log_rank_results = multivariate_logrank_test(all_durations, groups, all_events)
+    n_curves = len(durations)
+    if n_curves > 1:
+        groups = np.repeat(
+            np.arange(n_curves), [len(curve_durations) for curve_durations in durations]
+        )
+        if counts is not None and any(c is not None for c in counts):
+            counts = np.concatenate(
+                [
+                    (
+                        np.ones(len(curve_durations))
+                        if curve_counts is None
+                        else curve_counts
+                    )
+                    for curve_durations, curve_counts in zip(durations, counts)
+                ]
+            )
+        else:
+            counts = None
+        durations = np.concatenate(durations)
+        events = np.concatenate(events)
+
+        log_rank_results = compare_survival(
+            durations,
+            events,
+            groups,
+            n_groups=n_curves,
+            p=weights.p if weights else 0,
+            q=weights.q if weights else 0,
+            counts=counts,
+        )
         statistics = {
             "pValue": log_rank_results.p_value,
-            "degreesFreedom": len(non_empty_curves) - 1,
+            "degreesFreedom": log_rank_results.degrees_of_freedom,
         }
+        if n_curves > 2:
+            statistics["pairwise"] = [
+                {"curves": [curve_a, curve_b], "pValue": p_value}
+                for curve_a, curve_b, p_value in log_rank_results.pairwise
+            ]
 
     return statistics
 
 
+def render_survival_results(
+    curves: List[SurvivalCurve],
+    statistics: Dict,
+    output: str = "donors",
+    confidence_level: Optional[float] = None,
+) -> bytes:
+    """
+    Build and encode the JSON survival results. This is the most expensive step for
+    large cohorts, so it returns bytes that can be computed outside the event loop.
+    """
+    if output == "curve":
+        results = [
+            {
+                "meta": {"id": id(curve), **curve.meta},
+                "steps": curve.steps(confidence_level=confidence_level),
+            }
+            for curve in curves
+        ]
+    else:
+        results = [
+            {"meta": {"id": id(curve), **curve.meta}, "donors": curve.donors()}
+            for curve in curves
+        ]
+
+    # same encoding as `JSONResponse`
+    return json.dumps(
+        {"results": results, "overallStats": statistics},
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def stream_survival_results(
+    curves: List[SurvivalCurve], statistics: Dict
+) -> Iterator[bytes]:
+    """
+    Encode the survival results as newline-delimited JSON, one chunk at a time.
+
+    The first line holds the metadata of all the curves and the overall statistics:
+
+        {"results": [{"meta": {...}, "donorCount": 123}, ...], "overallStats": {...}}
+
+    Each following line holds a chunk of the donors of one curve, curve after curve:
+
+        {"result": 0, "donors": [...]}
+    """
+    yield (
+        json.dumps(
+            {
+                "results": [
+                    {
+                        "meta": {"id": id(curve), **curve.meta},
+                        "donorCount": curve.cohort.size,
+                    }
+                    for curve in curves
+                ],
+                "overallStats": statistics,
+            },
+            allow_nan=False,
+        ).encode()
+        + b"\n"
+    )
+    for index, curve in enumerate(curves):
+        for donors in curve.iter_donor_chunks(config.SURVIVAL_STREAM_CHUNK_SIZE):
+            yield (
+                json.dumps(
+                    {"result": index, "donors": donors}, allow_nan=False
+                ).encode()
+                + b"\n"
+            )
+
+
+async def build_survival_response(
+    curves: List[SurvivalCurve],
+    output: str = "donors",
+    confidence_level: Optional[float] = None,
+    logrank_weights: Optional[LogRankWeights] = None,
+    accept: Optional[str] = None,
+    cpu_pool: Optional[CPUPool] = None,
+) -> Response:
+    """
+    Compare the curves and return them in the requested format: JSON, or streamed
+    NDJSON if the `Accept` header asks for it and the donors are requested.
+    """
+    statistics = await run_cpu_bound(
+        cpu_pool,
+        calculate_survival_statistics,
+        [curve.durations for curve in curves],
+        [curve.events for curve in curves],
+        weights=logrank_weights,
+        counts=[curve.counts for curve in curves],
+    )
+
+    if output == "donors" and NDJSON_MEDIA_TYPE in (accept or ""):
+        return StreamingResponse(
+            stream_survival_results(curves, statistics),
+            media_type=NDJSON_MEDIA_TYPE,
+        )
+
+    # the curves are rendered in a thread: pickling them to a process would cost more
+    # than rendering them
+    content = await run_in_thread(
+        cpu_pool,
+        render_survival_results,
+        curves,
+        statistics,
+        output=output,
+        confidence_level=confidence_level,
+    )
+    return Response(
+        content=content,
+        status_code=status.HTTP_200_OK,
+        media_type="application/json",
+    )
+
+
 # Define a Pydantic model for the request body
 class PlotRequest(BaseModel):
     filters: List[Dict]
+    logrank_weights: Optional[LogRankWeights] = None
+    # "donors": one entry per donor. "curve": only the distinct steps of each curve
+    output: Literal["donors", "curve"] = "donors"
+    # with `output="curve"`, also return the bounds of this confidence interval
+    confidence_level: Optional[float] = Field(default=None, gt=0, lt=1)
+    # split the cohort (a single filter) into one curve per value of this field, e.g.
+    # "demographic.gender"
+    stratify_by: Optional[str] = Field(default=None, pattern=r"^\w+(\.\w+)*$")
+    # "cases": fit the curves from the cases' documents. "aggregation": fit them from
+    # histograms of the cases' durations, which doesn't depend on the cohort size but
+    # only supports `output="curve"`
+    source: Literal["cases", "aggregation"] = "cases"
 
 
 @survival.post(
     path="/",
     dependencies=[Depends(get_guppy_client)],
     status_code=status.HTTP_200_OK,
-    description="Retrieves the survival plot(s) for the given filters. An array of filters is provided and will return an array of survival plot data",
+    description='Retrieves the survival plot(s) for the given filters. An array of filters is provided and will return an array of survival plot data. Send `Accept: application/x-ndjson` to stream the donors as newline-delimited JSON. Set `stratify_by` to split a single cohort into one curve per value of a field, from a single Guppy query. Set `source` to "aggregation" (with `output` "curve") to fit the curves from histograms instead of fetching the cases',
     summary="Survival plots for cohort represented as filters",
     responses={
         status.HTTP_200_OK: {"description": "Successfully processed the survival plot"},
@@ -257,34 +702,58 @@ async def plot(
     access_token: Optional[str] = Cookie(None),
     gen3_graphql_client: GuppyGQLClient = Depends(get_guppy_client),
     auth: Auth = Depends(Auth),
-) -> JSONResponse:
+    survival_cache: Optional[TTLCache] = Depends(get_survival_cache),
+    cache_control: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+    cpu_pool: Optional[CPUPool] = Depends(get_cpu_pool),
+) -> Response:
     filters = body.filters
 
     if filters is None or len(filters) == 0:
         raise HTTPException(status_code=400, detail="Must have at least one filter")
+    if body.stratify_by and len(filters) != 1:
+        raise HTTPException(
+            status_code=400, detail="stratify_by requires exactly one filter"
+        )
+    if body.source == "aggregation" and (body.output != "curve" or body.stratify_by):
+        raise HTTPException(
+            status_code=400,
+            detail='source "aggregation" requires output "curve" and no stratify_by',
+        )
 
     try:
-        non_empty_curves = []
-        for f in filters:
-            curve = await get_curve(f, gen3_graphql_client, access_token=access_token)
-            if curve:
-                non_empty_curves.append(curve)
-
-        statistics = calculate_survival_statistics(non_empty_curves)
-
-        results = [
-            {"meta": curve["meta"], "donors": curve["donors"]}
-            for curve in non_empty_curves
+        # fetch the cohorts concurrently; the curves are returned in the filters' order
+        curves = await gather_with_concurrency(
+            config.SURVIVAL_MAX_CONCURRENT_COHORTS,
+            *(
+                get_cached_curves(
+                    f,
+                    gen3_graphql_client,
+                    survival_cache,
+                    access_token=access_token,
+                    cache_control=cache_control,
+                    cpu_pool=cpu_pool,
+                    stratify_by=body.stratify_by,
+                    source=body.source,
+                )
+                for f in filters
+            ),
+        )
+        non_empty_curves = [
+            curve for cohort_curves in curves for curve in cohort_curves
         ]
 
-        return JSONResponse(
-            status_code=status.HTTP_200_OK,
-            content={
-                "results": results,
-                "overallStats": statistics,
-            },
+        return await build_survival_response(
+            non_empty_curves,
+            output=body.output,
+            confidence_level=body.confidence_level,
+            logrank_weights=body.logrank_weights,
+            accept=accept,
+            cpu_pool=cpu_pool,
         )
 
+    except HTTPException:
+        raise
     except ValueError as e:
         logger.error(f"Error while processing survival plot: {e}")
         raise HTTPException(status_code=500, detail="Error with survival calculation")
@@ -298,7 +767,10 @@ class CompareSurvivalRequest(BaseModel):
     filters: List[Dict]
     doc_type: str
     field: str
+    # no longer used: the cohorts are fetched entirely, page by page
     limit: int = MAX_CASES
+    output: Literal["donors", "curve"] = "donors"
+    confidence_level: Optional[float] = Field(default=None, gt=0, lt=1)
 
 
 @survival.post(
@@ -328,70 +800,72 @@ async def compare(
     access_token: Optional[str] = Cookie(None),
     gen3_graphql_client: GuppyGQLClient = Depends(get_guppy_client),
     auth: Auth = Depends(Auth),
-) -> JSONResponse:
+    survival_cache: Optional[TTLCache] = Depends(get_survival_cache),
+    cache_control: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+    cpu_pool: Optional[CPUPool] = Depends(get_cpu_pool),
+) -> Response:
     filters = request.filters
-    doc_type = request.doc_type
     field = request.field
-    limit = request.limit
 
     if len(filters) != 2:
         raise HTTPException(
             status_code=400, detail="filters must be a list of 2 filters"
         )
-
-    # get a list of cases to perform set operation on, for each cohort
-    plot_items_0 = await cases.get_item_ids(
-        gen3_graphql_client,
-        doc_type,
-        field,
-        filters[0],
-        limit=limit,
-        access_token=access_token,
-    )
-
-    plot_items_1 = await cases.get_item_ids(
-        gen3_graphql_client,
-        doc_type,
-        field,
-        filters[1],
-        limit=limit,
-        access_token=access_token,
-    )
-
-    if plot_items_0.get("data") is None:
+    if request.doc_type != "case":
         raise HTTPException(
-            status_code=400, detail="No cases found for the first filter"
+            status_code=400, detail="Only the 'case' doc_type can be compared"
         )
-    if plot_items_1.get("data") is None:
-        raise HTTPException(
-            status_code=400, detail="No cases found for the second filter"
-        )
-
-    # extract ids
-
-    ids = glom(plot_items_0, f"data.{doc_type}", default=[])
-    ids_0 = [x[field] for x in ids if x.get(field) is not None]
-
-    ids = glom(plot_items_1, f"data.{doc_type}", default=[])
-    ids_1 = [x[field] for x in ids if x.get(field) is not None]
-
-    # Fastest approach: Convert to sets once and reuse
-    set0 = set(ids_0)
-    set1 = set(ids_1)
 
-    intersection = set0 & set1
-
-    # Subtract the intersection from both sets
-    item_id_0_minus_intersection = list(set0 - intersection)
-    item_id_1_minus_intersection = list(set1 - intersection)
-
-    # build graphql filter for both using in
-
-    filter_0 = {"in": {field: item_id_0_minus_intersection}}
-    filter_1 = {"in": {field: item_id_1_minus_intersection}}
+    async def fetch_curves():
+        # fetch each cohort once, with the comparison field along with the survival data
+        cohorts = await gather_with_concurrency(
+            config.SURVIVAL_MAX_CONCURRENT_COHORTS,
+            *(
+                fetch_cohort(
+                    f, gen3_graphql_client, access_token=access_token, key_field=field
+                )
+                for f in filters
+            ),
+        )
+        # encode the keys of both cohorts as integers, with a shared dictionary
+        dictionary = IdDictionary()
+        codes = dictionary.encode(
+            *(cohort.keys if cohort else [] for cohort in cohorts)
+        )
+        id_sets = [IdSet.from_codes(cohort_codes) for cohort_codes in codes]
+
+        # keep the cases of each cohort that are not in the other cohort
+        exclusive_cohorts = []
+        for cohort, cohort_codes, other_ids in zip(cohorts, codes, reversed(id_sets)):
+            if cohort is None:
+                continue
+            exclusive = (cohort_codes != IdDictionary.MISSING) & ~other_ids.contains(
+                cohort_codes
+            )
+            if exclusive.any():
+                exclusive_cohorts.append(cohort.take(np.flatnonzero(exclusive)))
+        return await fit_curves(exclusive_cohorts, cpu_pool=cpu_pool)
 
-    return await plot(
-        PlotRequest(filters=[filter_0, filter_1]),
-        access_token,
-        gen3_graphql_client,
-    )
+    try:
+        curves = await with_survival_cache(
+            survival_cache,
+            cache_control,
+            ("survival_compare", filters, field, access_scope(access_token)),
+            fetch_curves,
+        )
+        return await build_survival_response(
+            curves,
+            output=request.output,
+            confidence_level=request.confidence_level,
+            accept=accept,
+            cpu_pool=cpu_pool,
+        )
+    except HTTPException:
+        raise
+    except ValueError as e:
+        logger.error(f"Error while processing survival comparison: {e}")
+        raise HTTPException(status_code=500, detail="Error with survival calculation")
+    except Exception as e:
+        logger.error(f"Error while processing survival comparison: {e}")
+        raise HTTPException(status_code=500)
@@ -0,0 +1,214 @@
+"""Protection of an upstream service (Guppy) against overload"""
+
+import asyncio
+from collections import deque
+import time
+from typing import Optional
+
+from fastapi import HTTPException
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
+
+from gen3analysis.config import logger
+from gen3analysis.utils.metrics import (
+    UPSTREAM_CIRCUIT_OPEN,
+    UPSTREAM_CONCURRENCY_LIMIT,
+    UPSTREAM_REJECTED,
+    UPSTREAM_REQUESTS,
+    UPSTREAM_RETRIES,
+)
+
+
+class AdaptiveLimiter:
+    """
+    Limit the number of concurrent requests to a service, adapting the limit to how
+    the service copes (AIMD, as in TCP congestion control): each fast, successful
+    request raises the limit by `1 / limit` (about +1 per round of requests), and a
+    request that fails with an overload error or takes longer than `latency_target`
+    seconds divides it by `1 / decrease_ratio`. The limit stays between `min_limit`
+    and `max_limit`.
+
+    Requests over the limit wait for a slot, in order.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: int,
+        min_limit: int,
+        max_limit: int,
+        latency_target: float,
+        decrease_ratio: float = 0.5,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.latency_target = latency_target
+        self.decrease_ratio = decrease_ratio
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        # requests sent before the last decrease don't decrease the limit again: they
+        # reflect the load from before it
+        self._last_decrease = float("-inf")
+        UPSTREAM_CONCURRENCY_LIMIT.labels(service=name).set(self.limit)
+
+    @property
+    def _capacity(self) -> int:
+        return int(self.limit)
+
+    async def acquire(self) -> float:
+        """
+        Wait for a slot, and return the time at which it was acquired, to be passed to
+        `release`
+        """
+        if self.in_flight < self._capacity and not self._waiters:
+            self.in_flight += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+            UPSTREAM_REQUESTS.labels(service=self.name, state="queued").inc()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # the slot was granted to this request, give it back
+                    self.in_flight -= 1
+                    self._wake()
+                raise
+            finally:
+                UPSTREAM_REQUESTS.labels(service=self.name, state="queued").dec()
+                if future in self._waiters:
+                    self._waiters.remove(future)
+        UPSTREAM_REQUESTS.labels(service=self.name, state="in_flight").inc()
+        return time.monotonic()
+
+    def release(self, start: float, overloaded: bool) -> None:
+        """
+        Release the slot acquired at `start`. `overloaded` is True if the request failed
+        in a way that suggests the service is overloaded (timeout, 5xx error...)
+        """
+        self.in_flight -= 1
+        UPSTREAM_REQUESTS.labels(service=self.name, state="in_flight").dec()
+        now = time.monotonic()
+        if overloaded or now - start > self.latency_target:
+            if start >= self._last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.decrease_ratio)
+                self._last_decrease = now
+                logger.warning(
+                    f"{self.name} concurrency limit decreased to {self._capacity}"
+                )
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        UPSTREAM_CONCURRENCY_LIMIT.labels(service=self.name).set(self.limit)
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < self._capacity:
+            future = self._waiters.popleft()
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+
+class CircuitBreaker:
+    """
+    Fail fast, with a 503 error, while a service is unhealthy instead of sending it
+    more requests.
+
+    After `failure_threshold` consecutive failures, the circuit "opens": all
+    requests are rejected for `reset_timeout` seconds. Then a single trial request is
+    let through ("half-open"): if it succeeds the circuit closes, otherwise it opens
+    again. A `failure_threshold` of 0 disables the circuit breaker.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        UPSTREAM_CIRCUIT_OPEN.labels(service=name).set(0)
+
+    def check(self) -> bool:
+        """
+        Raise a 503 error if the request must not be sent. Return True if the request
+        is the trial request of the half-open circuit
+        """
+        if not self.failure_threshold:
+            return False
+        if (
+            self.state == self.OPEN
+            and time.monotonic() >= self._opened_at + self.reset_timeout
+        ):
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        if self.state != self.CLOSED:
+            UPSTREAM_REJECTED.labels(service=self.name).inc()
+            raise HTTPException(
+                status_code=HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"{self.name} is unavailable, please retry later",
+            )
+        return False
+
+    def record(self, failed: Optional[bool], trial: bool = False) -> None:
+        """
+        Record the outcome of a request let through by `check`: `None` if it was
+        abandoned (e.g. cancelled) before completing. `trial` is the value returned by
+        `check`: while the circuit is not closed, only the outcome of the trial
+        request matters, not that of requests sent before the circuit opened
+        """
+        if not self.failure_threshold:
+            return
+        if trial:
+            self._trial_in_flight = False
+        elif self.state != self.CLOSED:
+            return
+        if failed is None:
+            return
+        if not failed:
+            self.failures = 0
+            self._set_state(self.CLOSED)
+            return
+        self.failures += 1
+        if trial or self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f"{self.name} circuit breaker: {self.state} -> {state}")
+        self.state = state
+        UPSTREAM_CIRCUIT_OPEN.labels(service=self.name).set(int(state == self.OPEN))
+
+
+class RetryBudget:
+    """
+    Cap retries to a fraction of the requests, so that retries don't multiply the
+    load on a service that is already struggling: each request deposits `ratio`
+    tokens (up to `max_tokens`), and each retry withdraws one.
+    """
+
+    def __init__(self, name: str, ratio: float, max_tokens: float = 10):
+        self.name = name
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self) -> None:
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            UPSTREAM_RETRIES.labels(service=self.name, result="budget_exhausted").inc()
+            return False
+        self.tokens -= 1
+        UPSTREAM_RETRIES.labels(service=self.name, result="retried").inc()
+        return True
@@ -0,0 +1,106 @@
+"""In-memory caching helpers"""
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from gen3analysis.utils.metrics import CACHE_EVICTIONS, CACHE_REQUESTS
+
+# returned by `TTLCache.get` when the key is not cached, since `None` can be cached
+MISSING = object()
+
+
+def canonical_hash(*parts: Any) -> str:
+    """
+    Return a stable hash of JSON-serializable values: dict keys are sorted so that
+    equivalent filters written in a different order get the same hash.
+    """
+    canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def access_scope(access_token: Optional[str]) -> str:
+    """
+    Return an identifier of the data a caller can access, to be included in cache keys
+    so that results are never shared between callers with different permissions. The
+    token itself is hashed so that it is not kept in memory as a key.
+    """
+    if not access_token:
+        return "anonymous"
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+
+class TTLCache:
+    """
+    Least-recently-used cache whose entries expire `ttl_seconds` after being set.
+
+    The cache holds at most `max_entries` entries and, if `max_weight` is set, at most
+    `max_weight` total weight as computed by `weigher` (e.g. the number of cases of a
+    survival curve). The least recently used entries are evicted first.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int,
+        ttl_seconds: float,
+        max_weight: int = 0,
+        weigher: Optional[Callable[[Any], int]] = None,
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_weight = max_weight
+        self.weigher = weigher or (lambda value: 1)
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()  # key => (expires_at, weight, value)
+        self._weight = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        """Return the cached value for `key`, or `MISSING`"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            CACHE_REQUESTS.labels(cache=self.name, result="miss").inc()
+            return MISSING
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        CACHE_REQUESTS.labels(cache=self.name, result="hit").inc()
+        return entry[2]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.max_entries <= 0:
+            return
+        weight = self.weigher(value)
+        if self.max_weight and weight > self.max_weight:
+            # would evict everything else and still not fit
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, weight, value)
+        self._weight += weight
+
+        while len(self._entries) > self.max_entries or (
+            self.max_weight and self._weight > self.max_weight
+        ):
+            self._remove(next(iter(self._entries)))
+            CACHE_EVICTIONS.labels(cache=self.name).inc()
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._weight = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, weight, _ = self._entries.pop(key)
+        self._weight -= weight
@@ -1,7 +1,8 @@
 """ General purpose functions """
 
+import asyncio
 from functools import reduce
-from typing import Dict, Tuple, Hashable, Any
+from typing import Awaitable, Dict, List, Tuple, Hashable, Any
 
 from sqlalchemy import inspect
 
@@ -112,3 +113,36 @@ def find_differences(
 def remove_keys(d: dict, keys: set):
     """Given a dictionary d and set of keys k, remove all k in d"""
     return {k: v for k, v in d.items() if k not in keys}
+
+
+async def gather_with_concurrency(limit: int, *aws: Awaitable) -> List[Any]:
+    """
+    Run awaitables concurrently, with at most `limit` of them running at the same time,
+    and return their results in the order they were provided.
+
+    If one of them fails, the others are cancelled and the exception is raised. If the
+    caller is cancelled (e.g. the client disconnected), all of them are cancelled.
+
+    Args:
+        limit (int): maximum number of awaitables running at once. No limit if <= 0
+        *aws (Awaitable): the awaitables to run
+
+    Returns:
+        list: the results, in the same order as `aws`
+    """
+    semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+
+    async def run(aw):
+        if semaphore is None:
+            return await aw
+        async with semaphore:
+            return await aw
+
+    tasks = [asyncio.ensure_future(run(aw)) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
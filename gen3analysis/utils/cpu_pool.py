@@ -0,0 +1,130 @@
+"""Execution of CPU-bound work outside of the asyncio event loop"""
+
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Optional
+
+from fastapi import HTTPException
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
+
+from gen3analysis.config import logger
+from gen3analysis.utils.metrics import CPU_POOL_REJECTED, CPU_POOL_TASKS
+
+
+class CPUPool:
+    """
+    Run CPU-bound functions (curve fitting, statistics, JSON encoding...) in a pool of
+    workers so that they don't block the event loop, and other requests, while they run.
+
+    - kind="process": functions run in worker processes. Arguments and results are
+      pickled, so they should be compact (e.g. NumPy arrays rather than lists of dicts).
+      Functions that take or build many Python objects, like rendering JSON or
+      aligning lists of histogram buckets, would spend more time pickling than they
+      save: `run_in_thread` runs them in worker threads instead.
+    - kind="thread": functions run in worker threads. They only run in parallel with
+      the event loop while they release the GIL, like most NumPy operations: pure
+      Python code still slows down the other requests.
+    - kind="inline": functions run directly on the event loop.
+
+    At most `max_workers` functions run at once; at most `max_queue` more wait for a
+    worker, and further submissions are rejected with a 503 error. A function keeps its
+    worker until it returns, even if its caller was cancelled.
+    """
+
+    def __init__(self, kind: str, max_workers: int, max_queue: int):
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor: Optional[Executor] = None
+        self._thread_executor: Optional[Executor] = None
+        if kind in ["process", "thread"]:
+            self._thread_executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="gen3analysis-cpu"
+            )
+            self._executor = self._thread_executor
+        if kind == "process":
+            self._executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        self._slots = asyncio.Semaphore(max_workers)
+        self._queued = 0
+        logger.info(f"CPUPool initialized: kind={kind}, max_workers={max_workers}")
+
+    async def run(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        return await self._run(self._executor, func, *args, **kwargs)
+
+    async def run_in_thread(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        """Like `run`, but in a worker thread when kind="process" too"""
+        return await self._run(self._thread_executor, func, *args, **kwargs)
+
+    async def _run(
+        self, executor: Optional[Executor], func: Callable, *args: Any, **kwargs: Any
+    ) -> Any:
+        if executor is None:
+            return func(*args, **kwargs)
+
+        if self._slots.locked() and self._queued >= self.max_queue:
+            CPU_POOL_REJECTED.inc()
+            raise HTTPException(
+                status_code=HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many analyses in progress, please retry later",
+            )
+
+        self._queued += 1
+        CPU_POOL_TASKS.labels(state="queued").inc()
+        try:
+            await self._slots.acquire()
+        finally:
+            self._queued -= 1
+            CPU_POOL_TASKS.labels(state="queued").dec()
+
+        CPU_POOL_TASKS.labels(state="running").inc()
+        loop = asyncio.get_running_loop()
+        try:
+            future = executor.submit(partial(func, *args, **kwargs))
+        except BaseException:
+            self._release_slot()
+            raise
+
+        # the slot is released when the function is done, not when the caller stops
+        # waiting for it (e.g. the client disconnected): a cancelled call keeps its
+        # worker busy until it returns
+        def release(_: Future) -> None:
+            try:
+                loop.call_soon_threadsafe(self._release_slot)
+            except RuntimeError:
+                pass  # the event loop is closed
+
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    def _release_slot(self) -> None:
+        CPU_POOL_TASKS.labels(state="running").dec()
+        self._slots.release()
+
+    def shutdown(self) -> None:
+        for executor in {self._executor, self._thread_executor} - {None}:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        self._thread_executor = None
+
+
+async def run_cpu_bound(
+    cpu_pool: Optional[CPUPool], func: Callable, *args: Any, **kwargs: Any
+) -> Any:
+    """Run `func` in `cpu_pool`, or directly if there is no pool"""
+    if cpu_pool is None:
+        return func(*args, **kwargs)
+    return await cpu_pool.run(func, *args, **kwargs)
+
+
+async def run_in_thread(
+    cpu_pool: Optional[CPUPool], func: Callable, *args: Any, **kwargs: Any
+) -> Any:
+    """Run `func` in a thread of `cpu_pool`, or directly if there is no pool"""
+    if cpu_pool is None:
+        return func(*args, **kwargs)
+    return await cpu_pool.run_in_thread(func, *args, **kwargs)
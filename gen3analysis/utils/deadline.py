@@ -0,0 +1,109 @@
+"""Per-request deadline of the requests to other Gen3 services"""
+
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import time
+from typing import AsyncIterator, Iterator, Optional
+
+from fastapi import HTTPException
+import httpx
+from starlette.status import HTTP_504_GATEWAY_TIMEOUT
+
+from gen3analysis import config
+
+# header a client can send to shorten the deadline of its request, in seconds
+DEADLINE_HEADER = "x-request-timeout"
+
+# `time.monotonic()` value after which the current request is abandoned, or None.
+# Being a context variable, it follows the request into the tasks it spawns, down to
+# the Guppy client, without being passed around as an argument
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+def request_timeout(header_value: Optional[str]) -> Optional[float]:
+    """
+    Return the timeout of a request, in seconds: the `DEADLINE_HEADER` value if it is
+    valid, capped by `REQUEST_TIMEOUT_SECONDS`, or None if there is no timeout
+    """
+    timeout = config.REQUEST_TIMEOUT_SECONDS or None
+    try:
+        requested = float(header_value) if header_value else None
+    except ValueError:
+        requested = None
+    if requested is not None and requested > 0:
+        timeout = min(timeout, requested) if timeout else requested
+    return timeout
+
+
+@contextmanager
+def request_deadline(timeout: Optional[float]) -> Iterator[None]:
+    """
+    Set the deadline of the code in the block (and of the tasks it creates) to
+    `timeout` seconds from now. An outer, earlier deadline is kept.
+    """
+    deadline = _deadline.get()
+    if timeout is not None:
+        new_deadline = time.monotonic() + timeout
+        deadline = new_deadline if deadline is None else min(deadline, new_deadline)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Return the number of seconds left before the deadline, or None if there is none"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def deadline_exceeded() -> HTTPException:
+    return HTTPException(
+        HTTP_504_GATEWAY_TIMEOUT, "The request did not complete before its deadline"
+    )
+
+
+def check_deadline(delay: float = 0) -> None:
+    """
+    Raise a 504 error if the deadline has passed, or would pass after waiting `delay`
+    seconds
+    """
+    left = remaining()
+    if left is not None and left <= delay:
+        raise deadline_exceeded()
+
+
+def capped_timeout(timeout: httpx.Timeout) -> httpx.Timeout:
+    """Return `timeout` with each phase bounded by the time left before the deadline"""
+    left = remaining()
+    if left is None:
+        return timeout
+
+    def cap(value: Optional[float]) -> float:
+        return left if value is None else min(value, left)
+
+    return httpx.Timeout(
+        connect=cap(timeout.connect),
+        read=cap(timeout.read),
+        write=cap(timeout.write),
+        pool=cap(timeout.pool),
+    )
+
+
+@asynccontextmanager
+async def within_deadline() -> AsyncIterator[None]:
+    """
+    Cancel the code in the block when the deadline passes, and raise a 504 error
+    instead. httpx timeouts apply to each read or write, so they do not bound a whole
+    request on their own.
+    """
+    check_deadline()
+    try:
+        async with asyncio.timeout(remaining()):
+            yield
+    except TimeoutError:
+        raise deadline_exceeded()
@@ -0,0 +1,180 @@
+"""Top-k truncation and pagination of the histogram buckets of facets"""
+
+import base64
+import binascii
+from dataclasses import dataclass
+import json
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from gen3analysis.utils.facet_stats import (
+    AlignedBuckets,
+    align_buckets,
+    compare_facet_buckets,
+)
+
+
+@dataclass
+class BucketPage:
+    """
+    The buckets returned for a page: `positions` are their indices in the aligned
+    arrays, grouped by facet, by decreasing total count. `other_counts[c][f]` and
+    `other_buckets[c][f]` are the total count and the number of buckets of facet `f`
+    in cohort `c` that are past the top k.
+    """
+
+    positions: np.ndarray
+    other_counts: np.ndarray  # shape (n_cohorts, n_facets)
+    other_buckets: np.ndarray  # shape (n_cohorts, n_facets)
+    has_more: bool
+
+
+def encode_cursor(offset: int) -> str:
+    """Return the opaque cursor of the page of buckets starting at `offset`"""
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    """Return the offset of a cursor returned by `encode_cursor`, or raise ValueError"""
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))["offset"]
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return offset
+
+
+def select_buckets(
+    aligned: AlignedBuckets,
+    truncated: np.ndarray,
+    top_k: Optional[int] = None,
+    offset: int = 0,
+    page_size: Optional[int] = None,
+) -> BucketPage:
+    """
+    Rank the buckets of each facet by decreasing total count across the cohorts (ties
+    in order of first appearance), and select the ranks `offset` to
+    `offset + page_size` among the `top_k` first. The other buckets past the top k
+    are rolled up into "other" counts.
+
+    Only the facets where `truncated` (a boolean per facet) is True are ranked and
+    truncated: the buckets of the other facets (e.g. numeric bins) are all selected,
+    in their order.
+    """
+    segments = aligned.segments
+    n_facets = len(aligned.facets)
+    truncated_bucket = truncated[segments]
+    totals = np.where(truncated_bucket, aligned.counts.sum(axis=0), 0)
+
+    # one sort ranks the buckets of all the facets: by facet, then by decreasing total
+    order = np.lexsort((-totals, segments))
+    sizes = np.bincount(segments, minlength=n_facets)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - starts[segments[order]]
+
+    shown = sizes if top_k is None else np.minimum(sizes, top_k)
+    page_end = shown if page_size is None else np.minimum(shown, offset + page_size)
+    # the facets that are not truncated are selected whole
+    shown = np.where(truncated, shown, sizes)
+    first = np.where(truncated, offset, 0)
+    page_end = np.where(truncated, page_end, sizes)
+    in_page = (rank >= first[segments]) & (rank < page_end[segments])
+
+    other = rank >= shown[segments]
+    other_segments = segments[other]
+    return BucketPage(
+        positions=order[in_page[order]],
+        other_counts=np.stack(
+            [
+                np.bincount(other_segments, row[other], minlength=n_facets)
+                for row in aligned.counts
+            ]
+        ),
+        other_buckets=np.stack(
+            [
+                np.bincount(other_segments, row[other], minlength=n_facets)
+                for row in aligned.present
+            ]
+        ),
+        has_more=bool((truncated & (shown > page_end)).any()),
+    )
+
+
+def page_to_json(
+    aligned: AlignedBuckets, page: BucketPage, rollup: np.ndarray
+) -> List[Dict[str, dict]]:
+    """
+    Return the histograms of each facet in each cohort, with the buckets of `page`
+    that are present in the cohort, and an `other` rollup for the facets where
+    `rollup` is True
+    """
+    positions = page.positions
+    bounds = np.searchsorted(
+        aligned.segments[positions], np.arange(len(aligned.facets) + 1)
+    )
+    # numeric histograms have `[start, end]` keys
+    keys = [
+        list(key) if isinstance(key, tuple) else key
+        for key in aligned.keys[positions].tolist()
+    ]
+    res = []
+    for counts, present, other_counts, other_buckets in zip(
+        aligned.counts[:, positions].astype(np.int64).tolist(),
+        aligned.present[:, positions].tolist(),
+        page.other_counts.astype(np.int64).tolist(),
+        page.other_buckets.astype(np.int64).tolist(),
+    ):
+        facets = {}
+        for i, facet in enumerate(aligned.facets):
+            start, end = bounds[i], bounds[i + 1]
+            facets[facet] = {
+                "buckets": [
+                    {"key": key, "count": count}
+                    for key, count, is_present in zip(
+                        keys[start:end], counts[start:end], present[start:end]
+                    )
+                    if is_present
+                ]
+            }
+            if rollup[i]:
+                facets[facet]["other"] = {
+                    "count": other_counts[i],
+                    "buckets": other_buckets[i],
+                }
+        res.append(facets)
+    return res
+
+
+def paginate_facets(
+    facets: List[str],
+    buckets: Sequence[Dict[str, List[dict]]],
+    truncated: Sequence[bool],
+    top_k: Optional[int] = None,
+    offset: int = 0,
+    page_size: Optional[int] = None,
+    correction: Optional[str] = None,
+) -> dict:
+    """
+    Align the buckets of the cohorts (`buckets[c][facet]`), and select the top-k
+    buckets and page of each facet (see `select_buckets`).
+
+    Returns:
+        dict: `cohorts`, the histograms of each cohort (see `page_to_json`);
+        `has_more`, whether some facets have buckets after this page; and with a
+        `correction`, `statistics`: the significance tests of the differences between
+        the 2 cohorts (see `compare_facet_buckets`), on all the buckets, with the
+        per-bucket tests of the page's buckets.
+    """
+    aligned = align_buckets(facets, buckets)
+    truncated = np.asarray(truncated, dtype=bool)
+    page = select_buckets(aligned, truncated, top_k, offset, page_size)
+    res = {
+        "cohorts": page_to_json(aligned, page, truncated & (top_k is not None)),
+        "has_more": page.has_more,
+    }
+    if correction is not None:
+        res["statistics"] = compare_facet_buckets(aligned, correction, page.positions)
+    return res
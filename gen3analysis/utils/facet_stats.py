@@ -0,0 +1,229 @@
+"""Significance tests of the differences between the facets of two cohorts"""
+
+from dataclasses import dataclass
+from operator import itemgetter
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from scipy.special import chdtrc, ndtr
+
+
+@dataclass
+class AlignedBuckets:
+    """
+    The buckets of several facets in several cohorts, flattened into aligned arrays:
+    bucket `i` belongs to facet `facets[segments[i]]`, has key `keys[i]` and count
+    `counts[c][i]` in cohort `c` (0 if absent from the cohort, in which case
+    `present[c][i]` is False). The buckets of each facet are contiguous, in order of
+    first appearance.
+    """
+
+    facets: List[str]
+    segments: np.ndarray
+    keys: np.ndarray
+    counts: np.ndarray  # shape (n_cohorts, n_buckets)
+    present: np.ndarray  # shape (n_cohorts, n_buckets)
+
+
+def align_buckets(
+    facets: List[str], buckets: Sequence[Dict[str, List[dict]]]
+) -> AlignedBuckets:
+    """
+    Align the histogram buckets (`{"key": ..., "count": ...}`) of each facet in the
+    cohorts: `buckets[c][facet]` are the buckets of `facet` in cohort `c`
+    """
+    segments, keys, counts, cohorts = [], [], [], []
+    for cohort, cohort_buckets in enumerate(buckets):
+        for segment, facet in enumerate(facets):
+            histogram = cohort_buckets.get(facet) or []
+            segments.append(np.full(len(histogram), segment, dtype=np.int64))
+            cohorts.append(np.full(len(histogram), cohort, dtype=np.int64))
+            facet_keys = map(itemgetter("key"), histogram)
+            if histogram and isinstance(histogram[0]["key"], list):
+                # numeric histograms have `[start, end]` keys
+                facet_keys = map(tuple, facet_keys)
+            keys.extend(facet_keys)
+            counts.extend(map(itemgetter("count"), histogram))
+    segments = np.concatenate(segments)
+    cohorts = np.concatenate(cohorts)
+    counts = np.asarray(counts, dtype=np.float64)
+    keys_array = np.empty(len(keys), dtype=object)
+    keys_array[:] = keys
+
+    # a bucket is identified by its (facet, key) pair, numbered in order of first
+    # appearance by `pd.factorize`...
+    key_codes, unique_keys = pd.factorize(keys_array)
+    missing = key_codes < 0
+    if missing.any():
+        # `pd.factorize` codes null keys as -1: they get their own `None` key instead
+        key_codes[missing] = len(unique_keys)
+        unique_keys = np.append(unique_keys.astype(object), None)
+    n_keys = max(len(unique_keys), 1)
+    pair_codes, unique_pairs = pd.factorize(segments * n_keys + key_codes)
+    # ... then grouped by facet, stably
+    order = np.argsort(unique_pairs // n_keys, kind="stable")
+    bucket = np.empty_like(order)
+    bucket[order] = np.arange(len(order))
+    bucket = bucket[pair_codes]
+    unique_pairs = unique_pairs[order]
+
+    in_cohort = [cohorts == cohort for cohort in range(len(buckets))]
+    return AlignedBuckets(
+        facets=facets,
+        segments=unique_pairs // n_keys,
+        keys=keys_array[:0] if not len(keys) else unique_keys[unique_pairs % n_keys],
+        counts=np.stack(
+            [
+                np.bincount(bucket[mask], counts[mask], minlength=len(unique_pairs))
+                for mask in in_cohort
+            ]
+        ),
+        present=np.stack(
+            [
+                np.bincount(bucket[mask], minlength=len(unique_pairs)) > 0
+                for mask in in_cohort
+            ]
+        ),
+    )
+
+
+def adjust_p_values(
+    p_values: np.ndarray, segments: np.ndarray, method: str
+) -> np.ndarray:
+    """
+    Adjust `p_values` for multiple testing, separately within each segment (e.g. the
+    buckets of each facet are a family of tests):
+    - fdr_bh: Benjamini-Hochberg false discovery rate
+    - holm: Holm-Bonferroni family-wise error rate
+    - bonferroni: Bonferroni family-wise error rate
+    - none: no adjustment
+    """
+    if method == "none" or not len(p_values):
+        return p_values
+    sizes = np.bincount(segments)
+    m = sizes[segments].astype(np.float64)
+    if method == "bonferroni":
+        return np.minimum(1, p_values * m)
+
+    # rank of each p-value within its segment, from 1
+    order = np.lexsort((p_values, segments))
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    rank = np.arange(1, len(order) + 1) - starts[segments[order]]
+    sorted_p = p_values[order]
+    sorted_m = m[order]
+    sorted_segments = segments[order].astype(np.float64)
+
+    # the running min/max must not cross segments: offsetting each segment by twice
+    # its index keeps the (0 to 1) values of different segments apart
+    if method == "fdr_bh":
+        adjusted = np.minimum(1, sorted_p * sorted_m / rank) + 2 * sorted_segments
+        adjusted = np.minimum.accumulate(adjusted[::-1])[::-1] - 2 * sorted_segments
+    elif method == "holm":
+        adjusted = np.minimum(1, sorted_p * (sorted_m - rank + 1)) + 2 * sorted_segments
+        adjusted = np.maximum.accumulate(adjusted) - 2 * sorted_segments
+    else:
+        raise ValueError(f"Unknown multiple-testing correction: {method}")
+
+    result = np.empty_like(p_values)
+    result[order] = adjusted
+    return result
+
+
+def compare_facet_buckets(
+    aligned: AlignedBuckets,
+    correction: str = "fdr_bh",
+    positions: Optional[np.ndarray] = None,
+) -> dict:
+    """
+    Test the differences between 2 cohorts, for all the facets at once:
+    - per facet: chi-square test of independence between cohort and bucket, on the
+      2 x n_buckets contingency table. Adjusted across facets.
+    - per bucket: two-proportion z-test of the bucket's share of the facet's counts in
+      each cohort. Adjusted across the buckets of each facet.
+
+    Returns:
+        dict: by facet, `chi2`, `dof`, `p_value` and `adjusted_p_value`, and the
+        columns of the per-bucket tests (`keys`, `proportion1`, `proportion2`, `z`,
+        `p_value`, `adjusted_p_value`). Statistics that are not defined (e.g. a facet
+        without counts in a cohort) are None. With `positions`, only the per-bucket
+        tests of the buckets at these positions (grouped by facet, e.g. a page of
+        buckets) are returned, in that order; they are still computed and adjusted
+        with all the buckets.
+    """
+    n_facets = len(aligned.facets)
+    segments = aligned.segments
+    observed = aligned.counts
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # chi-square test, on the buckets with counts
+        row_totals = np.stack(
+            [np.bincount(segments, row, minlength=n_facets) for row in observed]
+        )
+        col_totals = observed.sum(axis=0)
+        total = row_totals.sum(axis=0)
+        expected = row_totals[:, segments] * col_totals / total[segments]
+        cells = np.where(expected > 0, (observed - expected) ** 2 / expected, 0)
+        chi2 = np.bincount(segments, cells.sum(axis=0), minlength=n_facets)
+        non_empty = np.bincount(segments, col_totals > 0, minlength=n_facets)
+        dof = non_empty - 1
+        defined = (dof > 0) & (row_totals > 0).all(axis=0)
+        chi2_p = np.where(defined, chdtrc(np.maximum(dof, 1), chi2), np.nan)
+
+        # two-proportion z-tests, with the pooled proportion
+        n1, n2 = row_totals[0, segments], row_totals[1, segments]
+        proportion1 = observed[0] / n1
+        proportion2 = observed[1] / n2
+        pooled = col_totals / (n1 + n2)
+        se = np.sqrt(pooled * (1 - pooled) * (1 / n1 + 1 / n2))
+        z = (proportion1 - proportion2) / se
+        z_p = 2 * ndtr(-np.abs(z))
+
+    facet_adjusted = np.full(n_facets, np.nan)
+    facet_adjusted[defined] = adjust_p_values(
+        chi2_p[defined], np.zeros(defined.sum(), dtype=np.int64), correction
+    )
+    tested = np.isfinite(z_p)
+    bucket_adjusted = np.full(len(z_p), np.nan)
+    bucket_adjusted[tested] = adjust_p_values(z_p[tested], segments[tested], correction)
+
+    def column(values: np.ndarray) -> np.ndarray:
+        return np.where(np.isfinite(values), values, None)
+
+    if positions is None:
+        positions = np.arange(len(segments))
+    columns = {
+        "proportion1": column(proportion1[positions]),
+        "proportion2": column(proportion2[positions]),
+        "z": column(z[positions]),
+        "p_value": column(z_p[positions]),
+        "adjusted_p_value": column(bucket_adjusted[positions]),
+    }
+    res = {}
+    bounds = np.searchsorted(segments[positions], np.arange(n_facets + 1))
+    for i, facet in enumerate(aligned.facets):
+        start, end = bounds[i], bounds[i + 1]
+        keys = aligned.keys[positions[start:end]].tolist()
+        if keys and isinstance(keys[0], tuple):
+            keys = [list(key) for key in keys]
+        res[facet] = {
+            "chi2": float(chi2[i]) if defined[i] else None,
+            "dof": int(dof[i]) if defined[i] else None,
+            "p_value": float(chi2_p[i]) if defined[i] else None,
+            "adjusted_p_value": float(facet_adjusted[i]) if defined[i] else None,
+            "buckets": {
+                "keys": keys,
+                **{
+                    name: values[start:end].tolist() for name, values in columns.items()
+                },
+            },
+        }
+    return res
+
+
+def facet_statistics(
+    facets: List[str],
+    buckets: Sequence[Dict[str, List[dict]]],
+    correction: str = "fdr_bh",
+) -> dict:
+    """Align the buckets of the 2 cohorts and test their differences"""
+    return compare_facet_buckets(align_buckets(facets, buckets), correction)
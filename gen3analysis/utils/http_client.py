@@ -0,0 +1,46 @@
+"""Shared HTTP client for the requests to other Gen3 services"""
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from gen3analysis import config
+
+
+def make_http_client() -> httpx.AsyncClient:
+    """
+    Create the HTTP client shared by all the requests of a worker, so that connections
+    to Guppy and revproxy are kept alive and reused instead of being opened (TCP, and
+    TLS in "dev" deployments) for every request. It must be closed with `aclose()`.
+
+    HTTP/2 (`HTTP_CLIENT_HTTP2`) requires the `h2` package: `pip install httpx[http2]`.
+    """
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=config.HTTP_CLIENT_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=config.HTTP_CLIENT_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            config.HTTP_CLIENT_TIMEOUT,
+            connect=config.HTTP_CLIENT_CONNECT_TIMEOUT,
+            pool=config.HTTP_CLIENT_POOL_TIMEOUT,
+        ),
+        http2=config.HTTP_CLIENT_HTTP2,
+    )
+
+
+@asynccontextmanager
+async def use_http_client(
+    http_client: Optional[httpx.AsyncClient],
+) -> AsyncIterator[httpx.AsyncClient]:
+    """
+    Yield `http_client`, or a short-lived client if there is no shared client (e.g.
+    outside of the app's lifespan)
+    """
+    if http_client is not None:
+        yield http_client
+    else:
+        async with httpx.AsyncClient() as client:
+            yield client
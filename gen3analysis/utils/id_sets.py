@@ -0,0 +1,120 @@
+"""Compact set algebra on cohort ids"""
+
+from typing import Hashable, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+class IdDictionary:
+    """
+    Dictionary encoding of ids (e.g. `_case_id` strings): each distinct id gets an
+    integer code, so that the ids of several cohorts can be compared as integer arrays.
+    Cohorts must be encoded with the same dictionary to be compared.
+
+    Codes are dense (0 to `len(dictionary) - 1`), which lets `IdSet` use bitmaps over
+    the codes instead of sorting them.
+    """
+
+    # code of missing (None) ids, which never belong to an `IdSet`
+    MISSING = -1
+
+    def __init__(self):
+        self._index = pd.Index([], dtype=object)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def encode(self, *columns: Sequence[Hashable]) -> List[np.ndarray]:
+        """
+        Return the int64 codes of the ids of each column, `MISSING` for None. Encoding
+        all the columns in one call hashes each id once, with pandas' C hash tables.
+        """
+        ids = np.concatenate(
+            [np.asarray(column, dtype=object) for column in columns]
+            or [np.empty(0, dtype=object)]
+        )
+        if len(self._index):
+            codes = self._index.get_indexer(ids).astype(np.int64)
+            new = codes == self.MISSING
+            new_codes, new_ids = pd.factorize(ids[new])
+            codes[new] = np.where(
+                new_codes >= 0, new_codes + len(self._index), self.MISSING
+            )
+        else:
+            codes, new_ids = pd.factorize(ids)
+            codes = codes.astype(np.int64, copy=False)
+        if len(new_ids):
+            self._index = self._index.append(pd.Index(new_ids, dtype=object))
+        return np.split(codes, np.cumsum([len(column) for column in columns])[:-1])
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Return the ids corresponding to `codes`, as an object array"""
+        return self._index.to_numpy(dtype=object)[codes]
+
+
+def _bitmap(codes: np.ndarray, size: int) -> np.ndarray:
+    bitmap = np.zeros(size, dtype=bool)
+    bitmap[codes] = True
+    return bitmap
+
+
+class IdSet:
+    """
+    Immutable set of id codes, stored as a sorted array of unique int64 codes.
+
+    Since dictionary codes are dense, set operations and membership tests go through
+    boolean bitmaps indexed by code: they take linear time, without sorting and without
+    allocating a Python object per id.
+    """
+
+    def __init__(self, codes: np.ndarray):
+        # `codes` must be sorted and unique; use `from_codes` otherwise
+        self.codes = codes
+
+    @classmethod
+    def from_codes(cls, codes: np.ndarray) -> "IdSet":
+        codes = np.asarray(codes, dtype=np.int64)
+        codes = codes[codes != IdDictionary.MISSING]
+        if not len(codes):
+            return cls(codes)
+        return cls(np.flatnonzero(_bitmap(codes, int(codes.max()) + 1)))
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+    @property
+    def _size(self) -> int:
+        return int(self.codes[-1]) + 1 if len(self.codes) else 0
+
+    def intersection(self, other: "IdSet") -> "IdSet":
+        return IdSet(self.codes[other.contains(self.codes)])
+
+    def difference(self, other: "IdSet") -> "IdSet":
+        return IdSet(self.codes[~other.contains(self.codes)])
+
+    def union(self, other: "IdSet") -> "IdSet":
+        size = max(self._size, other._size)
+        return IdSet(
+            np.flatnonzero(_bitmap(self.codes, size) | _bitmap(other.codes, size))
+        )
+
+    __and__ = intersection
+    __sub__ = difference
+    __or__ = union
+
+    def contains(self, codes: np.ndarray) -> np.ndarray:
+        """Return a boolean mask of the `codes` that are in the set"""
+        codes = np.asarray(codes, dtype=np.int64)
+        mask = np.zeros(len(codes), dtype=bool)
+        # `MISSING` codes are never in the set
+        valid = codes >= 0
+        if not valid.any():
+            return mask
+        bitmap = _bitmap(self.codes, max(self._size, int(codes.max()) + 1))
+        mask[valid] = bitmap[codes[valid]]
+        return mask
@@ -1,10 +1,95 @@
+import os
 from typing import Any, Dict, Optional
 
 from fastapi import FastAPI
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    make_asgi_app,
+    multiprocess,
+)
 from pydantic import BaseModel, Field
 
 from gen3analysis.config import logger
 
+# WARNING: the labels of these metrics must not contain any PII / PHI
+
+CACHE_REQUESTS = Counter(
+    "gen3analysis_cache_requests",
+    "Number of cache lookups, by cache and result (hit or miss)",
+    ["cache", "result"],
+)
+CACHE_EVICTIONS = Counter(
+    "gen3analysis_cache_evictions",
+    "Number of entries evicted from a cache to respect its size limits",
+    ["cache"],
+)
+CACHE_REVALIDATIONS = Counter(
+    "gen3analysis_cache_revalidations",
+    "Number of stale cache entries served while being refreshed in the background, by cache and result (started, pending if already being refreshed, succeeded or failed)",
+    ["cache", "result"],
+)
+
+GUPPY_COALESCED_REQUESTS = Counter(
+    "gen3analysis_guppy_coalesced_requests",
+    "Number of Guppy queries sent upstream (sent) or served by an identical in-flight query (shared)",
+    ["result"],
+)
+
+UPSTREAM_REQUESTS = Gauge(
+    "gen3analysis_upstream_requests",
+    "Number of requests to an upstream service waiting for (queued) or using (in_flight) a concurrency slot",
+    ["service", "state"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    "gen3analysis_upstream_concurrency_limit",
+    "Current adaptive limit of concurrent requests to an upstream service",
+    ["service"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_CIRCUIT_OPEN = Gauge(
+    "gen3analysis_upstream_circuit_open",
+    "1 if the circuit breaker of an upstream service is open, 0 otherwise",
+    ["service"],
+    multiprocess_mode="livemax",
+)
+UPSTREAM_REJECTED = Counter(
+    "gen3analysis_upstream_rejected",
+    "Number of requests to an upstream service rejected because its circuit breaker was open",
+    ["service"],
+)
+UPSTREAM_RETRIES = Counter(
+    "gen3analysis_upstream_retries",
+    "Number of retried requests to an upstream service (retried), or not retried because the retry budget was exhausted (budget_exhausted)",
+    ["service", "result"],
+)
+
+CPU_POOL_TASKS = Gauge(
+    "gen3analysis_cpu_pool_tasks",
+    "Number of CPU-bound tasks waiting for (queued) or using (running) a worker",
+    ["state"],
+    multiprocess_mode="livesum",
+)
+CPU_POOL_REJECTED = Counter(
+    "gen3analysis_cpu_pool_rejected",
+    "Number of CPU-bound tasks rejected because the CPU pool queue was full",
+)
+
+
+def make_metrics_app():
+    """
+    Return an ASGI app serving the Prometheus metrics. When running with several
+    gunicorn workers (`PROMETHEUS_MULTIPROC_DIR` is set), the metrics of all the
+    workers are aggregated.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return make_asgi_app(registry=registry)
+    return make_asgi_app()
+
 
 class MetricModel(BaseModel):
     """A base class for metric models"""
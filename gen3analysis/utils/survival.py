@@ -0,0 +1,825 @@
+"""Columnar helpers for the survival analysis endpoints"""
+
+from dataclasses import dataclass, field
+from statistics import NormalDist
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from scipy.special import chdtrc
+
+from gen3analysis import config
+
+
+class StringDictionary:
+    """
+    Dictionary encoding of a string column: each distinct value is stored once and
+    rows refer to it by an integer code.
+    """
+
+    def __init__(self):
+        self.values: List[Optional[str]] = []
+        self._codes: Dict[Optional[str], int] = {}
+
+    def encode(self, value: Optional[str]) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Return the values corresponding to `codes`, as an object array"""
+        values = np.empty(len(self.values), dtype=object)
+        values[:] = self.values
+        return values[codes]
+
+
+@dataclass
+class SurvivalCohort:
+    """
+    Survival data of a cohort, one row per case.
+
+    All the columns are aligned arrays. `case_ids` and `submitter_ids` are unique per
+    case, so they are stored as object arrays referencing the parsed strings; the
+    low-cardinality `project_id` column is dictionary-encoded.
+    """
+
+    durations: np.ndarray  # float64
+    events: np.ndarray  # int8, 1 if dead, 0 if censored
+    case_ids: np.ndarray  # object
+    submitter_ids: np.ndarray  # object
+    project_id_codes: np.ndarray  # int32 codes into `project_ids`
+    project_ids: StringDictionary
+    # only set when the cohort is fetched with a stratification field
+    strata_codes: Optional[np.ndarray] = None  # int32 codes into `strata`
+    strata: Optional[StringDictionary] = None
+    # only set when the cohort is fetched with a key field, e.g. to compare cohorts
+    keys: Optional[np.ndarray] = None  # object
+    # only set for cohorts built from aggregated counts (see `from_counts`): number of
+    # cases each row stands for
+    counts: Optional[np.ndarray] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.durations)
+
+    @classmethod
+    def from_counts(
+        cls, durations: np.ndarray, events: np.ndarray, counts: np.ndarray
+    ) -> "SurvivalCohort":
+        """
+        Build a cohort from a table of (duration, event, number of cases) rows, for
+        which the individual cases are not known.
+        """
+        project_ids = StringDictionary()
+        project_ids.encode(None)
+        return cls(
+            durations=np.asarray(durations, dtype=np.float64),
+            events=np.asarray(events, dtype=np.int8),
+            case_ids=np.full(len(durations), None, dtype=object),
+            submitter_ids=np.full(len(durations), None, dtype=object),
+            project_id_codes=np.zeros(len(durations), dtype=np.int32),
+            project_ids=project_ids,
+            counts=np.asarray(counts, dtype=np.float64),
+        )
+
+    def take(self, indices: np.ndarray) -> "SurvivalCohort":
+        """Return the sub-cohort made of the rows at `indices`, without strata"""
+        return SurvivalCohort(
+            durations=self.durations[indices],
+            events=self.events[indices],
+            case_ids=self.case_ids[indices],
+            submitter_ids=self.submitter_ids[indices],
+            project_id_codes=self.project_id_codes[indices],
+            project_ids=self.project_ids,
+            keys=None if self.keys is None else self.keys[indices],
+        )
+
+    def stratify(self) -> List[Tuple[Any, "SurvivalCohort"]]:
+        """
+        Partition the cohort by stratum, in a single pass over the strata codes.
+
+        Returns:
+            list of (stratum value, sub-cohort), sorted by stratum value (numbers
+            numerically, before strings), with the cases that have no value for the
+            stratification field last
+        """
+        if self.strata_codes is None or self.strata is None:
+            raise ValueError("The cohort was not fetched with a stratification field")
+
+        # rows grouped by code; the stable sort keeps the rows' order within a stratum
+        order = np.argsort(self.strata_codes, kind="stable")
+        counts = np.bincount(self.strata_codes, minlength=len(self.strata.values))
+        bounds = np.concatenate(([0], np.cumsum(counts)))
+        codes = sorted(
+            range(len(self.strata.values)),
+            key=lambda code: stratum_sort_key(self.strata.values[code]),
+        )
+        return [
+            (
+                self.strata.values[code],
+                self.take(order[bounds[code] : bounds[code + 1]]),
+            )
+            for code in codes
+            if counts[code]
+        ]
+
+
+def stratum_sort_key(value: Any) -> Tuple[int, float, str]:
+    if value is None:
+        return (2, 0, "")
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (0, value, "")
+    return (1, 0, str(value))
+
+
+def scalar_value(document: Optional[Dict[str, Any]], props: List[str]) -> Any:
+    """
+    Return `nested_value(document, props)`, or raise ValueError if it is not a scalar
+    (e.g. `props` is the path of an object field)
+    """
+    value = nested_value(document, props)
+    if not isinstance(value, (str, int, float, bool, type(None))):
+        raise ValueError(f"'{'.'.join(props)}' is not a field with scalar values")
+    return value
+
+
+def nested_value(document: Optional[Dict[str, Any]], props: List[str]) -> Any:
+    """
+    Return the value at the path `props` in a Guppy document. Like the survival fields,
+    nested documents are lists, of which the first item is used.
+    """
+    value: Any = document
+    for prop in props:
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if not isinstance(value, dict):
+            return None
+        value = value.get(prop)
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return value
+
+
+class SurvivalAccumulator:
+    """
+    Parse Guppy `case` documents straight into typed arrays, page by page, so that only
+    one page of Guppy JSON needs to be held in memory at a time.
+
+    The duration of a case is `demographic.days_to_death` if available, otherwise
+    `diagnoses.days_to_last_follow_up`. The event is 1 unless `vital_status` is
+    "alive". Cases without demographic data or without a valid duration are dropped.
+
+    If `strata_props` is set (e.g. `["demographic", "gender"]`), the value of that field
+    is also collected, dictionary-encoded, so that the cohort can be stratified. If
+    `key_props` is set, the value of that field is collected as the `keys` column.
+    These fields must have scalar values, otherwise `add_page` raises ValueError.
+    """
+
+    def __init__(
+        self,
+        strata_props: Optional[List[str]] = None,
+        key_props: Optional[List[str]] = None,
+    ):
+        self._chunks: List[Tuple[np.ndarray, ...]] = []
+        self.project_ids = StringDictionary()
+        self.strata_props = strata_props
+        self.strata = StringDictionary() if strata_props else None
+        self.key_props = key_props
+
+    def add_page(self, cases: List[Dict[str, Any]]) -> None:
+        n_cases = len(cases)
+        durations = np.empty(n_cases, dtype=np.float64)
+        events = np.empty(n_cases, dtype=np.int8)
+        case_ids = np.empty(n_cases, dtype=object)
+        submitter_ids = np.empty(n_cases, dtype=object)
+        project_id_codes = np.empty(n_cases, dtype=np.int32)
+        strata_codes = np.empty(n_cases if self.strata else 0, dtype=np.int32)
+        keys = np.empty(n_cases if self.key_props else 0, dtype=object)
+
+        row = 0
+        for case in cases:
+            # a list in GraphQL documents, an object in the `/download` documents of
+            # cases with a single demographic
+            demo = nested_value(case, ["demographic"])
+            if not isinstance(demo, dict):
+                continue
+
+            # use days_to_death if available, otherwise use days_to_last_follow_up
+            duration = demo.get("days_to_death")
+            if duration is None:
+                duration = nested_value(case, ["diagnoses", "days_to_last_follow_up"])
+                if duration is None:
+                    continue
+            try:
+                duration = float(duration)
+            except (TypeError, ValueError):
+                continue
+            if duration != duration:  # NaN
+                continue
+
+            durations[row] = duration
+            events[row] = (demo.get("vital_status") or "").lower() != "alive"
+            case_ids[row] = case.get("_case_id")
+            submitter_ids[row] = case.get("submitter_id")
+            project_id_codes[row] = self.project_ids.encode(case.get("project_id"))
+            if self.strata:
+                strata_codes[row] = self.strata.encode(
+                    scalar_value(case, self.strata_props)
+                )
+            if self.key_props:
+                keys[row] = scalar_value(case, self.key_props)
+            row += 1
+
+        if row:
+            self._chunks.append(
+                (
+                    durations[:row],
+                    events[:row],
+                    case_ids[:row],
+                    submitter_ids[:row],
+                    project_id_codes[:row],
+                    strata_codes[:row],
+                    keys[:row],
+                )
+            )
+
+    def finalize(self) -> SurvivalCohort:
+        if len(self._chunks) == 1:
+            columns = self._chunks[0]
+        elif self._chunks:
+            columns = tuple(np.concatenate(column) for column in zip(*self._chunks))
+        else:
+            columns = (
+                np.empty(0, dtype=np.float64),
+                np.empty(0, dtype=np.int8),
+                np.empty(0, dtype=object),
+                np.empty(0, dtype=object),
+                np.empty(0, dtype=np.int32),
+                np.empty(0, dtype=np.int32),
+                np.empty(0, dtype=object),
+            )
+        self._chunks = []
+        *columns, strata_codes, keys = columns
+        return SurvivalCohort(
+            *columns,
+            project_ids=self.project_ids,
+            strata_codes=strata_codes if self.strata else None,
+            strata=self.strata,
+            keys=keys if self.key_props else None,
+        )
+
+
+def _histogram_counts(
+    buckets: List[Dict[str, Any]], timeline: np.ndarray
+) -> np.ndarray:
+    """
+    Return the counts of a Guppy histogram at each time of `timeline`. Range buckets
+    (`"key": [start, end]`) are counted at their start.
+    """
+    counts = np.zeros(len(timeline))
+    if buckets:
+        times = [
+            bucket["key"][0] if isinstance(bucket["key"], list) else bucket["key"]
+            for bucket in buckets
+        ]
+        np.add.at(
+            counts,
+            np.searchsorted(timeline, np.asarray(times, dtype=np.float64)),
+            [bucket["count"] for bucket in buckets],
+        )
+    return counts
+
+
+def survival_table_from_histograms(
+    death: List[Dict[str, Any]],
+    death_alive: List[Dict[str, Any]],
+    follow_up: List[Dict[str, Any]],
+    follow_up_alive: List[Dict[str, Any]],
+    follow_up_death: List[Dict[str, Any]],
+    follow_up_death_alive: List[Dict[str, Any]],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Rebuild the (duration, event, number of cases) table of a cohort from Guppy
+    histograms, following the rules of `SurvivalAccumulator` as closely as Guppy
+    filters allow:
+
+    - cases with a positive `days_to_death` use it as duration. They are counted by the
+      `death` histogram of `days_to_death`, and `death_alive` for the ones whose
+      `vital_status` is "alive" (censored);
+    - the other cases use `days_to_last_follow_up`. Their histogram is the `follow_up`
+      histogram of all the cases with a `days_to_last_follow_up`, minus the
+      `follow_up_death` histogram of the ones that also have a `days_to_death`; same
+      for the alive cases with `follow_up_alive` and `follow_up_death_alive`.
+
+    The histograms must count each case once: with several `days_to_last_follow_up`
+    values per case (nested histograms count every diagnosis), they are inconsistent.
+
+    Since they are built from filters, the curves differ from those of
+    `SurvivalAccumulator` for some cases:
+
+    - a case with a `days_to_death` <= 0 and a positive `days_to_last_follow_up` is
+      counted at its follow-up time, instead of its `days_to_death`;
+    - a case without demographic is counted as a death at its follow-up time, instead
+      of being dropped;
+    - a case is censored only if its `vital_status` is "Alive" or "alive", instead of
+      any casing of "alive".
+
+    Returns:
+        (durations, events, counts): one row per (time, event) with a non-zero count
+
+    Raises:
+        ValueError: if the histograms are not consistent with one value per case
+    """
+    histograms = [
+        death,
+        death_alive,
+        follow_up,
+        follow_up_alive,
+        follow_up_death,
+        follow_up_death_alive,
+    ]
+    timeline = np.unique(
+        np.asarray(
+            [
+                bucket["key"][0] if isinstance(bucket["key"], list) else bucket["key"]
+                for buckets in histograms
+                for bucket in buckets or []
+            ],
+            dtype=np.float64,
+        )
+    )
+    (
+        death,
+        death_alive,
+        follow_up,
+        follow_up_alive,
+        follow_up_death,
+        follow_up_death_alive,
+    ) = (_histogram_counts(buckets, timeline) for buckets in histograms)
+
+    follow_up_only = follow_up - follow_up_death
+    follow_up_only_alive = follow_up_alive - follow_up_death_alive
+    # each histogram counts a subset of the cases of the one it is subtracted from
+    if (
+        (death_alive > death).any()
+        or (follow_up_only < 0).any()
+        or (follow_up_only_alive < 0).any()
+        or (follow_up_only_alive > follow_up_only).any()
+    ):
+        raise ValueError("The histograms count some cases more than once")
+    deaths = death - death_alive + follow_up_only - follow_up_only_alive
+    censored = death_alive + follow_up_only_alive
+
+    durations = np.concatenate((timeline, timeline))
+    events = np.repeat(np.array([1, 0], dtype=np.int8), len(timeline))
+    counts = np.concatenate((deaths, censored))
+    keep = counts > 0
+    return durations[keep], events[keep], counts[keep]
+
+
+@dataclass
+class KaplanMeierEstimate:
+    """
+    Kaplan-Meier survival curve, as aligned arrays with one entry per time point.
+
+    Like lifelines, the timeline starts at time 0 (where everyone is at risk), followed
+    by each distinct duration.
+    """
+
+    timeline: np.ndarray
+    at_risk: np.ndarray
+    events: np.ndarray
+    censored: np.ndarray
+    survival: np.ndarray
+    # Greenwood's cumulative sum of d / (n * (n - d)), used for the confidence intervals
+    variance: np.ndarray
+
+    def confidence_interval(self, alpha: float = 0.05) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the (lower, upper) bounds of the survival estimate, computed with the
+        exponential Greenwood formula (same as lifelines).
+        """
+        z = NormalDist().inv_cdf(1 - alpha / 2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            v = np.log(self.survival)
+            spread = z * np.sqrt(self.variance) / v
+            lower = np.exp(-np.exp(np.log(-v) - spread))
+            upper = np.exp(-np.exp(np.log(-v) + spread))
+        return np.nan_to_num(lower, nan=1.0), np.nan_to_num(upper, nan=1.0)
+
+
+def kaplan_meier(
+    durations: np.ndarray,
+    events: np.ndarray,
+    weights: Optional[np.ndarray] = None,
+) -> KaplanMeierEstimate:
+    """
+    Fit a Kaplan-Meier estimator: count the deaths and censorings at each distinct
+    duration, then take the cumulative product of the conditional survival
+    probabilities.
+
+    The arithmetic follows lifelines' `KaplanMeierFitter` so both return the same
+    values.
+
+    Args:
+        durations (np.ndarray): duration of each observation
+        events (np.ndarray): 1 if the observation is a death, 0 if it is censored
+        weights (np.ndarray): optional number of cases each observation stands for
+
+    Returns:
+        KaplanMeierEstimate
+    """
+    durations = np.asarray(durations, dtype=np.float64)
+    events = np.asarray(events)
+    weights = (
+        np.ones(len(durations)) if weights is None else np.asarray(weights, dtype=float)
+    )
+
+    timeline = np.unique(durations)
+    if not len(timeline) or timeline[0] > 0:
+        timeline = np.concatenate(([0.0], timeline))
+    steps = np.searchsorted(timeline, durations)
+    removed = np.bincount(steps, weights=weights, minlength=len(timeline))
+    observed = np.bincount(
+        steps, weights=np.where(events == 1, weights, 0.0), minlength=len(timeline)
+    )
+    at_risk = weights.sum() - np.concatenate(([0.0], np.cumsum(removed)[:-1]))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_survival = np.cumsum(np.log(at_risk - observed) - np.log(at_risk))
+        variance = observed / (at_risk * (at_risk - observed))
+    variance[np.isinf(variance)] = 0
+    return KaplanMeierEstimate(
+        timeline=timeline,
+        at_risk=at_risk,
+        events=observed,
+        censored=removed - observed,
+        survival=np.exp(log_survival),
+        variance=np.cumsum(variance),
+    )
+
+
+def kaplan_meier_lifelines(
+    durations: np.ndarray,
+    events: np.ndarray,
+    weights: Optional[np.ndarray] = None,
+) -> KaplanMeierEstimate:
+    """
+    Reference implementation of `kaplan_meier`, using lifelines' `KaplanMeierFitter`.
+    """
+    from lifelines import KaplanMeierFitter
+
+    kmf = KaplanMeierFitter()
+    kmf.fit(
+        durations=durations,
+        event_observed=events,
+        weights=weights,
+        label="Survival Curve",
+    )
+    event_table = kmf.event_table
+    return KaplanMeierEstimate(
+        timeline=kmf.survival_function_.index.to_numpy(dtype=float),
+        at_risk=event_table["at_risk"].to_numpy(dtype=float),
+        events=event_table["observed"].to_numpy(dtype=float),
+        censored=event_table["censored"].to_numpy(dtype=float),
+        survival=kmf.survival_function_.iloc[:, 0].to_numpy(),
+        variance=kmf._cumulative_sq_.to_numpy(),
+    )
+
+
+def fit_kaplan_meier(
+    durations: np.ndarray,
+    events: np.ndarray,
+    weights: Optional[np.ndarray] = None,
+) -> KaplanMeierEstimate:
+    """Fit a Kaplan-Meier estimator with the implementation selected in the config"""
+    if config.SURVIVAL_ESTIMATOR == "lifelines":
+        return kaplan_meier_lifelines(durations, events, weights)
+    return kaplan_meier(durations, events, weights)
+
+
+@dataclass
+class LogRankResult:
+    statistic: float
+    p_value: float
+    degrees_of_freedom: int
+    # (group_a, group_b, p-value) for each pair of groups
+    pairwise: List[Tuple[int, int, float]]
+
+
+def _fleming_harrington_weights(
+    n_at_risk: np.ndarray, n_events: np.ndarray, p: float, q: float
+) -> np.ndarray:
+    """
+    Fleming-Harrington weights S(t-)^p * (1 - S(t-))^q, where S(t-) is the
+    left-continuous Kaplan-Meier estimate of the pooled groups. Computed along the
+    first axis, so several poolings can be weighted at once.
+    """
+    if p == 0 and q == 0:
+        return np.ones(n_at_risk.shape)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_steps = np.log(n_at_risk - n_events) - np.log(n_at_risk)
+    survival = np.exp(np.cumsum(log_steps, axis=0))
+    left_survival = np.concatenate((np.ones((1,) + survival.shape[1:]), survival[:-1]))
+    return np.power(left_survival, p) * np.power(1.0 - left_survival, q)
+
+
+def logrank_test(
+    durations: np.ndarray,
+    events: np.ndarray,
+    groups: np.ndarray,
+    n_groups: int,
+    p: float = 0,
+    q: float = 0,
+    counts: Optional[np.ndarray] = None,
+) -> LogRankResult:
+    """
+    Multi-group log-rank test, with optional Fleming-Harrington weights, along with the
+    two-group test of every pair of groups.
+
+    The per-time, per-group death and at-risk tables are built once with `bincount`
+    and shared by the overall and the pairwise tests. With p = q = 0 (the default),
+    this is the standard log-rank test, same as lifelines' `multivariate_logrank_test`.
+
+    Args:
+        durations (np.ndarray): duration of each observation
+        events (np.ndarray): 1 if the observation is a death, 0 if it is censored
+        groups (np.ndarray): group index of each observation, in [0, n_groups)
+        n_groups (int): number of groups
+        p (float): Fleming-Harrington weight exponent of S(t-)
+        q (float): Fleming-Harrington weight exponent of 1 - S(t-)
+        counts (np.ndarray): optional number of cases each observation stands for
+
+    Returns:
+        LogRankResult
+    """
+    if p < 0 or q < 0:
+        raise ValueError("Fleming-Harrington weights p and q must be non-negative")
+
+    timeline, steps = np.unique(durations, return_inverse=True)
+    cells = steps * n_groups + groups
+    size = len(timeline) * n_groups
+    if counts is None:
+        counts = np.ones(len(durations))
+    removed = np.bincount(cells, weights=counts, minlength=size).reshape(-1, n_groups)
+    observed = np.bincount(
+        cells, weights=np.where(events == 1, counts, 0), minlength=size
+    ).reshape(-1, n_groups)
+    # number of observations at risk right before each time point, per group
+    at_risk = removed.sum(0) - np.cumsum(removed, axis=0) + removed
+
+    # overall test
+    n_at_risk = at_risk.sum(1)
+    n_events = observed.sum(1)
+    weights = _fleming_harrington_weights(n_at_risk, n_events, p, q)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = at_risk * (n_events / n_at_risk)[:, None]
+        factor = np.where(n_at_risk > 1, (n_at_risk - n_events) / (n_at_risk - 1), 1)
+        factor = np.nan_to_num(weights**2 * factor * n_events / n_at_risk**2)
+    z = (weights[:, None] * (observed - expected)).sum(0)
+    variance = np.diag((factor[:, None] * at_risk * n_at_risk[:, None]).sum(0))
+    variance -= (factor[:, None] * at_risk).T @ at_risk
+    statistic = float(z[:-1] @ np.linalg.pinv(variance[:-1, :-1]) @ z[:-1])
+
+    # pairwise two-group tests, all pairs at once
+    pair_a, pair_b = np.triu_indices(n_groups, k=1)
+    pair_at_risk = at_risk[:, pair_a] + at_risk[:, pair_b]
+    pair_events = observed[:, pair_a] + observed[:, pair_b]
+    pair_weights = _fleming_harrington_weights(pair_at_risk, pair_events, p, q)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pair_z = pair_weights * (
+            observed[:, pair_a] - at_risk[:, pair_a] * pair_events / pair_at_risk
+        )
+        pair_variance = (
+            pair_weights**2
+            * at_risk[:, pair_a]
+            * at_risk[:, pair_b]
+            * pair_events
+            * (pair_at_risk - pair_events)
+            / (pair_at_risk**2 * (pair_at_risk - 1))
+        )
+        pair_variance = np.nansum(pair_variance, 0)
+        # a pair of groups without events doesn't differ: statistic 0, p-value 1
+        pair_statistics = np.where(
+            pair_variance > 0, np.nansum(pair_z, 0) ** 2 / pair_variance, 0.0
+        )
+
+    return LogRankResult(
+        statistic=statistic,
+        p_value=float(chdtrc(n_groups - 1, statistic)),
+        degrees_of_freedom=n_groups - 1,
+        pairwise=list(
+            zip(
+                pair_a.tolist(),
+                pair_b.tolist(),
+                chdtrc(1, pair_statistics).tolist(),
+            )
+        ),
+    )
+
+
+def logrank_test_lifelines(
+    durations: np.ndarray,
+    events: np.ndarray,
+    groups: np.ndarray,
+    n_groups: int,
+    p: float = 0,
+    q: float = 0,
+) -> LogRankResult:
+    """
+    Reference implementation of `logrank_test`, using lifelines.
+    """
+    from lifelines.statistics import multivariate_logrank_test, pairwise_logrank_test
+
+    kwargs = {}
+    if p or q:
+        kwargs = {"weightings": "fleming-harrington", "p": p, "q": q}
+    overall = multivariate_logrank_test(durations, groups, events, **kwargs)
+    pairwise = pairwise_logrank_test(durations, groups, events, **kwargs).summary
+    return LogRankResult(
+        statistic=float(overall.test_statistic),
+        p_value=float(overall.p_value),
+        degrees_of_freedom=n_groups - 1,
+        pairwise=[
+            (int(a), int(b), float(pairwise.loc[(a, b), "p"]))
+            for a, b in zip(*np.triu_indices(n_groups, k=1))
+        ],
+    )
+
+
+def compare_survival(
+    durations: np.ndarray,
+    events: np.ndarray,
+    groups: np.ndarray,
+    n_groups: int,
+    p: float = 0,
+    q: float = 0,
+    counts: Optional[np.ndarray] = None,
+) -> LogRankResult:
+    """Run a log-rank test with the implementation selected in the config"""
+    if config.SURVIVAL_ESTIMATOR == "lifelines":
+        if counts is not None:
+            # lifelines' pairwise test doesn't support weights: expand the rows instead
+            repeats = counts.astype(np.int64)
+            durations, events, groups = (
+                np.repeat(durations, repeats),
+                np.repeat(events, repeats),
+                np.repeat(groups, repeats),
+            )
+        return logrank_test_lifelines(durations, events, groups, n_groups, p, q)
+    return logrank_test(durations, events, groups, n_groups, p, q, counts)
+
+
+def donor_survival_estimates(
+    timeline: np.ndarray,
+    survival: np.ndarray,
+    durations: np.ndarray,
+    events: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Join each donor to the step of the survival curve at which it leaves the study.
+
+    Donors are ordered by duration; donors sharing a duration keep their input order.
+    A donor who died uses the survival estimate of the previous step (i.e. the
+    probability right before the death), or 1.0 if there is no previous step. A
+    censored donor uses the estimate of its own step.
+
+    Args:
+        timeline (np.ndarray): sorted time points of the fitted curve
+        survival (np.ndarray): survival estimate at each time point of `timeline`
+        durations (np.ndarray): duration of each donor
+        events (np.ndarray): 1 if the donor died, 0 if it was censored
+
+    Returns:
+        tuple: (order, estimates) - `order` holds the donor indices sorted by duration,
+            `estimates` holds the survival estimate of each donor in that order
+    """
+    order = np.argsort(durations, kind="stable")
+    steps = np.searchsorted(timeline, durations[order])
+
+    # value of the step before each donor's step, 1.0 before the first step
+    previous = np.concatenate(([1.0], survival[:-1]))
+    estimates = np.where(events[order] == 1, previous[steps], survival[steps])
+
+    return order, estimates
+
+
+def build_donors(
+    order: np.ndarray,
+    estimates: np.ndarray,
+    durations: np.ndarray,
+    events: np.ndarray,
+    case_ids: np.ndarray,
+    submitter_ids: np.ndarray,
+    project_ids: np.ndarray,
+) -> List[Dict]:
+    """
+    Build the `donors` list of a survival curve response.
+
+    Args:
+        order (np.ndarray): donor indices, as returned by `donor_survival_estimates`
+        estimates (np.ndarray): survival estimate of each donor, in `order`
+        durations (np.ndarray): duration of each donor
+        events (np.ndarray): 1 if the donor died, 0 if it was censored
+        case_ids (np.ndarray): `_case_id` of each donor
+        submitter_ids (np.ndarray): `submitter_id` of each donor
+        project_ids (np.ndarray): `project_id` of each donor
+
+    Returns:
+        list: one dict per donor, sorted by time
+    """
+    return [
+        {
+            "time": time,
+            "id": case_id,
+            "submitter_id": submitter_id,
+            "project_id": project_id,
+            "survivalEstimate": estimate,
+            "censored": censored,
+        }
+        for time, case_id, submitter_id, project_id, estimate, censored in zip(
+            durations[order].astype(np.int64).tolist(),
+            case_ids[order].tolist(),
+            submitter_ids[order].tolist(),
+            project_ids[order].tolist(),
+            estimates.astype(np.float64).tolist(),
+            (events[order] != 1).tolist(),
+        )
+    ]
+
+
+def _as_json_numbers(values: np.ndarray) -> list:
+    """Convert an array of counts or times to a list, using ints for integral values"""
+    if np.all(np.mod(values, 1) == 0):
+        return values.astype(np.int64).tolist()
+    return values.tolist()
+
+
+@dataclass
+class SurvivalCurve:
+    """A cohort and its fitted Kaplan-Meier curve"""
+
+    cohort: SurvivalCohort
+    estimate: KaplanMeierEstimate
+    # returned along with the curve, e.g. the stratum value of a stratified curve
+    meta: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def durations(self) -> np.ndarray:
+        return self.cohort.durations
+
+    @property
+    def events(self) -> np.ndarray:
+        return self.cohort.events
+
+    @property
+    def counts(self) -> Optional[np.ndarray]:
+        return self.cohort.counts
+
+    def donors(self) -> List[Dict]:
+        """Return one dict per donor, with its survival estimate, sorted by time"""
+        return next(self.iter_donor_chunks(chunk_size=self.cohort.size or 1), [])
+
+    def iter_donor_chunks(self, chunk_size: int) -> Iterator[List[Dict]]:
+        """
+        Yield the donors (see `donors`) in chunks of at most `chunk_size`, so that the
+        donor dicts of a large cohort don't all need to be in memory at once.
+        """
+        order, estimates = donor_survival_estimates(
+            timeline=self.estimate.timeline,
+            survival=self.estimate.survival,
+            durations=self.durations,
+            events=self.events,
+        )
+        project_ids = self.cohort.project_ids.decode(self.cohort.project_id_codes)
+        for start in range(0, len(order), chunk_size):
+            yield build_donors(
+                order[start : start + chunk_size],
+                estimates[start : start + chunk_size],
+                durations=self.durations,
+                events=self.events,
+                case_ids=self.cohort.case_ids,
+                submitter_ids=self.cohort.submitter_ids,
+                project_ids=project_ids,
+            )
+
+    def steps(self, confidence_level: Optional[float] = None) -> Dict[str, list]:
+        """
+        Return the distinct steps of the curve as parallel lists: time, survival
+        estimate, number at risk, number of events and number censored at each time
+        point, and optionally the bounds of the confidence interval.
+        """
+        estimate = self.estimate
+        steps = {
+            "time": _as_json_numbers(estimate.timeline),
+            "survival": estimate.survival.tolist(),
+            "atRisk": _as_json_numbers(estimate.at_risk),
+            "events": _as_json_numbers(estimate.events),
+            "censored": _as_json_numbers(estimate.censored),
+        }
+        if confidence_level:
+            lower, upper = estimate.confidence_interval(alpha=1 - confidence_level)
+            steps["lower"] = lower.tolist()
+            steps["upper"] = upper.tolist()
+        return steps
@@ -0,0 +1,151 @@
+import asyncio
+
+from fastapi import HTTPException
+import pytest
+
+from gen3analysis.utils.backpressure import AdaptiveLimiter, CircuitBreaker, RetryBudget
+
+
+def make_limiter(initial_limit=2):
+    return AdaptiveLimiter(
+        name="test",
+        initial_limit=initial_limit,
+        min_limit=1,
+        max_limit=4,
+        latency_target=10,
+    )
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_queues_requests_over_the_limit():
+    limiter = make_limiter()
+    first = await limiter.acquire()
+    await limiter.acquire()
+
+    third = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    assert not third.done()
+    assert limiter.in_flight == 2
+
+    limiter.release(first, overloaded=False)
+    await asyncio.wait_for(third, 1)
+    assert limiter.in_flight == 2
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_cancelled_waiter_does_not_leak_slot():
+    limiter = make_limiter(initial_limit=1)
+    start = await limiter.acquire()
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    limiter.release(start, overloaded=False)
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_aimd():
+    limiter = make_limiter()
+
+    # additive increase: about +1 per `limit` successful requests
+    for _ in range(3):
+        limiter.release(await limiter.acquire(), overloaded=False)
+    assert 3 <= limiter.limit < 3.5
+
+    # multiplicative decrease, once for the requests sent before the decrease
+    starts = [await limiter.acquire() for _ in range(3)]
+    for start in starts:
+        limiter.release(start, overloaded=True)
+    assert 1.5 <= limiter.limit < 1.75
+
+    # slow responses also decrease the limit, down to `min_limit`
+    limiter.latency_target = 0
+    for _ in range(3):
+        limiter.release(await limiter.acquire(), overloaded=False)
+    assert limiter.limit == 1
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(
+        "gen3analysis.utils.backpressure.time.monotonic", lambda: now[0]
+    )
+    breaker = CircuitBreaker(name="test", failure_threshold=2, reset_timeout=30)
+
+    breaker.check()
+    breaker.record(True)
+    breaker.check()
+    breaker.record(False)
+    # failures must be consecutive
+    breaker.check()
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.check()
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # fail fast while open
+    with pytest.raises(HTTPException) as e:
+        breaker.check()
+    assert e.value.status_code == 503
+
+    # a single trial request once the reset timeout has passed
+    now[0] = 31
+    assert breaker.check()
+    with pytest.raises(HTTPException):
+        breaker.check()
+    breaker.record(True, trial=True)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    now[0] = 62
+    assert breaker.check()
+    breaker.record(False, trial=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert not breaker.check()
+
+
+def test_circuit_breaker_ignores_requests_sent_before_opening(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(
+        "gen3analysis.utils.backpressure.time.monotonic", lambda: now[0]
+    )
+    breaker = CircuitBreaker(name="test", failure_threshold=1, reset_timeout=30)
+    slow = breaker.check()
+    breaker.record(True, breaker.check())
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # a request sent before the circuit opened doesn't close it
+    breaker.record(False, slow)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    now[0] = 31
+    trial = breaker.check()
+    breaker.record(False, slow)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # nor does it release the trial
+    with pytest.raises(HTTPException):
+        breaker.check()
+
+    breaker.record(True, trial)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_circuit_breaker_disabled():
+    breaker = CircuitBreaker(name="test", failure_threshold=0, reset_timeout=30)
+    for _ in range(10):
+        breaker.check()
+        breaker.record(True)
+    breaker.check()
+
+
+def test_retry_budget():
+    budget = RetryBudget(name="test", ratio=0.5, max_tokens=2)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
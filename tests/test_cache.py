@@ -0,0 +1,60 @@
+from unittest.mock import patch
+
+from gen3analysis.utils.cache import (
+    MISSING,
+    TTLCache,
+    access_scope,
+    canonical_hash,
+)
+
+
+def test_canonical_hash_ignores_key_order():
+    assert canonical_hash({"a": 1, "b": [1, {"c": 2, "d": 3}]}) == canonical_hash(
+        {"b": [1, {"d": 3, "c": 2}], "a": 1}
+    )
+    assert canonical_hash({"a": 1}) != canonical_hash({"a": 2})
+
+
+def test_access_scope():
+    assert access_scope(None) == access_scope("") == "anonymous"
+    assert access_scope("token1") != access_scope("token2")
+    assert "token1" not in access_scope("token1")
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(name="test", max_entries=2, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "b" is now the least recently used
+    cache.set("c", 3)
+
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_ttl_cache_evicts_by_weight():
+    cache = TTLCache(
+        name="test", max_entries=10, ttl_seconds=60, max_weight=10, weigher=len
+    )
+    cache.set("a", [0] * 4)
+    cache.set("b", [0] * 4)
+    cache.set("c", [0] * 4)
+    assert cache.get("a") is MISSING
+    assert len(cache) == 2
+
+    # bigger than the whole cache: not cached
+    cache.set("d", [0] * 11)
+    assert cache.get("d") is MISSING
+    assert len(cache) == 2
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(name="test", max_entries=10, ttl_seconds=60)
+    with patch("gen3analysis.utils.cache.time.monotonic", return_value=1000):
+        cache.set("a", None)
+        assert cache.get("a") is None
+    with patch("gen3analysis.utils.cache.time.monotonic", return_value=1060):
+        assert cache.get("a") is MISSING
+    assert len(cache) == 0
@@ -1,8 +1,12 @@
+import asyncio
 import json
 
+from fastapi import HTTPException
 import pytest
 
 from conftest import TEST_ACCESS_TOKEN, TEST_PROJECT_ID
+from gen3analysis import config
+from gen3analysis.routes.compare import shared_range
 from tests.utils import mock_guppy_data
 
 cohort1 = {
@@ -130,6 +134,7 @@ async def test_compare_facets_endpoint(app, client):
         query="query ($cohort1: JSON, $cohort2: JSON){\n        cohort1: _aggregation {\n            case (filter: $cohort1, accessibility: accessible) { project_id { histogram { key count } } demographic { ethnicity { histogram { key count } } } abc { def { ghi { histogram { key count } } } } diagnoses { age_at_diagnosis { histogram(rangeStep: 3652) { key count } } }  }\n        }\n        cohort2: _aggregation {\n            case (filter: $cohort2, accessibility: accessible) { project_id { histogram { key count } } demographic { ethnicity { histogram { key count } } } abc { def { ghi { histogram { key count } } } } diagnoses { age_at_diagnosis { histogram(rangeStep: 3652) { key count } } }  }\n        }\n    }",
         variables={"cohort1": cohort1, "cohort2": cohort2},
         retry_count=1,
+        cacheable=True,
     )
 
     assert res.json() == {
@@ -184,6 +189,427 @@ async def test_compare_facets_endpoint(app, client):
     }
 
 
+@pytest.mark.asyncio
+async def test_compare_facets_endpoint_facet_groups(app, client, monkeypatch):
+    monkeypatch.setattr(config, "COMPARE_FACET_GROUP_SIZE", 2)
+
+    def histograms(facets, count):
+        return {
+            f"cohort{i}": {
+                "case": {
+                    facet: {"histogram": [{"key": "key1", "count": count * i}]}
+                    for facet in facets
+                }
+            }
+            for i in [1, 2]
+        }
+
+    mock_guppy_data(
+        app,
+        [
+            {"data": histograms(["project_id", "gender"], 10)},
+            {"data": histograms(["race"], 20)},
+        ],
+    )
+
+    body = {
+        "doc_type": "case",
+        "cohort1": cohort1,
+        "cohort2": cohort2,
+        "facets": ["project_id", "gender", "race"],
+    }
+    res = await client.post(
+        "/compare/facets",
+        json=body,
+        cookies={"access_token": TEST_ACCESS_TOKEN},
+    )
+    assert res.status_code == 200, res.json()
+
+    # one query per group of facets
+    queries = [
+        call.kwargs["query"] for call in app.state.guppy_client.execute.call_args_list
+    ]
+    assert len(queries) == 2
+    assert "gender" in queries[0] and "race" not in queries[0]
+    assert "race" in queries[1] and "gender" not in queries[1]
+
+    # the groups are merged, in the requested order
+    assert res.json() == {
+        f"cohort{i}": {
+            "facets": {
+                "project_id": {"buckets": [{"key": "key1", "count": 10 * i}]},
+                "gender": {"buckets": [{"key": "key1", "count": 10 * i}]},
+                "race": {"buckets": [{"key": "key1", "count": 20 * i}]},
+            }
+        }
+        for i in [1, 2]
+    }
+    assert list(res.json()["cohort1"]["facets"]) == ["project_id", "gender", "race"]
+
+    timings = res.headers["Server-Timing"].split(", ")
+    assert len(timings) == 2
+    assert timings[1].startswith("facets-1;dur=")
+    assert timings[1].endswith(';desc="race"')
+
+
+@pytest.mark.asyncio
+async def test_compare_facets_endpoint_cancels_groups_on_error(
+    app, client, monkeypatch
+):
+    monkeypatch.setattr(config, "COMPARE_FACET_GROUP_SIZE", 1)
+    cancelled = asyncio.Event()
+
+    async def execute(query, **kwargs):
+        if "gender" in query:
+            raise HTTPException(status_code=400, detail="invalid facet")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    mock_guppy_data(app, [])
+    app.state.guppy_client.execute.side_effect = execute
+
+    res = await client.post(
+        "/compare/facets",
+        json={
+            "doc_type": "case",
+            "cohort1": cohort1,
+            "cohort2": cohort2,
+            "facets": ["project_id", "gender"],
+        },
+        cookies={"access_token": TEST_ACCESS_TOKEN},
+    )
+    assert res.status_code == 400, res.json()
+    # the query of the other group does not keep running
+    assert cancelled.is_set()
+
+
+@pytest.mark.asyncio
+async def test_compare_facets_endpoint_n_cohorts(app, client, monkeypatch):
+    monkeypatch.setattr(config, "COMPARE_COHORTS_PER_QUERY", 2)
+    cohort3 = {"=": {"project_id": "other-project"}}
+
+    def histograms(cohorts):
+        return {
+            "data": {
+                alias: {"case": {"gender": {"histogram": [{"key": "f", "count": n}]}}}
+                for alias, n in cohorts.items()
+            }
+        }
+
+    mock_guppy_data(
+        app, [histograms({"cohort1": 1, "cohort2": 2}), histograms({"cohort3": 3})]
+    )
+
+    body = {
+        "doc_type": "case",
+        # `cohort1` is requested twice but only aggregated once
+        "cohorts": [cohort1, cohort2, cohort1, cohort3],
+        "facets": ["gender"],
+    }
+    res = await client.post(
+        "/compare/facets",
+        json=body,
+        cookies={"access_token": TEST_ACCESS_TOKEN},
+    )
+    assert res.status_code == 200, res.json()
+
+    calls = app.state.guppy_client.execute.call_args_list
+    assert [call.kwargs["variables"] for call in calls] == [
+        {"cohort1": cohort1, "cohort2": cohort2},
+        {"cohort3": cohort3},
+    ]
+    assert calls[1].kwargs["query"].startswith("query ($cohort3: JSON){")
+    assert res.json() == {
+        "cohorts": [
+            {"facets": {"gender": {"buckets": [{"key": "f", "count": n}]}}}
+            for n in [1, 2, 1, 3]
+        ]
+    }
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "cohorts",
+    [
+        {},
+        {"cohort1": cohort1},
+        {"cohorts": []},
+        {"cohorts": [cohort1], "cohort1": cohort1},
+        # statistics compare 2 cohorts
+        {"cohorts": [cohort1, cohort2], "statistics": True},
+        # bins of a facet with an interval
+        {
+            "cohort1": cohort1,
+            "cohort2": cohort2,
+            "bins": {"gender": 10},
+            "interval": {"gender": 10},
+        },
+    ],
+)
+async def test_compare_facets_endpoint_invalid_cohorts(app, client, cohorts):
+    mock_guppy_data(app, [])
+    res = await client.post(
+        "/compare/facets",
+        json={"doc_type": "case", "facets": ["gender"], **cohorts},
+        cookies={"access_token": TEST_ACCESS_TOKEN},
+    )
+    assert res.status_code == 400, res.json()
+    app.state.guppy_client.execute.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_compare_facets_endpoint_statistics(app, client):
+    mock_guppy_data(
+        app,
+        [
+            {
+                "data": {
+                    alias: {
+                        "case": {
+                            "gender": {
+                                "histogram": [
+                                    {"key": "female", "count": female},
+                                    {"key": "male", "count": 100 - female},
+                                ]
+                            }
+                        }
+                    }
+                    for alias, female in [("cohort1", 40), ("cohort2", 70)]
+                }
+            }
+        ],
+    )
+
+    body = {
+        "doc_type": "case",
+        "cohort1": cohort1,
+        "cohort2": cohort2,
+        "facets": ["gender"],
+        "statistics": True,
+        "correction": "bonferroni",
+    }
+    res = await client.post(
+        "/compare/facets",
+        json=body,
+        cookies={"access_token": TEST_ACCESS_TOKEN},
+    )
+    assert res.status_code == 200, res.json()
+
+    statistics = res.json()["statistics"]
+    assert statistics["correction"] == "bonferroni"
+    gender = statistics["facets"]["gender"]
+    assert gender["dof"] == 1
+    assert gender["p_value"] < 0.001
+    assert gender["buckets"]["keys"] == ["female", "male"]
+    assert gender["buckets"]["proportion1"] == [0.4, 0.6]
+    # 2 buckets
+    assert gender["buckets"]["adjusted_p_value"][0] == pytest.approx(
+        min(1, 2 * gender["buckets"]["p_value"][0])
+    )
+
+
+@pytest.mark.asyncio
+async def test_compare_facets_endpoint_top_k_pages(app, client):
+    sites = {
+        "cohort1": {"lung": 10, "brain": 3, "skin": 1},
+        "cohort2": {"brain": 9, "kidney": 4},
+    }
+    data = {
+        "data": {
+            alias: {
+                "case": {
+                    "site": {
+                        "histogram": [
+                            {"key": key, "count": count}
+                            for key, count in counts.items()
+                        ]
+                    }
+                }
+            }
+            for alias, counts in sites.items()
+        }
+    }
+    mock_guppy_data(app, [data, data])
+
+    body = {
+        "doc_type": "case",
+        "cohort1": cohort1,
+        "cohort2": cohort2,
+        "facets": ["site"],
+        "top_k": 3,
+        "page_size": 2,
+    }
+    res = await client.post(
+        "/compare/facets",
+        json=body,
+        cookies={"access_token": TEST_ACCESS_TOKEN},
+    )
+    assert res.status_code == 200, res.json()
+    page = res.json()
+    assert page["cohort1"]["facets"]["site"] == {
+        "buckets": [{"key": "brain", "count": 3}, {"key": "lung", "count": 10}],
+        "other": {"count": 1, "buckets": 1},
+    }
+    assert page["cohort2"]["facets"]["site"] == {
+        "buckets": [{"key": "brain", "count": 9}],
+        "other": {"count": 0, "buckets": 0},
+    }
+    assert page["next_cursor"]
+
+    res = await client.post(
+        "/compare/facets",
+        json={**body, "cursor": page["next_cursor"]},
+        cookies={"access_token": TEST_ACCESS_TOKEN},
+    )
+    assert res.status_code == 200, res.json()
+    page = res.json()
+    assert page["cohort1"]["facets"]["site"]["buckets"] == []
+    assert page["cohort2"]["facets"]["site"]["buckets"] == [
+        {"key": "kidney", "count": 4}
+    ]
+    assert page["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"top_k": 0},
+        {"page_size": -1},
+        # a cursor requires a page size
+        {"cursor": "eyJvZmZzZXQiOiAyfQ=="},
+        {"page_size": 2, "cursor": "not a cursor"},
+    ],
+)
+async def test_compare_facets_endpoint_invalid_pages(app, client, params):
+    mock_guppy_data(app, [])
+    body = {
+        "doc_type": "case",
+        "cohort1": cohort1,
+        "cohort2": cohort2,
+        "facets": ["site"],
+        **params,
+    }
+    res = await client.post(
+        "/compare/facets",
+        json=body,
+        cookies={"access_token": TEST_ACCESS_TOKEN},
+    )
+    assert res.status_code == 400, res.json()
+    app.state.guppy_client.execute.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "value_ranges,n_bins,expected",
+    [
+        ([(7300, 29000), (8000, 31000)], 10, (5000, 35000, 5000)),
+        ([(7300, 29000), (8000, 31000)], 20, (6000, 32000, 2000)),
+        ([(0.5, 4.2), None], 10, (0, 5, 1)),
+        ([(15, 15)], 5, (15, 16, 1)),
+        ([None, None], 10, None),
+    ],
+)
+def test_shared_range(value_ranges, n_bins, expected):
+    assert shared_range(value_ranges, n_bins) == expected
+
+
+@pytest.mark.asyncio
+async def test_compare_facets_endpoint_shared_bins(app, client):
+    def age_histograms(cohorts):
+        return {
+            "data": {
+                alias: {
+                    "case": {"diagnoses": {"age_at_diagnosis": {"histogram": buckets}}}
+                }
+                for alias, buckets in cohorts.items()
+            }
+        }
+
+    ranges = age_histograms(
+        {
+            "cohort1": [{"key": [7300, 29000], "count": 144}],
+            "cohort2": [{"key": [8000, 31000], "count": 30}],
+        }
+    )
+    histograms = age_histograms(
+        {
+            "cohort1": [{"key": [6000, 8000], "count": 144}],
+            "cohort2": [{"key": [8000, 10000], "count": 30}],
+        }
+    )
+    mock_guppy_data(app, [ranges, histograms, histograms])
+
+    body = {
+        "doc_type": "case",
+        "cohort1": cohort1,
+        "cohort2": cohort2,
+        "facets": ["diagnoses.age_at_diagnosis"],
+        "bins": {"diagnoses.age_at_diagnosis": 20},
+    }
+    for _ in range(2):
+        res = await client.post(
+            "/compare/facets",
+            json=body,
+            cookies={"access_token": TEST_ACCESS_TOKEN},
+        )
+        assert res.status_code == 200, res.json()
+        assert res.json()["bins"] == {
+            "diagnoses.age_at_diagnosis": {"start": 6000, "end": 32000, "step": 2000}
+        }
+        assert res.json()["cohort2"]["facets"]["diagnoses.age_at_diagnosis"] == {
+            "buckets": [{"key": [8000, 10000], "count": 30}]
+        }
+
+    queries = [
+        call.kwargs["query"] for call in app.state.guppy_client.execute.call_args_list
+    ]
+    # the ranges of values are cached: queried by the first request only
+    assert len(queries) == 3
+    assert "age_at_diagnosis { histogram { key count } }" in queries[0]
+    for query in queries[1:]:
+        assert (
+            query.count("histogram(rangeStart: 6000, rangeEnd: 32000, rangeStep: 2000)")
+            == 2
+        )
+
+
+@pytest.mark.asyncio
+async def test_compare_facets_endpoint_bins_of_text_facet(app, client):
+    mock_guppy_data(
+        app,
+        [
+            {
+                "data": {
+                    alias: {
+                        "case": {
+                            "gender": {"histogram": [{"key": "female", "count": 3}]}
+                        }
+                    }
+                    for alias in ["cohort1", "cohort2"]
+                }
+            }
+        ],
+    )
+    res = await client.post(
+        "/compare/facets",
+        json={
+            "doc_type": "case",
+            "cohort1": cohort1,
+            "cohort2": cohort2,
+            "facets": ["gender"],
+            "bins": {"gender": 10},
+        },
+        cookies={"access_token": TEST_ACCESS_TOKEN},
+    )
+    assert res.status_code == 400, res.json()
+    assert "gender" in res.json()["detail"]
+    # only the ranges of values were queried
+    assert app.state.guppy_client.execute.call_count == 1
+
+
 @pytest.mark.asyncio
 async def test_compare_intersection_endpoint(app, client):
     n_c1_ids = 35
@@ -217,6 +643,7 @@ async def test_compare_intersection_endpoint(app, client):
             "intersection": {"AND": [cohort1, cohort2]},
         },
         retry_count=1,
+        cacheable=True,
     )
 
     print("Result:", json.dumps(res.json(), indent=2))
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from gen3analysis.utils.core import gather_with_concurrency
+
+
+@pytest.mark.asyncio
+async def test_gather_with_concurrency_keeps_order_and_limit():
+    running = 0
+    max_running = 0
+
+    async def work(i, delay):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(delay)
+        running -= 1
+        return i
+
+    results = await gather_with_concurrency(
+        2, *(work(i, delay) for i, delay in enumerate([0.03, 0.01, 0.02, 0.0]))
+    )
+    assert results == [0, 1, 2, 3]
+    assert max_running == 2
+
+
+@pytest.mark.asyncio
+async def test_gather_with_concurrency_cancels_others_on_error():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        await gather_with_concurrency(0, slow(), fail())
+    assert cancelled == [True]
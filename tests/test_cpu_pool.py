@@ -0,0 +1,81 @@
+import asyncio
+import os
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from gen3analysis.utils.cpu_pool import CPUPool, run_cpu_bound, run_in_thread
+
+
+@pytest.mark.asyncio
+async def test_cpu_pool_runs_outside_event_loop_thread():
+    cpu_pool = CPUPool(kind="thread", max_workers=2, max_queue=4)
+    try:
+        thread = await run_cpu_bound(cpu_pool, threading.get_ident)
+        assert thread != threading.get_ident()
+        assert await run_cpu_bound(cpu_pool, pow, 2, 10) == 1024
+    finally:
+        cpu_pool.shutdown()
+
+    # without a pool, the function runs inline
+    assert await run_cpu_bound(None, threading.get_ident) == threading.get_ident()
+
+
+@pytest.mark.asyncio
+async def test_cpu_pool_run_in_thread_of_process_pool():
+    cpu_pool = CPUPool(kind="process", max_workers=1, max_queue=4)
+    try:
+        # the function runs in a thread of this process: its arguments are not pickled
+        assert await run_in_thread(cpu_pool, os.getpid) == os.getpid()
+        thread = await run_in_thread(cpu_pool, threading.get_ident)
+        assert thread != threading.get_ident()
+    finally:
+        cpu_pool.shutdown()
+
+    assert await run_in_thread(None, threading.get_ident) == threading.get_ident()
+
+
+@pytest.mark.asyncio
+async def test_cpu_pool_rejects_when_queue_is_full():
+    cpu_pool = CPUPool(kind="thread", max_workers=1, max_queue=1)
+    release = threading.Event()
+    try:
+        running = asyncio.create_task(cpu_pool.run(release.wait))
+        queued = asyncio.create_task(cpu_pool.run(pow, 2, 3))
+        await asyncio.sleep(0.01)
+
+        with pytest.raises(HTTPException) as e:
+            await cpu_pool.run(pow, 2, 4)
+        assert e.value.status_code == 503
+
+        release.set()
+        assert await running is True
+        assert await queued == 8
+    finally:
+        release.set()
+        cpu_pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_cpu_pool_keeps_slot_of_cancelled_calls_until_done():
+    cpu_pool = CPUPool(kind="thread", max_workers=1, max_queue=0)
+    release = threading.Event()
+    try:
+        running = asyncio.create_task(cpu_pool.run(release.wait))
+        await asyncio.sleep(0.01)
+        running.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await running
+
+        # the cancelled function still runs: its worker is not free
+        with pytest.raises(HTTPException) as e:
+            await cpu_pool.run(pow, 2, 4)
+        assert e.value.status_code == 503
+
+        release.set()
+        await asyncio.sleep(0.01)
+        assert await cpu_pool.run(pow, 2, 4) == 16
+    finally:
+        release.set()
+        cpu_pool.shutdown()
@@ -1,3 +1,4 @@
+import asyncio
 from datetime import datetime, timedelta
 from unittest.mock import AsyncMock, patch
 
@@ -73,3 +74,114 @@ async def test_refresh_token_raises_on_connection_error():
 
         assert exc_info.value.status_code == 503
         assert "Connection error while fetching CSRF token" in exc_info.value.detail
+
+
+def csrf_response(token):
+    return type(
+        "Response",
+        (object,),
+        {"status_code": 200, "json": lambda self: {"csrf": token}},
+    )()
+
+
+@pytest.mark.asyncio
+async def test_get_token_refreshes_ahead_of_expiry_in_background():
+    cache = CSRFTokenCache(
+        rest_api_url="http://example.com", token_ttl_seconds=3600, shared_file=""
+    )
+    cache._cached_token = CachedToken(
+        token="old_token", expires_at=datetime.utcnow() + timedelta(seconds=10)
+    )
+
+    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
+        mock_get.return_value = csrf_response("new_token")
+
+        # the valid token is served right away, and refreshed in the background
+        assert await cache.get_token() == "old_token"
+        assert await cache.get_token() == "old_token"
+        await cache._refresh_task
+        assert await cache.get_token() == "new_token"
+        assert mock_get.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_get_token_coalesces_concurrent_refreshes():
+    cache = CSRFTokenCache(
+        rest_api_url="http://example.com", token_ttl_seconds=3600, shared_file=""
+    )
+
+    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
+        mock_get.return_value = csrf_response("new_token")
+        tokens = await asyncio.gather(*(cache.get_token() for _ in range(10)))
+
+    assert tokens == ["new_token"] * 10
+    assert mock_get.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_get_token_serves_expired_token_when_refresh_fails():
+    cache = CSRFTokenCache(
+        rest_api_url="http://example.com", token_ttl_seconds=3600, shared_file=""
+    )
+    cache._cached_token = CachedToken(
+        token="expired_token", expires_at=datetime.utcnow() - timedelta(seconds=1)
+    )
+
+    with patch(
+        "httpx.AsyncClient.get", side_effect=httpx.ConnectError("Connection failed")
+    ):
+        assert await cache.get_token() == "expired_token"
+
+        # without any token to fall back on, the error is raised
+        cache._cached_token = None
+        with pytest.raises(HTTPException):
+            await cache.get_token()
+
+
+@pytest.mark.asyncio
+async def test_token_is_shared_between_workers_through_file(tmp_path):
+    shared_file = str(tmp_path / "csrf.json")
+    worker_1, worker_2 = (
+        CSRFTokenCache(
+            rest_api_url="http://example.com",
+            token_ttl_seconds=3600,
+            shared_file=shared_file,
+        )
+        for _ in range(2)
+    )
+
+    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
+        mock_get.return_value = csrf_response("shared_token")
+        assert await worker_1.get_token() == "shared_token"
+        assert await worker_2.get_token() == "shared_token"
+
+    assert mock_get.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_forced_refresh_does_not_adopt_rejected_shared_token(tmp_path):
+    shared_file = str(tmp_path / "csrf.json")
+    worker_1, worker_2 = (
+        CSRFTokenCache(
+            rest_api_url="http://example.com",
+            token_ttl_seconds=3600,
+            shared_file=shared_file,
+        )
+        for _ in range(2)
+    )
+
+    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
+        mock_get.return_value = csrf_response("tok1")
+        assert await worker_1.get_token() == "tok1"
+        assert await worker_2.get_token() == "tok1"
+
+        # Guppy rejected `tok1`: it is replaced, not read back from the shared file
+        mock_get.return_value = csrf_response("tok2")
+        await worker_1.refresh(force=True)
+        assert await worker_1.get_token() == "tok2"
+        assert mock_get.call_count == 2
+
+        # the other worker adopts the new token from the shared file
+        await worker_2.refresh(force=True)
+        assert await worker_2.get_token() == "tok2"
+        assert mock_get.call_count == 2
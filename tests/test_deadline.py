@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from gen3analysis import config
+from gen3analysis.main import ClientDisconnectMiddleware
+from gen3analysis.utils.deadline import remaining, request_deadline, request_timeout
+
+
+@pytest.mark.parametrize(
+    "setting,header,expected",
+    [
+        (60, None, 60),
+        (60, "5", 5),
+        # the header can only shorten the deadline
+        (60, "120", 60),
+        (60, "not a number", 60),
+        (60, "-1", 60),
+        # no deadline
+        (0, None, None),
+        (0, "5", 5),
+    ],
+)
+def test_request_timeout(monkeypatch, setting, header, expected):
+    monkeypatch.setattr(config, "REQUEST_TIMEOUT_SECONDS", setting)
+    assert request_timeout(header) == expected
+
+
+def test_request_deadline_keeps_earlier_deadline():
+    assert remaining() is None
+    with request_deadline(1):
+        with request_deadline(100):
+            assert remaining() <= 1
+        with request_deadline(None):
+            assert remaining() <= 1
+    assert remaining() is None
+
+
+@pytest.mark.asyncio
+async def test_client_disconnect_cancels_request():
+    body_read = asyncio.Event()
+    disconnect = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def app(scope, receive, send):
+        message = await receive()
+        assert message == {"type": "http.request", "body": b"{}", "more_body": False}
+        body_read.set()
+        try:
+            # e.g. waiting for Guppy, without reading the request anymore
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    messages = [{"type": "http.request", "body": b"{}", "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        pass
+
+    handler = asyncio.ensure_future(
+        ClientDisconnectMiddleware(app)({"type": "http"}, receive, send)
+    )
+    await body_read.wait()
+    disconnect.set()
+    await asyncio.wait_for(handler, 1)
+    assert cancelled.is_set()
+
+
+@pytest.mark.asyncio
+async def test_client_disconnect_after_response_does_not_cancel():
+    response_sent = asyncio.Event()
+    finished = asyncio.Event()
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+        await asyncio.sleep(0.05)
+        finished.set()
+
+    async def receive():
+        await response_sent.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            response_sent.set()
+
+    await asyncio.wait_for(
+        ClientDisconnectMiddleware(app)({"type": "http"}, receive, send), 1
+    )
+    assert finished.is_set()
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from gen3analysis.utils.facet_buckets import (
+    decode_cursor,
+    encode_cursor,
+    paginate_facets,
+)
+
+
+def histogram(counts):
+    return [{"key": key, "count": count} for key, count in counts.items()]
+
+
+cohorts = [
+    {
+        "site": histogram({"lung": 10, "brain": 3, "skin": 1, "bone": 2}),
+        "age": [{"key": [0, 10], "count": 5}, {"key": [10, 20], "count": 1}],
+    },
+    {
+        "site": histogram({"brain": 9, "kidney": 4, "bone": 1}),
+        "age": [{"key": [10, 20], "count": 2}],
+    },
+]
+
+
+def test_paginate_facets_top_k():
+    res = paginate_facets(["site", "age"], cohorts, [True, False], top_k=2)
+    # totals: brain 12, lung 10, kidney 4, bone 3, skin 1
+    assert res["cohorts"][0]["site"] == {
+        "buckets": [{"key": "brain", "count": 3}, {"key": "lung", "count": 10}],
+        "other": {"count": 3, "buckets": 2},
+    }
+    assert res["cohorts"][1]["site"] == {
+        "buckets": [{"key": "brain", "count": 9}],
+        "other": {"count": 5, "buckets": 2},
+    }
+    # facets that are not truncated are returned whole, in their order
+    assert res["cohorts"][0]["age"] == {"buckets": cohorts[0]["age"]}
+    assert res["cohorts"][1]["age"] == {"buckets": cohorts[1]["age"]}
+    assert not res["has_more"]
+
+
+def test_paginate_facets_pages():
+    keys = []
+    offset = 0
+    while True:
+        res = paginate_facets(
+            ["site", "age"], cohorts, [True, False], offset=offset, page_size=2
+        )
+        keys.append([bucket["key"] for bucket in res["cohorts"][0]["site"]["buckets"]])
+        assert "other" not in res["cohorts"][0]["site"]
+        if not res["has_more"]:
+            break
+        offset += 2
+    assert keys == [["brain", "lung"], ["bone"], ["skin"]]
+
+
+def test_paginate_facets_pages_of_top_k():
+    res = paginate_facets(["site"], cohorts, [True], top_k=3, offset=2, page_size=2)
+    assert res["cohorts"][0]["site"] == {
+        "buckets": [],
+        "other": {"count": 3, "buckets": 2},
+    }
+    assert res["cohorts"][1]["site"] == {
+        "buckets": [{"key": "kidney", "count": 4}],
+        "other": {"count": 1, "buckets": 1},
+    }
+    assert not res["has_more"]
+
+
+def test_paginate_facets_statistics():
+    res = paginate_facets(
+        ["site"], cohorts, [True], top_k=2, correction="none", page_size=1
+    )
+    assert res["has_more"]
+    site = res["statistics"]["site"]
+    # the tests are run on all the buckets, but only returned for the page
+    assert site["dof"] == 4
+    assert site["buckets"]["keys"] == ["brain"]
+    assert site["buckets"]["proportion1"] == [pytest.approx(3 / 16)]
+
+
+def test_cursor():
+    assert decode_cursor(encode_cursor(40)) == 40
+    for cursor in ["", "not a cursor", encode_cursor(-1), "eyJhIjogMX0="]:
+        with pytest.raises(ValueError):
+            decode_cursor(cursor)
+
+
+def test_paginate_facets_many_buckets():
+    rng = np.random.default_rng(0)
+    counts = [rng.integers(1, 10**6, 5000) for _ in range(2)]
+    buckets = [
+        {"site": histogram({f"value_{i}": int(n) for i, n in enumerate(row)})}
+        for row in counts
+    ]
+    res = paginate_facets(["site"], buckets, [True], top_k=10)
+
+    totals = counts[0] + counts[1]
+    top = np.argsort(-totals, kind="stable")[:10]
+    site = res["cohorts"][0]["site"]
+    assert [bucket["key"] for bucket in site["buckets"]] == [f"value_{i}" for i in top]
+    assert site["other"] == {
+        "count": int(counts[0].sum() - counts[0][top].sum()),
+        "buckets": 4990,
+    }
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+from scipy.stats import chi2_contingency
+
+from gen3analysis.utils.facet_stats import (
+    adjust_p_values,
+    align_buckets,
+    compare_facet_buckets,
+)
+
+
+def histogram(counts):
+    return [{"key": key, "count": count} for key, count in counts.items()]
+
+
+def test_align_buckets():
+    aligned = align_buckets(
+        ["gender", "age"],
+        [
+            {
+                "gender": histogram({"female": 10, "male": 20}),
+                "age": [{"key": [0, 10], "count": 5}],
+            },
+            {
+                "gender": histogram({"male": 5, "unknown": 3}),
+                "age": [{"key": [0, 10], "count": 1}, {"key": [10, 20], "count": 4}],
+            },
+        ],
+    )
+    assert aligned.segments.tolist() == [0, 0, 0, 1, 1]
+    assert aligned.keys.tolist() == ["female", "male", "unknown", (0, 10), (10, 20)]
+    assert aligned.counts.tolist() == [[10, 20, 0, 5, 0], [0, 5, 3, 1, 4]]
+
+
+def test_align_buckets_with_null_keys():
+    aligned = align_buckets(
+        ["gender", "race"],
+        [
+            {
+                "gender": histogram({"female": 10, None: 2}),
+                "race": histogram({"white": 3}),
+            },
+            {
+                "gender": histogram({"male": 5}),
+                "race": histogram({None: 4, "white": 1}),
+            },
+        ],
+    )
+    # null keys are buckets of their own facet
+    assert aligned.segments.tolist() == [0, 0, 0, 1, 1]
+    assert aligned.keys.tolist() == ["female", None, "male", "white", None]
+    assert aligned.counts.tolist() == [[10, 2, 0, 3, 0], [0, 0, 5, 1, 4]]
+
+
+def reference_adjust(p_values, method):
+    m = len(p_values)
+    order = np.argsort(p_values)
+    adjusted = np.empty(m)
+    if method == "fdr_bh":
+        running = 1.0
+        for rank in range(m, 0, -1):
+            i = order[rank - 1]
+            running = min(running, p_values[i] * m / rank)
+            adjusted[i] = running
+    else:
+        running = 0.0
+        for rank in range(1, m + 1):
+            i = order[rank - 1]
+            running = max(running, min(1, p_values[i] * (m - rank + 1)))
+            adjusted[i] = running
+    return adjusted
+
+
+@pytest.mark.parametrize("method", ["fdr_bh", "holm"])
+def test_adjust_p_values_per_segment(method):
+    rng = np.random.default_rng(0)
+    segments = np.repeat([0, 1, 2], [5, 1, 8])
+    p_values = rng.uniform(0, 0.2, len(segments))
+
+    adjusted = adjust_p_values(p_values, segments, method)
+    for segment in range(3):
+        mask = segments == segment
+        np.testing.assert_allclose(
+            adjusted[mask], reference_adjust(p_values[mask], method)
+        )
+
+
+def test_compare_facet_buckets():
+    cohort1 = {
+        "gender": histogram({"female": 40, "male": 60, "unknown": 2}),
+        "race": histogram({"asian": 10}),
+        "project_id": histogram({"a": 3, "b": 7}),
+    }
+    cohort2 = {
+        "gender": histogram({"female": 70, "male": 30}),
+        # only one bucket: the chi-square test is not defined
+        "race": histogram({"asian": 20}),
+    }
+    res = compare_facet_buckets(
+        align_buckets(["gender", "race", "project_id"], [cohort1, cohort2]),
+        correction="none",
+    )
+
+    expected = chi2_contingency([[40, 60, 2], [70, 30, 0]], correction=False).statistic
+    assert res["gender"]["chi2"] == pytest.approx(expected)
+    assert res["gender"]["dof"] == 2
+    assert res["race"]["chi2"] is None
+    # no counts in cohort2
+    assert res["project_id"]["p_value"] is None
+    assert res["project_id"]["buckets"]["proportion2"] == [None, None]
+
+    buckets = res["gender"]["buckets"]
+    assert buckets["keys"] == ["female", "male", "unknown"]
+    assert buckets["proportion1"] == pytest.approx([40 / 102, 60 / 102, 2 / 102])
+    assert buckets["proportion2"] == pytest.approx([0.7, 0.3, 0])
+    # the "female" bucket: 2x2 table of female / not female
+    female = chi2_contingency([[40, 62], [70, 30]], correction=False)
+    assert buckets["z"][0] ** 2 == pytest.approx(female.statistic)
+    assert buckets["p_value"][0] == pytest.approx(female.pvalue)
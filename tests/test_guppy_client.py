@@ -0,0 +1,432 @@
+import asyncio
+import json
+import os
+from unittest.mock import AsyncMock
+
+from fastapi import HTTPException
+import httpx
+import pytest
+
+from gen3analysis import config
+from gen3analysis.gen3.guppyQuery import (
+    GuppyGQLClient,
+    GuppyQueryError,
+    GuppyResponseCache,
+)
+from gen3analysis.utils.deadline import request_deadline
+
+
+def make_client(results):
+    client = GuppyGQLClient(
+        graphql_url="http://guppy/graphql", csrf_token_url="http://revproxy"
+    )
+    release = asyncio.Event()
+
+    async def execute(*args):
+        await release.wait()
+        return results.pop(0)
+
+    client._execute = AsyncMock(side_effect=execute)
+    return client, release
+
+
+@pytest.mark.asyncio
+async def test_execute_coalesces_identical_in_flight_queries():
+    client, release = make_client([{"data": 1}, {"data": 2}, {"data": 3}])
+
+    calls = [
+        # the variables are compared canonically
+        client.execute("token", "query", {"a": 1, "b": 2}),
+        client.execute("token", "query", {"b": 2, "a": 1}),
+        # different access token or query: not shared
+        client.execute("other token", "query", {"a": 1, "b": 2}),
+        client.execute("token", "other query", {"a": 1, "b": 2}),
+    ]
+    tasks = [asyncio.ensure_future(call) for call in calls]
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*tasks)
+
+    assert client._execute.call_count == 3
+    assert results[0] is results[1]
+    assert [result["data"] for result in results] == [1, 1, 2, 3]
+    assert not client._in_flight
+
+
+@pytest.mark.asyncio
+async def test_execute_coalescing_survives_cancelled_caller():
+    client, release = make_client([{"data": 1}])
+
+    first = asyncio.ensure_future(client.execute("token", "query"))
+    second = asyncio.ensure_future(client.execute("token", "query"))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+
+    assert await second == {"data": 1}
+    assert client._execute.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_execute_uses_shared_http_client():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request.url.path)
+        if request.url.path == "/_status":
+            return httpx.Response(200, json={"csrf": "token"})
+        return httpx.Response(200, json={"data": {"case": []}})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = GuppyGQLClient(
+            graphql_url="http://guppy/graphql",
+            csrf_token_url="http://revproxy",
+            http_client=http_client,
+        )
+        assert await client.execute("token", "query") == {"data": {"case": []}}
+        assert await client.execute("token", "query 2") == {"data": {"case": []}}
+
+    # the CSRF token is fetched once, and all the requests go through the shared client
+    assert requests == ["/_status", "/graphql", "/graphql"]
+
+
+@pytest.mark.asyncio
+async def test_execute_cancels_request_without_callers():
+    client, release = make_client([{"data": 1}])
+    started = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def execute(*args):
+        started.set()
+        try:
+            await release.wait()
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    client._execute = AsyncMock(side_effect=execute)
+
+    caller = asyncio.ensure_future(client.execute("token", "query"))
+    await started.wait()
+    caller.cancel()
+    # the only caller is gone (e.g. the client disconnected): the request is aborted
+    await asyncio.wait_for(cancelled.wait(), 1)
+    assert not client._in_flight
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("coalesce", [True, False])
+async def test_execute_aborts_request_at_deadline(monkeypatch, coalesce):
+    monkeypatch.setattr(config, "GUPPY_COALESCE_REQUESTS", coalesce)
+    requests = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request.url.path)
+        if request.url.path == "/_status":
+            return httpx.Response(200, json={"csrf": "token"})
+        await asyncio.sleep(10)
+        return httpx.Response(200, json={"data": {}})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = GuppyGQLClient(
+            graphql_url="http://guppy/graphql",
+            csrf_token_url="http://revproxy",
+            http_client=http_client,
+        )
+        with request_deadline(0.1):
+            with pytest.raises(HTTPException) as e:
+                await asyncio.wait_for(client.execute("token", "query"), 1)
+            assert e.value.status_code == 504
+
+            # the deadline has passed: no request is sent anymore
+            with pytest.raises(HTTPException):
+                await client.execute("token", "query")
+
+    # not retried after the deadline
+    assert requests == ["/_status", "/graphql"]
+
+
+def make_http_guppy_client(http_client):
+    client = GuppyGQLClient(
+        graphql_url="http://guppy/graphql",
+        csrf_token_url="http://revproxy",
+        http_client=http_client,
+    )
+    client.csrf_cache.get_token = AsyncMock(return_value="csrf")
+    return client
+
+
+def status_handler(statuses, requests):
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request.url.path)
+        status = statuses.pop(0)
+        return httpx.Response(status, json={"data": {"status": status}})
+
+    return handler
+
+
+@pytest.mark.asyncio
+async def test_execute_retries_transient_errors_only(monkeypatch):
+    monkeypatch.setattr(config, "GUPPY_RETRY_MAX_WAIT_SECONDS", 0)
+    requests = []
+    statuses = [502, 200, 400]
+    transport = httpx.MockTransport(status_handler(statuses, requests))
+    async with httpx.AsyncClient(transport=transport) as http_client:
+        client = make_http_guppy_client(http_client)
+        assert await client.execute("token", "query") == {"data": {"status": 200}}
+        assert len(requests) == 2
+
+        # client errors are not retried
+        with pytest.raises(HTTPException) as e:
+            await client.execute("token", "query 2")
+        assert e.value.status_code == 400
+        assert len(requests) == 3
+
+
+@pytest.mark.asyncio
+async def test_execute_retry_budget(monkeypatch):
+    monkeypatch.setattr(config, "GUPPY_RETRY_MAX_WAIT_SECONDS", 0)
+    requests = []
+    statuses = [503] * 4
+    transport = httpx.MockTransport(status_handler(statuses, requests))
+    async with httpx.AsyncClient(transport=transport) as http_client:
+        client = make_http_guppy_client(http_client)
+        client.retry_budget.tokens = 1
+        client.retry_budget.ratio = 0
+        for query in ["query", "query 2"]:
+            with pytest.raises(HTTPException) as e:
+                await client.execute("token", query)
+            assert e.value.status_code == 503
+
+    # the first query is retried once, then the budget is exhausted
+    assert len(requests) == 3
+
+
+@pytest.mark.asyncio
+async def test_execute_fails_fast_when_circuit_is_open(monkeypatch):
+    monkeypatch.setattr(config, "GUPPY_CIRCUIT_FAILURE_THRESHOLD", 2)
+    requests = []
+    statuses = [504, 504]
+    transport = httpx.MockTransport(status_handler(statuses, requests))
+    async with httpx.AsyncClient(transport=transport) as http_client:
+        client = make_http_guppy_client(http_client)
+        limit = client.limiter.limit
+        with pytest.raises(HTTPException):
+            await client.execute("token", "query", retry_count=0)
+        with pytest.raises(HTTPException):
+            await client.execute("token", "query 2", retry_count=0)
+
+        # Guppy is not called anymore
+        with pytest.raises(HTTPException) as e:
+            await client.execute("token", "query 3")
+        assert e.value.status_code == 503
+        assert "unavailable" in e.value.detail
+
+    assert len(requests) == 2
+    assert client.limiter.limit < limit
+
+
+@pytest.mark.asyncio
+async def test_execute_opens_circuit_on_server_errors(monkeypatch):
+    monkeypatch.setattr(config, "GUPPY_CIRCUIT_FAILURE_THRESHOLD", 2)
+    responses = [
+        # an invalid query is not a failure of Guppy
+        httpx.Response(
+            200,
+            json={
+                "errors": [
+                    {
+                        "message": "Cannot query field",
+                        "extensions": {"code": "GRAPHQL_VALIDATION_FAILED"},
+                    }
+                ]
+            },
+        ),
+        httpx.Response(500, text="Internal Server Error"),
+        httpx.Response(
+            200,
+            json={
+                "errors": [
+                    {
+                        "message": "search_phase_execution_exception",
+                        "extensions": {"code": "INTERNAL_SERVER_ERROR"},
+                    }
+                ]
+            },
+        ),
+    ]
+    transport = httpx.MockTransport(lambda request: responses.pop(0))
+    async with httpx.AsyncClient(transport=transport) as http_client:
+        client = make_http_guppy_client(http_client)
+        for _ in range(2):
+            with pytest.raises(HTTPException):
+                await client.execute("token", "query", retry_count=0)
+            assert client.circuit_breaker.state == client.circuit_breaker.CLOSED
+        with pytest.raises(HTTPException):
+            await client.execute("token", "query", retry_count=0)
+        assert client.circuit_breaker.state == client.circuit_breaker.OPEN
+
+
+@pytest.mark.asyncio
+async def test_execute_invalid_query():
+    errors = [
+        {
+            "message": 'Cannot query field "unknown" on type "Case".',
+            "extensions": {"code": "GRAPHQL_VALIDATION_FAILED"},
+        }
+    ]
+    responses = [
+        httpx.Response(200, json={"errors": errors}),
+        httpx.Response(400, json={"errors": errors}),
+        httpx.Response(400, text="Bad Request"),
+    ]
+    transport = httpx.MockTransport(lambda request: responses.pop(0))
+    async with httpx.AsyncClient(transport=transport) as http_client:
+        client = make_http_guppy_client(http_client)
+        for expected in [GuppyQueryError, GuppyQueryError, HTTPException]:
+            with pytest.raises(HTTPException) as e:
+                await client.execute("token", "query", retry_count=0)
+            assert type(e.value) is expected
+
+
+@pytest.mark.asyncio
+async def test_execute_abandoned_circuit_trial(monkeypatch):
+    monkeypatch.setattr(config, "GUPPY_CIRCUIT_FAILURE_THRESHOLD", 1)
+    monkeypatch.setattr(config, "GUPPY_CIRCUIT_RESET_SECONDS", 0)
+    requests = []
+    statuses = [504, 200]
+    transport = httpx.MockTransport(status_handler(statuses, requests))
+    async with httpx.AsyncClient(transport=transport) as http_client:
+        client = make_http_guppy_client(http_client)
+        with pytest.raises(HTTPException):
+            await client.execute("token", "query", retry_count=0)
+        assert client.circuit_breaker.state == client.circuit_breaker.OPEN
+
+        # the trial request reaches its deadline while waiting for a limiter slot
+        in_flight = client.limiter.in_flight
+        client.limiter.in_flight = client.limiter._capacity
+        with request_deadline(0.05):
+            with pytest.raises(HTTPException) as e:
+                await client.execute("token", "query 2", retry_count=0)
+            assert e.value.status_code == 504
+        client.limiter.in_flight = in_flight
+
+        # another trial request is let through
+        assert await client.execute("token", "query 3") == {"data": {"status": 200}}
+        assert client.circuit_breaker.state == client.circuit_breaker.CLOSED
+
+    assert len(requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_download():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append((request.url.path, json.loads(request.content)))
+        return httpx.Response(200, json=[{"_case_id": "1"}, {"_case_id": "2"}])
+
+    transport = httpx.MockTransport(handler)
+    async with httpx.AsyncClient(transport=transport) as http_client:
+        client = make_http_guppy_client(http_client)
+        cases = await client.download(
+            "token", "case", ["_case_id", "demographic.gender"], {"=": {"a": 1}}
+        )
+
+    assert cases == [{"_case_id": "1"}, {"_case_id": "2"}]
+    assert requests == [
+        (
+            "/download",
+            {
+                "type": "case",
+                "fields": ["_case_id", "demographic.gender"],
+                "filter": {"=": {"a": 1}},
+                "accessibility": "accessible",
+            },
+        )
+    ]
+
+
+def make_fetch(results):
+    fetch = AsyncMock(side_effect=lambda: results.pop(0))
+    return fetch
+
+
+@pytest.mark.asyncio
+async def test_response_cache_stale_while_revalidate(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("gen3analysis.gen3.guppyQuery.time.time", lambda: now[0])
+    cache = GuppyResponseCache(max_entries=10, ttl_seconds=10, stale_seconds=20)
+    fetch = make_fetch([{"data": 1}, {"data": 2}, {"data": 3}])
+
+    assert await cache.get_or_fetch("key", fetch) == {"data": 1}
+    # fresh
+    now[0] += 5
+    assert await cache.get_or_fetch("key", fetch) == {"data": 1}
+    assert fetch.call_count == 1
+
+    # stale: returned immediately, and refreshed in the background
+    now[0] += 10
+    assert await cache.get_or_fetch("key", fetch) == {"data": 1}
+    await asyncio.gather(*cache._revalidating.values())
+    assert fetch.call_count == 2
+    assert await cache.get_or_fetch("key", fetch) == {"data": 2}
+
+    # expired
+    now[0] += 31
+    assert await cache.get_or_fetch("key", fetch) == {"data": 3}
+    assert fetch.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_response_cache_keeps_stale_result_if_refresh_fails(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("gen3analysis.gen3.guppyQuery.time.time", lambda: now[0])
+    cache = GuppyResponseCache(max_entries=10, ttl_seconds=10, stale_seconds=20)
+    await cache.get_or_fetch("key", make_fetch([{"data": 1}]))
+
+    now[0] += 15
+    failing_fetch = AsyncMock(side_effect=HTTPException(502))
+    assert await cache.get_or_fetch("key", failing_fetch) == {"data": 1}
+    await asyncio.gather(*cache._revalidating.values())
+    assert await cache.get_or_fetch("key", failing_fetch) == {"data": 1}
+
+
+@pytest.mark.asyncio
+async def test_response_cache_disk_tier(tmp_path):
+    directory = str(tmp_path / "cache")
+    cache = GuppyResponseCache(
+        max_entries=10, ttl_seconds=10, directory=directory, max_disk_entries=2
+    )
+    cache.DISK_PRUNE_INTERVAL = 1
+    for i in range(3):
+        await cache.get_or_fetch(f"key{i}", make_fetch([{"data": i}]))
+    # only the most recent files are kept
+    assert len(os.listdir(directory)) == 2
+
+    # e.g. another worker, or after a restart
+    other_cache = GuppyResponseCache(
+        max_entries=10, ttl_seconds=10, directory=directory
+    )
+    fetch = make_fetch([{"data": "fetched"}])
+    assert await other_cache.get_or_fetch("key2", fetch) == {"data": 2}
+    assert await other_cache.get_or_fetch("key0", fetch) == {"data": "fetched"}
+    assert fetch.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_execute_caches_cacheable_queries_only():
+    client, release = make_client([{"data": i} for i in range(4)])
+    client.response_cache = GuppyResponseCache(max_entries=10, ttl_seconds=60)
+    release.set()
+
+    query = "query { _aggregation { case { _totalCount } } }"
+    assert await client.execute("token", query, cacheable=True) == {"data": 0}
+    assert await client.execute("token", query, cacheable=True) == {"data": 0}
+    # the access scope is part of the key
+    assert await client.execute("other token", query, cacheable=True) == {"data": 1}
+    # e.g. the first page of a listing, with its `_totalCount`
+    page_query = "query { case { _case_id } _aggregation { case { _totalCount } } }"
+    assert await client.execute("token", page_query) == {"data": 2}
+    assert await client.execute("token", page_query) == {"data": 3}
+    assert client._execute.call_count == 4
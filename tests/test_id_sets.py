@@ -0,0 +1,44 @@
+import numpy as np
+
+from gen3analysis.utils.id_sets import IdDictionary, IdSet
+
+
+def test_id_set_algebra_matches_python_sets():
+    rng = np.random.default_rng(0)
+    ids_a = [f"case-{i}" for i in rng.integers(0, 500, 400)] + [None]
+    ids_b = [f"case-{i}" for i in rng.integers(250, 750, 400)]
+
+    dictionary = IdDictionary()
+    codes_a, codes_b = dictionary.encode(ids_a, ids_b)
+    assert codes_a[-1] == IdDictionary.MISSING
+    set_a, set_b = IdSet.from_codes(codes_a), IdSet.from_codes(codes_b)
+
+    python_a, python_b = set(ids_a) - {None}, set(ids_b)
+    assert len(set_a) == len(python_a)
+    for id_set, expected in [
+        (set_a & set_b, python_a & python_b),
+        (set_a - set_b, python_a - python_b),
+        (set_b - set_a, python_b - python_a),
+        (set_a | set_b, python_a | python_b),
+    ]:
+        assert set(dictionary.decode(id_set.codes)) == expected
+
+    assert set_b.contains(codes_a).tolist() == [id_ in python_b for id_ in ids_a]
+    assert not IdSet.from_codes([]).contains(codes_a).any()
+
+    # ids encoded later get the same codes
+    (codes_c,) = dictionary.encode(ids_b[:3] + ["new"])
+    assert codes_c.tolist() == codes_b[:3].tolist() + [len(dictionary) - 1]
+
+
+def test_id_set_contains_missing_codes():
+    missing = np.full(3, IdDictionary.MISSING)
+    # an empty set, and codes that are all missing (e.g. a null key field)
+    assert IdSet.from_codes([]).contains(missing).tolist() == [False] * 3
+    assert IdSet.from_codes([0, 2]).contains(missing).tolist() == [False] * 3
+    assert IdSet.from_codes([0, 2]).contains([2, -1, 0, 1]).tolist() == [
+        True,
+        False,
+        True,
+        False,
+    ]
@@ -1,6 +1,10 @@
+import json
+from unittest.mock import AsyncMock
+
 import pytest
 
 from conftest import TEST_ACCESS_TOKEN, TEST_PROJECT_ID
+from gen3analysis.gen3.guppyQuery import GuppyQueryError
 from tests.utils import mock_guppy_data
 
 mocked_guppy_data = [
@@ -338,7 +342,9 @@ survival_response = {
 
 
 @pytest.mark.asyncio
-async def test_survival_endpoint(app, client):
+@pytest.mark.parametrize("estimator", ["native", "lifelines"])
+async def test_survival_endpoint(app, client, monkeypatch, estimator):
+    monkeypatch.setattr("gen3analysis.config.SURVIVAL_ESTIMATOR", estimator)
     filters = {
         "filters": [
             {"and": [{"nested": {"path": "demographic", "in": {"race": ["other"]}}}]},
@@ -541,64 +547,6 @@ compare_response = {
     "overallStats": {"pValue": 0.1967056024589432, "degreesFreedom": 1},
 }
 
-cohort_a = {
-    "data": {
-        "case": [
-            {"_case_id": "4504a259-fa2d-4907"},
-            {"_case_id": "3fbe5718-860b-424d"},
-            {"_case_id": "6a227cb7-4b49-49e5"},
-            {"_case_id": "e4edadb6-6cde-421b"},
-            {"_case_id": "1bad0750-e557-4465"},
-            {"_case_id": "827f83de-2978-4e1f"},
-            {"_case_id": "de556316-0012-4845"},
-            {"_case_id": "691dfd51-29d0-40b0"},
-            {"_case_id": "f954ad83-f285-42e7"},
-            {"_case_id": "588926f0-67b5-4ee0"},
-            {"_case_id": "53f271e5-42bf-43dc"},
-            {"_case_id": "e7e8ead2-f02d-40f0"},
-            {"_case_id": "c60a78c9-936a-4016"},
-            {"_case_id": "7924d094-9aec-4623"},
-            {"_case_id": "70d1ba40-794e-45e6"},
-            {"_case_id": "a6a339e4-e0f8-41e8"},
-            {"_case_id": "5acdf538-23a2-450b"},
-            {"_case_id": "8fe0a8dd-849a-4062"},
-            {"_case_id": "60b3c672-4466-470f"},
-            {"_case_id": "e8446228-bc5a-4ade"},
-            {"_case_id": "bbd9fc9a-3f04-43f5"},
-            {"_case_id": "a84bee86-24ce-4ab6"},
-            {"_case_id": "b54a526f-2ce1-41ea"},
-            {"_case_id": "2b71f6f8-6dcc-40b2"},
-        ]
-    }
-}
-
-cohort_b = {
-    "data": {
-        "case": [
-            {"_case_id": "4504a259-fa2d-4907"},
-            {"_case_id": "3fbe5718-860b-424d"},
-            {"_case_id": "57036b4d-0b40-4c80"},
-            {"_case_id": "6a227cb7-4b49-49e5"},
-            {"_case_id": "1bad0750-e557-4465"},
-            {"_case_id": "4c616f0b-d7f7-4790"},
-            {"_case_id": "a3e1e9c6-29af-43bd"},
-            {"_case_id": "827f83de-2978-4e1f"},
-            {"_case_id": "9ba5997d-5dea-4448"},
-            {"_case_id": "691dfd51-29d0-40b0"},
-            {"_case_id": "f954ad83-f285-42e7"},
-            {"_case_id": "53f271e5-42bf-43dc"},
-            {"_case_id": "e7e8ead2-f02d-40f0"},
-            {"_case_id": "f4538c9c-b897-4b43"},
-            {"_case_id": "c60a78c9-936a-4016"},
-            {"_case_id": "70d1ba40-794e-45e6"},
-            {"_case_id": "5acdf538-23a2-450b"},
-            {"_case_id": "8fe0a8dd-849a-4062"},
-            {"_case_id": "0732a04c-d9db-41ba"},
-            {"_case_id": "afd30d80-6d45-403b"},
-        ]
-    }
-}
-
 result_cohort_a = {
     "data": {
         "_aggregation": {"case": {"_totalCount": 10}},
@@ -755,16 +703,54 @@ result_cohort_b = {
     }
 }
 
+# cases in both cohorts, which are excluded from both curves
+shared_cases = [
+    {
+        "_case_id": "4504a259-fa2d-4907",
+        "demographic": [{"days_to_death": 120, "vital_status": "Dead"}],
+        "diagnoses": [{"days_to_last_follow_up": 120}],
+        "project_id": TEST_PROJECT_ID,
+        "submitter_id": "ID_1001",
+    },
+    {
+        "_case_id": "3fbe5718-860b-424d",
+        "demographic": [{"days_to_death": None, "vital_status": "Alive"}],
+        "diagnoses": [{"days_to_last_follow_up": 450}],
+        "project_id": TEST_PROJECT_ID,
+        "submitter_id": "ID_1002",
+    },
+    {
+        "_case_id": "0732a04c-d9db-41ba",
+        "demographic": [{"days_to_death": 2000, "vital_status": "Dead"}],
+        "diagnoses": [{"days_to_last_follow_up": 1500}],
+        "project_id": TEST_PROJECT_ID,
+        "submitter_id": "ID_1003",
+    },
+]
+
+# each cohort is fetched once, with the compared field along with the survival data
 mocked_compare_guppy_data = [
-    cohort_a,
-    cohort_b,
-    result_cohort_a,
-    result_cohort_b,
+    {
+        "data": {
+            "_aggregation": {"case": {"_totalCount": 13}},
+            "case": result_cohort_a["data"]["case"][:5]
+            + shared_cases
+            + result_cohort_a["data"]["case"][5:],
+        }
+    },
+    {
+        "data": {
+            "_aggregation": {"case": {"_totalCount": 13}},
+            "case": shared_cases + result_cohort_b["data"]["case"],
+        }
+    },
 ]
 
 
 @pytest.mark.asyncio
-async def test_survival_compare_endpoint(app, client):
+@pytest.mark.parametrize("estimator", ["native", "lifelines"])
+async def test_survival_compare_endpoint(app, client, monkeypatch, estimator):
+    monkeypatch.setattr("gen3analysis.config.SURVIVAL_ESTIMATOR", estimator)
     parameters = {
         "filters": [
             {"nested": {"path": "demographic", "in": {"gender": ["male"]}}},
@@ -790,3 +776,452 @@ async def test_survival_compare_endpoint(app, client):
         result_json["results"][1]["donors"] == compare_response["results"][1]["donors"]
     )
     assert result_json["overallStats"] == compare_response["overallStats"]
+
+    # one query per cohort, without the cases' ids
+    calls = app.state.guppy_client.execute.call_args_list
+    assert len(calls) == 2
+    assert "_case_id" in calls[0].kwargs["query"]
+    assert "4504a259-fa2d-4907" not in json.dumps(calls[1].kwargs["variables"])
+
+
+@pytest.mark.asyncio
+async def test_survival_endpoint_paginates_large_cohorts(app, client, monkeypatch):
+    """
+    In "offset" mode, cohorts larger than a page are fetched page by page, in
+    `_case_id` order
+    """
+    monkeypatch.setattr("gen3analysis.config.SURVIVAL_PAGE_SIZE", 4)
+    monkeypatch.setattr("gen3analysis.config.SURVIVAL_PAGINATION_MODE", "offset")
+    cohort_cases = sorted(
+        mocked_guppy_data[1]["data"]["case"], key=lambda case: case["_case_id"]
+    )
+    pages = [
+        {
+            "data": {
+                "_aggregation": {"case": {"_totalCount": len(cohort_cases)}},
+                "case": cohort_cases[:4],
+            }
+        },
+        {"data": {"case": cohort_cases[4:8]}},
+        {"data": {"case": cohort_cases[8:12]}},
+        {"data": {"case": cohort_cases[12:]}},
+    ]
+    mock_guppy_data(app, pages)
+
+    res = await client.post(
+        "/survival/",
+        json={"filters": [{"and": []}]},
+        headers={"Authorization": f"bearer {TEST_ACCESS_TOKEN}"},
+    )
+    assert res.status_code == 200
+    assert sorted(
+        res.json()["results"][0]["donors"], key=lambda donor: donor["time"]
+    ) == sorted(
+        survival_response["results"][1]["donors"], key=lambda donor: donor["time"]
+    )
+
+    calls = app.state.guppy_client.execute.call_args_list
+    assert len(calls) == 4
+    assert "_aggregation" in calls[0].kwargs["query"]
+    assert "_aggregation" not in calls[1].kwargs["query"]
+    assert [call.kwargs["variables"]["offset"] for call in calls] == [0, 4, 8, 12]
+    assert calls[0].kwargs["variables"]["sort"] == [{"_case_id": "asc"}]
+
+
+@pytest.mark.asyncio
+async def test_survival_endpoint_downloads_large_cohorts(app, client, monkeypatch):
+    """
+    In "download" mode, cohorts larger than a page are fetched whole from Guppy's
+    `/download` endpoint, whose nested documents may be objects
+    """
+    monkeypatch.setattr("gen3analysis.config.SURVIVAL_PAGE_SIZE", 4)
+    monkeypatch.setattr("gen3analysis.config.SURVIVAL_PAGINATION_MODE", "download")
+    cohort_cases = mocked_guppy_data[1]["data"]["case"]
+    mock_guppy_data(
+        app,
+        [
+            {
+                "data": {
+                    "_aggregation": {"case": {"_totalCount": len(cohort_cases)}},
+                    "case": cohort_cases[:4],
+                }
+            }
+        ],
+    )
+    downloaded = [
+        {**case, "demographic": case["demographic"][0]} for case in cohort_cases
+    ]
+    app.state.guppy_client.download = AsyncMock(return_value=downloaded)
+
+    res = await client.post(
+        "/survival/",
+        json={"filters": [{"and": []}]},
+        headers={"Authorization": f"bearer {TEST_ACCESS_TOKEN}"},
+    )
+    assert res.status_code == 200
+    assert sorted(
+        res.json()["results"][0]["donors"], key=lambda donor: donor["time"]
+    ) == sorted(
+        survival_response["results"][1]["donors"], key=lambda donor: donor["time"]
+    )
+
+    assert app.state.guppy_client.execute.call_count == 1
+    download = app.state.guppy_client.download.call_args
+    assert download.kwargs["doc_type"] == "case"
+    assert "demographic.days_to_death" in download.kwargs["fields"]
+
+
+@pytest.mark.asyncio
+async def test_survival_endpoint_caches_curves_per_access_token(app, client):
+    filters = {"filters": [{"and": [{"=": {"project_id": TEST_PROJECT_ID}}]}]}
+    mock_guppy_data(app, [mocked_guppy_data[0]] * 3)
+
+    async def post(access_token, headers=None):
+        res = await client.post(
+            "/survival/",
+            json=filters,
+            cookies={"access_token": access_token},
+            headers=headers,
+        )
+        assert res.status_code == 200
+        assert (
+            res.json()["results"][0]["donors"]
+            == survival_response["results"][0]["donors"]
+        )
+
+    await post("token1")
+    await post("token1")
+    assert app.state.guppy_client.execute.call_count == 1
+
+    # another user does not get the cached curve
+    await post("token2")
+    assert app.state.guppy_client.execute.call_count == 2
+
+    # the cache can be bypassed
+    await post("token1", headers={"Cache-Control": "no-cache"})
+    assert app.state.guppy_client.execute.call_count == 3
+    assert app.state.survival_cache.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_survival_endpoint_curve_output(app, client):
+    mock_guppy_data(app, mocked_guppy_data)
+
+    res = await client.post(
+        "/survival/",
+        json={
+            "filters": [{"and": []}, {"and": [{"=": {"gender": "female"}}]}],
+            "output": "curve",
+            "confidence_level": 0.95,
+        },
+        headers={"Authorization": f"bearer {TEST_ACCESS_TOKEN}"},
+    )
+    assert res.status_code == 200
+    result_json = res.json()
+    assert "donors" not in result_json["results"][0]
+    steps = result_json["results"][0]["steps"]
+    assert steps["time"] == [0, 92, 734, 769, 876, 1007, 1467]
+    assert steps["survival"] == [1.0, 1.0, 1.0] + [0.7500000000000001] * 4
+    assert steps["atRisk"] == [6, 6, 5, 4, 3, 2, 1]
+    assert steps["events"] == [0, 0, 0, 1, 0, 0, 0]
+    assert steps["censored"] == [0, 1, 1, 0, 1, 1, 1]
+    assert steps["lower"][3] == pytest.approx(0.127946917595)
+    assert steps["upper"][3] == pytest.approx(0.960548642285)
+    assert len(result_json["results"][1]["steps"]["time"]) == 15
+    assert result_json["overallStats"] == survival_response["overallStats"]
+
+
+@pytest.mark.asyncio
+async def test_survival_endpoint_streams_ndjson(app, client, monkeypatch):
+    monkeypatch.setattr("gen3analysis.config.SURVIVAL_STREAM_CHUNK_SIZE", 4)
+    filters = {
+        "filters": [
+            {"and": [{"nested": {"path": "demographic", "in": {"race": ["other"]}}}]},
+            {"and": [{"nested": {"path": "demographic", "in": {"race": ["asian"]}}}]},
+        ]
+    }
+    mock_guppy_data(app, mocked_guppy_data)
+
+    res = await client.post(
+        "/survival/",
+        json=filters,
+        headers={
+            "Authorization": f"bearer {TEST_ACCESS_TOKEN}",
+            "Accept": "application/x-ndjson",
+        },
+    )
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in res.text.splitlines()]
+
+    assert [result["donorCount"] for result in lines[0]["results"]] == [6, 14]
+    assert lines[0]["overallStats"] == survival_response["overallStats"]
+
+    # donors come in chunks of at most 4, curve after curve
+    assert [(line["result"], len(line["donors"])) for line in lines[1:]] == [
+        (0, 4),
+        (0, 2),
+        (1, 4),
+        (1, 4),
+        (1, 4),
+        (1, 2),
+    ]
+    for index in range(2):
+        donors = [
+            donor
+            for line in lines[1:]
+            if line["result"] == index
+            for donor in line["donors"]
+        ]
+        assert donors == survival_response["results"][index]["donors"]
+
+
+@pytest.mark.asyncio
+async def test_survival_endpoint_stratify_by(app, client):
+    """
+    A cohort is fetched once and split into one curve per value of `stratify_by`,
+    giving the same curves and log-rank test as one filter per value.
+    """
+    stratified_cases = [
+        {
+            **case,
+            "demographic": [{**case["demographic"][0], "race": race}],
+        }
+        for race, response in zip(["other", "asian"], mocked_guppy_data)
+        for case in response["data"]["case"]
+    ]
+    mock_guppy_data(
+        app,
+        [
+            {
+                "data": {
+                    "_aggregation": {"case": {"_totalCount": len(stratified_cases)}},
+                    "case": stratified_cases,
+                }
+            }
+        ],
+    )
+
+    res = await client.post(
+        "/survival/",
+        json={"filters": [{"and": []}], "stratify_by": "demographic.race"},
+        headers={"Authorization": f"bearer {TEST_ACCESS_TOKEN}"},
+    )
+    assert res.status_code == 200
+    result_json = res.json()
+
+    calls = app.state.guppy_client.execute.call_args_list
+    assert len(calls) == 1
+    assert "demographic { race }" in calls[0].kwargs["query"]
+
+    # strata are sorted by value
+    assert [result["meta"]["stratum"] for result in result_json["results"]] == [
+        "asian",
+        "other",
+    ]
+    assert (
+        result_json["results"][0]["donors"] == survival_response["results"][1]["donors"]
+    )
+    assert (
+        result_json["results"][1]["donors"] == survival_response["results"][0]["donors"]
+    )
+    assert result_json["overallStats"] == survival_response["overallStats"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("accept", ["application/json", "application/x-ndjson"])
+async def test_survival_endpoint_strata_without_events(app, client, accept):
+    """
+    The pairs of curves without events have a p-value of 1, instead of NaN which is
+    not valid JSON
+    """
+    cases = [
+        case for response in mocked_guppy_data for case in response["data"]["case"]
+    ]
+    stratified_cases = [
+        {
+            **case,
+            "demographic": [
+                {
+                    **case["demographic"][0],
+                    "race": (
+                        "asian"
+                        if case["demographic"][0]["vital_status"] == "Dead"
+                        else ["other", "white"][index % 2]
+                    ),
+                }
+            ],
+        }
+        for index, case in enumerate(cases)
+    ]
+    mock_guppy_data(
+        app,
+        [
+            {
+                "data": {
+                    "_aggregation": {"case": {"_totalCount": len(stratified_cases)}},
+                    "case": stratified_cases,
+                }
+            }
+        ],
+    )
+
+    res = await client.post(
+        "/survival/",
+        json={"filters": [{"and": []}], "stratify_by": "demographic.race"},
+        headers={"Authorization": f"bearer {TEST_ACCESS_TOKEN}", "Accept": accept},
+    )
+    assert res.status_code == 200
+    result_json = json.loads(res.text.splitlines()[0])
+    assert [result["meta"]["stratum"] for result in result_json["results"]] == [
+        "asian",
+        "other",
+        "white",
+    ]
+    assert result_json["overallStats"]["pairwise"][2] == {
+        "curves": [1, 2],
+        "pValue": 1.0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_survival_endpoint_stratify_by_validation(app, client):
+    mock_guppy_data(app, mocked_guppy_data)
+    for body in [
+        {"filters": [{"and": []}, {"and": []}], "stratify_by": "project_id"},
+        {"filters": [{"and": []}], "stratify_by": "project_id } case {"},
+    ]:
+        res = await client.post(
+            "/survival/",
+            json=body,
+            headers={"Authorization": f"bearer {TEST_ACCESS_TOKEN}"},
+        )
+        assert res.status_code in (400, 422)
+    app.state.guppy_client.execute.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_survival_endpoint_stratify_by_object_field(app, client):
+    # Guppy rejects GraphQL queries that select an object field without subfields
+    mock_guppy_data(
+        app,
+        GuppyQueryError(
+            status_code=400,
+            detail='Guppy request failed: Field "demographic" of type "[Demographic]" '
+            "must have a selection of subfields.",
+        ),
+    )
+    res = await client.post(
+        "/survival/",
+        json={"filters": [{"and": []}], "stratify_by": "demographic"},
+        headers={"Authorization": f"bearer {TEST_ACCESS_TOKEN}"},
+    )
+    assert res.status_code == 400
+    assert "demographic" in res.json()["detail"]
+
+
+def survival_histograms(total_counts=None, **values):
+    """
+    Guppy output of the survival histograms: alias => the values of the histogram's
+    field, each counted once. `total_counts` overrides the number of cases
+    """
+    data = {}
+    for alias, alias_values in values.items():
+        field = (
+            "days_to_death" if alias.startswith("death") else "days_to_last_follow_up"
+        )
+        nested = "demographic" if alias.startswith("death") else "diagnoses"
+        data[alias] = {
+            "case": {
+                "_totalCount": (total_counts or {}).get(alias, len(alias_values)),
+                nested: {
+                    field: {
+                        "histogram": [
+                            {"key": [value, value + 1], "count": 1}
+                            for value in alias_values
+                        ]
+                    }
+                },
+            }
+        }
+    return {"data": data}
+
+
+@pytest.mark.asyncio
+async def test_survival_endpoint_from_aggregation(app, client):
+    """
+    With `source="aggregation"`, the curve is fitted from histograms of the cohort's
+    durations, in a single query, and matches the curve fitted from the cases.
+    """
+
+    mock_guppy_data(
+        app,
+        [
+            survival_histograms(
+                death=[769],
+                death_alive=[],
+                follow_up=[769, 1007, 1467, 876, 734, 92],
+                follow_up_alive=[1007, 1467, 876, 734, 92],
+                follow_up_death=[769],
+                follow_up_death_alive=[],
+            )
+        ],
+    )
+
+    res = await client.post(
+        "/survival/",
+        json={"filters": [{"and": []}], "output": "curve", "source": "aggregation"},
+        headers={"Authorization": f"bearer {TEST_ACCESS_TOKEN}"},
+    )
+    assert res.status_code == 200
+    steps = res.json()["results"][0]["steps"]
+    assert steps["time"] == [0, 92, 734, 769, 876, 1007, 1467]
+    assert steps["survival"] == [1.0, 1.0, 1.0] + [0.7500000000000001] * 4
+    assert steps["atRisk"] == [6, 6, 5, 4, 3, 2, 1]
+    assert steps["events"] == [0, 0, 0, 1, 0, 0, 0]
+    assert steps["censored"] == [0, 1, 1, 0, 1, 1, 1]
+
+    calls = app.state.guppy_client.execute.call_args_list
+    assert len(calls) == 1
+    assert "histogram(rangeStep: 1)" in calls[0].kwargs["query"]
+    assert calls[0].kwargs["variables"]["death"]["and"][0] == {"and": []}
+
+    # no donors without the cases
+    res = await client.post(
+        "/survival/",
+        json={"filters": [{"and": []}], "source": "aggregation"},
+        headers={"Authorization": f"bearer {TEST_ACCESS_TOKEN}"},
+    )
+    assert res.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_survival_endpoint_from_aggregation_with_several_values_per_case(
+    app, client
+):
+    """
+    Nested histograms count every diagnosis: if some cases have several, the curve
+    cannot be exact, and the request fails rather than returning a wrong curve
+    """
+    mock_guppy_data(
+        app,
+        [
+            survival_histograms(
+                total_counts={"follow_up": 2, "follow_up_alive": 1},
+                death=[],
+                death_alive=[],
+                # the first case has 2 diagnoses
+                follow_up=[100, 200, 300],
+                follow_up_alive=[100, 200],
+                follow_up_death=[],
+                follow_up_death_alive=[],
+            )
+        ],
+    )
+    res = await client.post(
+        "/survival/",
+        json={"filters": [{"and": []}], "output": "curve", "source": "aggregation"},
+        headers={"Authorization": f"bearer {TEST_ACCESS_TOKEN}"},
+    )
+    assert res.status_code == 422
+    assert "source" in res.json()["detail"]
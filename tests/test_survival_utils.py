@@ -0,0 +1,341 @@
+import numpy as np
+import pytest
+
+from gen3analysis.utils.survival import (
+    SurvivalAccumulator,
+    build_donors,
+    donor_survival_estimates,
+    kaplan_meier,
+    kaplan_meier_lifelines,
+    logrank_test,
+    logrank_test_lifelines,
+    survival_table_from_histograms,
+)
+
+
+def test_donor_survival_estimates_uses_previous_step_for_deaths():
+    # curve as returned by lifelines: a 0 time point followed by each duration
+    timeline = np.array([0.0, 1.0, 2.0, 3.0, 5.0])
+    survival = np.array([1.0, 1.0, 0.5, 0.25, 0.25])
+    durations = np.array([3.0, 1.0, 2.0, 2.0, 5.0])
+    events = np.array([1, 0, 1, 0, 0])
+
+    order, estimates = donor_survival_estimates(timeline, survival, durations, events)
+
+    # ties keep their input order
+    assert order.tolist() == [1, 2, 3, 0, 4]
+    # censored donors get their own step, deaths get the step before
+    assert estimates.tolist() == [1.0, 1.0, 0.5, 0.5, 0.25]
+
+
+def test_build_donors():
+    durations = np.array([20, 10])
+    events = np.array([1, 0])
+    donors = build_donors(
+        order=np.array([1, 0]),
+        estimates=np.array([1.0, 0.5]),
+        durations=durations,
+        events=events,
+        case_ids=np.array(["b", "a"], dtype=object),
+        submitter_ids=np.array(["ID_b", "ID_a"], dtype=object),
+        project_ids=np.array(["P", "P"], dtype=object),
+    )
+    assert donors == [
+        {
+            "time": 10,
+            "id": "a",
+            "submitter_id": "ID_a",
+            "project_id": "P",
+            "survivalEstimate": 1.0,
+            "censored": True,
+        },
+        {
+            "time": 20,
+            "id": "b",
+            "submitter_id": "ID_b",
+            "project_id": "P",
+            "survivalEstimate": 0.5,
+            "censored": False,
+        },
+    ]
+
+
+def test_survival_accumulator_parses_pages_and_drops_invalid_cases():
+    accumulator = SurvivalAccumulator()
+    accumulator.add_page(
+        [
+            {
+                "_case_id": "dead",
+                "submitter_id": "ID_1",
+                "project_id": "P-1",
+                "demographic": [{"days_to_death": 10, "vital_status": "Dead"}],
+                "diagnoses": [{"days_to_last_follow_up": 12}],
+            },
+            # no demographic: dropped
+            {"_case_id": "no-demographic", "project_id": "P-1"},
+            # no duration: dropped
+            {
+                "_case_id": "no-duration",
+                "project_id": "P-1",
+                "demographic": [{"days_to_death": None, "vital_status": "Alive"}],
+                "diagnoses": [{}],
+            },
+            # invalid duration: dropped
+            {
+                "_case_id": "invalid",
+                "project_id": "P-1",
+                "demographic": [{"days_to_death": "abc", "vital_status": "Dead"}],
+            },
+        ]
+    )
+    accumulator.add_page(
+        [
+            {
+                "_case_id": "alive",
+                "submitter_id": "ID_2",
+                "project_id": "P-2",
+                "demographic": [{"days_to_death": None, "vital_status": "Alive"}],
+                "diagnoses": [{"days_to_last_follow_up": "20"}],
+            },
+        ]
+    )
+    cohort = accumulator.finalize()
+
+    assert cohort.size == 2
+    assert cohort.durations.dtype == np.float64
+    assert cohort.durations.tolist() == [10.0, 20.0]
+    assert cohort.events.dtype == np.int8
+    assert cohort.events.tolist() == [1, 0]
+    assert cohort.case_ids.tolist() == ["dead", "alive"]
+    assert cohort.submitter_ids.tolist() == ["ID_1", "ID_2"]
+    assert cohort.project_ids.decode(cohort.project_id_codes).tolist() == [
+        "P-1",
+        "P-2",
+    ]
+
+
+def test_survival_accumulator_stratifies_cohort():
+    accumulator = SurvivalAccumulator(strata_props=["demographic", "gender"])
+    accumulator.add_page(
+        [
+            {
+                "_case_id": str(index),
+                "project_id": "P-1",
+                "demographic": [
+                    {"days_to_death": index + 1, "vital_status": "Dead"}
+                    | ({"gender": gender} if gender else {})
+                ],
+            }
+            for index, gender in enumerate(["male", None, "female", "male"])
+        ]
+    )
+    strata = accumulator.finalize().stratify()
+
+    # sorted by value, cases without a value last, and the cases' order is kept
+    assert [stratum for stratum, _ in strata] == ["female", "male", None]
+    assert [cohort.case_ids.tolist() for _, cohort in strata] == [
+        ["2"],
+        ["0", "3"],
+        ["1"],
+    ]
+    assert strata[1][1].durations.tolist() == [1.0, 4.0]
+    assert strata[1][1].strata_codes is None
+
+
+def test_survival_accumulator_stratifies_numbers_numerically():
+    accumulator = SurvivalAccumulator(strata_props=["diagnoses", "year_of_diagnosis"])
+    accumulator.add_page(
+        [
+            {
+                "_case_id": str(index),
+                "demographic": [{"days_to_death": index + 1}],
+                "diagnoses": [{"year_of_diagnosis": year}],
+            }
+            for index, year in enumerate([10, 9, None, 2.5, 100])
+        ]
+    )
+    strata = accumulator.finalize().stratify()
+    assert [stratum for stratum, _ in strata] == [2.5, 9, 10, 100, None]
+
+
+def test_survival_accumulator_rejects_object_strata():
+    accumulator = SurvivalAccumulator(strata_props=["demographic"])
+    with pytest.raises(ValueError):
+        accumulator.add_page(
+            [{"_case_id": "1", "demographic": [{"days_to_death": 1, "race": "x"}]}]
+        )
+
+
+def random_survival_data(seed):
+    rng = np.random.default_rng(seed)
+    n_cases = int(rng.integers(1, 300))
+    # few distinct durations so that there are many ties
+    durations = rng.integers(1, int(rng.integers(2, 100)), n_cases).astype(float)
+    if seed % 3 == 0:
+        durations += rng.random(n_cases)
+    events = (rng.random(n_cases) < rng.random()).astype(np.int8)
+    return durations, events
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_kaplan_meier_matches_lifelines(seed):
+    durations, events = random_survival_data(seed)
+
+    native = kaplan_meier(durations, events)
+    reference = kaplan_meier_lifelines(durations, events)
+
+    for field in ["timeline", "at_risk", "events", "censored", "survival"]:
+        np.testing.assert_array_equal(
+            getattr(native, field), getattr(reference, field), err_msg=field
+        )
+    np.testing.assert_allclose(native.variance, reference.variance, rtol=1e-12)
+
+    lower, upper = native.confidence_interval()
+    ref_lower, ref_upper = reference.confidence_interval()
+    np.testing.assert_allclose(lower, ref_lower, rtol=1e-9)
+    np.testing.assert_allclose(upper, ref_upper, rtol=1e-9)
+
+
+def test_kaplan_meier_with_weights_matches_repeated_observations():
+    durations = np.array([5.0, 3.0, 8.0, 3.0])
+    events = np.array([1, 0, 1, 1])
+    weights = np.array([2, 1, 3, 4])
+
+    weighted = kaplan_meier(durations, events, weights=weights)
+    repeated = kaplan_meier(np.repeat(durations, weights), np.repeat(events, weights))
+
+    np.testing.assert_array_equal(weighted.timeline, repeated.timeline)
+    np.testing.assert_array_equal(weighted.at_risk, repeated.at_risk)
+    np.testing.assert_allclose(weighted.survival, repeated.survival)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("p, q", [(0, 0), (1, 0), (0.5, 2)])
+def test_logrank_test_matches_lifelines(seed, p, q):
+    rng = np.random.default_rng(seed)
+    n_groups = int(rng.integers(2, 6))
+    durations, events = random_survival_data(seed)
+    groups = np.arange(len(durations)) % n_groups
+
+    native = logrank_test(durations, events, groups, n_groups, p=p, q=q)
+    reference = logrank_test_lifelines(durations, events, groups, n_groups, p=p, q=q)
+
+    assert native.degrees_of_freedom == n_groups - 1
+    assert native.statistic == pytest.approx(reference.statistic, rel=1e-9, abs=1e-12)
+    assert native.p_value == pytest.approx(reference.p_value, rel=1e-9, abs=1e-12)
+    assert [pair[:2] for pair in native.pairwise] == [
+        pair[:2] for pair in reference.pairwise
+    ]
+    np.testing.assert_allclose(
+        [pair[2] for pair in native.pairwise],
+        [pair[2] for pair in reference.pairwise],
+        rtol=1e-9,
+    )
+
+
+def test_survival_table_from_histograms_matches_cases():
+    rng = np.random.default_rng(0)
+    cases = []
+    for index in range(500):
+        demographic = {"vital_status": rng.choice(["Alive", "Dead", None])}
+        diagnoses = [{"days_to_last_follow_up": int(rng.integers(1, 50))}]
+        if rng.random() < 0.4:
+            demographic["days_to_death"] = int(rng.integers(1, 50))
+            if rng.random() < 0.5:
+                diagnoses = []
+        cases.append(
+            {
+                "_case_id": str(index),
+                "demographic": [demographic],
+                "diagnoses": diagnoses,
+            }
+        )
+
+    def histogram(field, *conditions):
+        counts = {}
+        for case in cases:
+            demographic = case["demographic"][0]
+            value = (
+                demographic.get("days_to_death")
+                if field == "death"
+                else (case["diagnoses"] or [{}])[0].get("days_to_last_follow_up")
+            )
+            if value is None or not all(condition(case) for condition in conditions):
+                continue
+            counts[value] = counts.get(value, 0) + 1
+        return [
+            {"key": [key, key + 1], "count": count} for key, count in counts.items()
+        ]
+
+    def has_death(case):
+        return case["demographic"][0].get("days_to_death") is not None
+
+    def is_alive(case):
+        return case["demographic"][0]["vital_status"] == "Alive"
+
+    durations, events, counts = survival_table_from_histograms(
+        death=histogram("death"),
+        death_alive=histogram("death", is_alive),
+        follow_up=histogram("follow_up"),
+        follow_up_alive=histogram("follow_up", is_alive),
+        follow_up_death=histogram("follow_up", has_death),
+        follow_up_death_alive=histogram("follow_up", has_death, is_alive),
+    )
+
+    accumulator = SurvivalAccumulator()
+    accumulator.add_page(cases)
+    cohort = accumulator.finalize()
+    expected = kaplan_meier(cohort.durations, cohort.events)
+    actual = kaplan_meier(durations, events, weights=counts)
+    np.testing.assert_allclose(actual.timeline, expected.timeline)
+    np.testing.assert_allclose(actual.at_risk, expected.at_risk)
+    np.testing.assert_allclose(actual.survival, expected.survival)
+
+
+def test_survival_table_from_histograms_rejects_inconsistent_counts():
+    def histogram(values):
+        return [{"key": [value, value + 1], "count": 1} for value in values]
+
+    # `follow_up_death` counts cases that `follow_up`, its superset, doesn't count
+    with pytest.raises(ValueError):
+        survival_table_from_histograms(
+            death=histogram([10]),
+            death_alive=[],
+            follow_up=histogram([20]),
+            follow_up_alive=[],
+            follow_up_death=histogram([20, 30]),
+            follow_up_death_alive=[],
+        )
+
+
+def test_logrank_test_with_counts_matches_repeated_observations():
+    durations, events = random_survival_data(1)
+    groups = np.arange(len(durations)) % 3
+    counts = np.random.default_rng(1).integers(1, 4, len(durations))
+
+    expected = logrank_test(
+        np.repeat(durations, counts),
+        np.repeat(events, counts),
+        np.repeat(groups, counts),
+        3,
+    )
+    actual = logrank_test(durations, events, groups, 3, counts=counts)
+    assert actual.statistic == pytest.approx(expected.statistic)
+    assert actual.pairwise == pytest.approx(expected.pairwise)
+
+
+def test_logrank_test_of_groups_without_events():
+    durations = np.array([1.0, 2.0, 3.0, 4.0, 1.5, 2.5, 3.5, 5.0, 6.0])
+    events = np.array([1, 1, 0, 1, 0, 0, 0, 0, 0])
+    # groups 1 and 2 have no events
+    groups = np.array([0, 0, 0, 0, 1, 1, 2, 2, 2])
+
+    native = logrank_test(durations, events, groups, 3)
+    reference = logrank_test_lifelines(durations, events, groups, 3)
+
+    assert native.statistic == pytest.approx(reference.statistic)
+    np.testing.assert_allclose(
+        [pair[2] for pair in native.pairwise],
+        [pair[2] for pair in reference.pairwise],
+    )
+    assert native.pairwise[2] == (1, 2, 1.0)